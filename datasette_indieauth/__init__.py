@@ -1,21 +1,67 @@
 from datasette import hookimpl
+from .allow_list import table_allow_list
+from .audit import _audit_logs, audit_log
+from .avatars import AVATAR_CACHE_CONTROL, AvatarError, avatar_cache
+from .diagnostics import diagnostics
+from .popular import popular_endpoints, warm_periodically, WARM_CONNECTIONS_INTERVAL
+from .relme import find_rel_me_provider
+from .replay import ReplayGuardError, replay_guards, STATE_MAX_AGE
+from .status import flush_cache, invalidate_url, status
+from .tokens import (
+    endpoint_registry,
+    sign_cookie,
+    sign_state,
+    unsign_cookie,
+    unsign_state,
+)
+from .permissions import cached_plugin_config
+from .discovery import (
+    _clients,
+    _parse_pools,
+    discover,
+    hcard_cache,
+    http_client,
+    prefetch,
+    restore_discovery_cache,
+    snapshot_discovery_cache,
+    snapshot_periodically,
+)
 from .utils import (
     build_authorization_url,
     canonicalize_url,
-    discover_endpoints,
+    DiscoverEndpointsError,
     display_url,
+    same_profile,
     verify_profile_url,
     verify_same_domain,
 )
 import httpx
 import itsdangerous
-from markupsafe import escape
+from markupsafe import escape, Markup
+import asyncio
+import collections
+import hashlib
 import json
+import re
+import secrets
+import time
 import urllib
+import weakref
 
 DATASETTE_INDIEAUTH_STATE = "datasette-indieauth-state"
 DATASETTE_INDIEAUTH_COOKIE = "datasette-indieauth-cookie"
 
+FORBIDDEN_JSON = b'{"ok": false, "error": "Forbidden", "status": 403}'
+LOGIN_PAGE_CACHE_SIZE = 16
+LOGIN_PAGE_ERROR_HTML = '<p class="message-error">{}</p>'
+
+DISCOVERY_CACHE_SNAPSHOT_INTERVAL = 5 * 60
+
+# Background tasks started by the startup hook, per Datasette instance
+_background_tasks = weakref.WeakKeyDictionary()
+# Rendered login pages per Datasette instance, keyed by (title, instance URL)
+_login_pages = weakref.WeakKeyDictionary()
+
 
 async def indieauth(request, datasette):
     return await indieauth_page(request, datasette)
@@ -27,6 +73,8 @@ async def indieauth_page(request, datasette, status=200, error=None):
     urls = Urls(request, datasette)
 
     if request.method == "POST":
+        start = time.perf_counter()
+        me = authorization_endpoint = provider = None
         while True:  # So I can use 'break'
             post = await request.post_vars()
             me = post.get("me")
@@ -39,12 +87,25 @@ async def indieauth_page(request, datasette, status=200, error=None):
 
             # Start the auth process
             try:
-                me, authorization_endpoint, token_endpoint = await discover_endpoints(
-                    me
+                me, authorization_endpoint, token_endpoint = await discover(
+                    datasette, me
                 )
-            except httpx.RequestError as ex:
+            except (httpx.RequestError, DiscoverEndpointsError) as ex:
                 error = "Invalid IndieAuth identifier: {}".format(ex)
                 break
+            if not authorization_endpoint and cached_plugin_config(
+                datasette
+            ).config.get("relmeauth"):
+                # Sign in through a rel=me profile that links back instead
+                try:
+                    found = await find_rel_me_provider(datasette, me)
+                except (httpx.RequestError, DiscoverEndpointsError):
+                    found = None
+                if found:
+                    provider, authorization_endpoint = found
+                else:
+                    error = "Invalid IndieAuth identifier - no authorization_endpoint or verified rel=me link found"
+                    break
             if not authorization_endpoint:
                 error = "Invalid IndieAuth identifier - no authorization_endpoint found"
                 break
@@ -53,68 +114,212 @@ async def indieauth_page(request, datasette, status=200, error=None):
                 authorization_endpoint=authorization_endpoint,
                 client_id=urls.client_id,
                 redirect_uri=urls.redirect_uri,
-                me=me,
-                signing_function=lambda x: datasette.sign(x, DATASETTE_INDIEAUTH_STATE),
+                me=provider or me,
+                signing_function=lambda x: sign_state(
+                    datasette, x, DATASETTE_INDIEAUTH_STATE
+                ),
             )
             response = Response.redirect(authorization_url)
             response.set_cookie(
                 "ds_indieauth",
-                datasette.sign(
-                    {
-                        "v": verifier,
-                        "m": me,
-                    },
+                sign_cookie(
+                    datasette,
+                    verifier,
+                    me,
                     DATASETTE_INDIEAUTH_COOKIE,
+                    provider=provider,
                 ),
             )
+            log_sign_in(datasette, "start", start, me, authorization_endpoint)
             return response
+        log_sign_in(datasette, "start", start, me, authorization_endpoint, error)
+
+    return await login_page(request, datasette, error=error, status=status)
 
+
+async def login_page(request, datasette, error=None, status=200):
+    from datasette.utils.asgi import Response
+
+    title = datasette.metadata("title") or "Datasette"
+    absolute_instance_url = datasette.absolute_url(request, datasette.urls.instance())
+    csrftoken = request.scope.get("csrftoken") or (lambda: "")
+    # Signed-in users, flash messages and ?_context= all vary the base template
+    cacheable = not (
+        request.actor or "ds_messages" in request.cookies or "_context" in request.args
+    )
+    page = None
+    if cacheable:
+        page = await _cached_login_page(
+            request, datasette, title, absolute_instance_url
+        )
+    if page is None:
+        return Response.html(
+            await datasette.render_template(
+                "indieauth.html",
+                {
+                    "error": error,
+                    "title": title,
+                    "absolute_instance_url": absolute_instance_url,
+                },
+                request=request,
+            ),
+            status=status,
+        )
+    token = csrftoken()
+    headers = {}
+    if request.method == "GET" and status == 200 and not error:
+        etag = '"{}"'.format(
+            hashlib.sha256((page.digest + token).encode("utf-8")).hexdigest()[:32]
+        )
+        headers = {"etag": etag}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response("", status=304, headers=headers)
+    error_html = LOGIN_PAGE_ERROR_HTML.format(escape(error)) if error else ""
     return Response.html(
-        await datasette.render_template(
-            "indieauth.html",
-            {
-                "error": error,
-                "title": datasette.metadata("title") or "Datasette",
-                "absolute_instance_url": datasette.absolute_url(
-                    request, datasette.urls.instance()
-                ),
-            },
-            request=request,
-        ),
+        page.render(csrftoken=token, error=error_html),
         status=status,
+        headers=headers,
     )
 
 
+class CachedPage:
+    "A rendered page with placeholder slots for the per-request parts"
+
+    def __init__(self, html, slots):
+        self.digest = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        self.parts = re.split(
+            "({})".format("|".join(re.escape(v) for v in slots.values())), html
+        )
+        self.names = {v: k for k, v in slots.items()}
+
+    def render(self, **values):
+        return "".join(
+            values[self.names[part]] if part in self.names else part
+            for part in self.parts
+        )
+
+
+async def _cached_login_page(request, datasette, title, absolute_instance_url):
+    from datasette.utils.asgi import Request
+
+    cache = _login_pages.setdefault(datasette, collections.OrderedDict())
+    key = (title, absolute_instance_url)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    marker = "indieauth-{}".format(secrets.token_hex(8))
+    slots = {
+        "csrftoken": marker + "-csrftoken",
+        "error": LOGIN_PAGE_ERROR_HTML.format(marker + "-error"),
+    }
+    scope = dict(request.scope, csrftoken=lambda: slots["csrftoken"])
+    html = await datasette.render_template(
+        "indieauth.html",
+        {
+            "error": Markup(marker + "-error"),
+            "title": title,
+            "absolute_instance_url": absolute_instance_url,
+        },
+        request=Request(scope, request.receive),
+    )
+    if slots["error"] not in html:
+        # A customized template without the standard error markup
+        page = None
+    else:
+        page = CachedPage(html, slots)
+    cache[key] = page
+    while len(cache) > LOGIN_PAGE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return page
+
+
+async def indieauth_prefetch(request, datasette):
+    from datasette.utils.asgi import Response
+
+    me = canonicalize_url(request.args.get("me") or "")
+    if not request.args.get("me") or not verify_profile_url(me):
+        return Response.json({"ok": False, "error": "Invalid me"}, status=400)
+    return Response.json({"ok": True, "me": me, "started": prefetch(datasette, me)})
+
+
 async def indieauth_done(request, datasette):
+    start = time.perf_counter()
+    attempt = {"me": None, "authorization_endpoint": None, "error": None}
+    response = await _indieauth_done(request, datasette, attempt)
+    log_sign_in(datasette, "done", start, **attempt)
+    return response
+
+
+async def _indieauth_done(request, datasette, attempt):
     from datasette.utils.asgi import Response
 
+    async def error_page(error, status=200):
+        attempt["error"] = error
+        return await indieauth_page(request, datasette, error=error, status=status)
+
     state = request.args.get("state") or ""
     code = request.args.get("code")
     try:
-        state_bits = datasette.unsign(state, DATASETTE_INDIEAUTH_STATE)
+        state_bits = unsign_state(datasette, state, DATASETTE_INDIEAUTH_STATE)
     except itsdangerous.BadSignature:
-        return await indieauth_page(
-            request, datasette, error="Invalid state", status=400
-        )
-    authorization_endpoint = state_bits["a"]
+        return await error_page("Invalid state", status=400)
+    authorization_endpoint = state_bits.get("a")
+    attempt["authorization_endpoint"] = authorization_endpoint
+    if "n" not in state_bits or "t" not in state_bits:
+        return await error_page("Invalid state", status=400)
+    if authorization_endpoint is None and state_bits.get("i") is None:
+        return await error_page("Invalid state", status=400)
+    if time.time() - state_bits["t"] > STATE_MAX_AGE:
+        return await error_page("Sign-in attempt has expired, please try again")
 
     urls = Urls(request, datasette)
 
     # code_verifier should be in a signed cookie
     code_verifier = None
     original_me = None
+    provider = None
     if "ds_indieauth" in request.cookies:
         try:
-            cookie_bits = datasette.unsign(
-                request.cookies["ds_indieauth"], DATASETTE_INDIEAUTH_COOKIE
+            cookie_bits = unsign_cookie(
+                datasette, request.cookies["ds_indieauth"], DATASETTE_INDIEAUTH_COOKIE
             )
             code_verifier = cookie_bits["v"]
             original_me = cookie_bits["m"]
+            provider = cookie_bits.get("p")
         except (itsdangerous.BadSignature, KeyError):
             pass
     if not code_verifier or not original_me:
-        return await indieauth_page(
-            request, datasette, error="Invalid ds_indieauth cookie"
+        return await error_page("Invalid ds_indieauth cookie")
+    attempt["me"] = original_me
+
+    if authorization_endpoint is None:
+        # Signed by a process that has not told this one about the endpoint,
+        # so discover it again and check it is the one the ID refers to
+        try:
+            _, authorization_endpoint, _ = await discover(
+                datasette, provider or original_me
+            )
+        except (httpx.RequestError, DiscoverEndpointsError):
+            authorization_endpoint = None
+        if not authorization_endpoint or not endpoint_registry(datasette).matches(
+            state_bits["i"], authorization_endpoint
+        ):
+            return await error_page("Invalid state", status=400)
+        attempt["authorization_endpoint"] = authorization_endpoint
+
+    # Each state can only be used once
+    guard, shared_guard = replay_guards(
+        datasette, cached_plugin_config(datasette).config
+    )
+    try:
+        if not guard.consume(state_bits["n"]) or (
+            shared_guard is not None and not await shared_guard.consume(state_bits["n"])
+        ):
+            return await error_page("Sign-in attempt has already been used", status=400)
+    except ReplayGuardError as ex:
+        # Misconfigured, so no sign-in can succeed until it is fixed
+        return await error_page(
+            "Could not check this sign-in attempt: {}".format(ex), status=500
         )
 
     data = {
@@ -124,8 +329,7 @@ async def indieauth_done(request, datasette):
         "redirect_uri": urls.redirect_uri,
         "code_verifier": code_verifier,
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(authorization_endpoint, data=data)
+    response = await http_client(datasette).post(authorization_endpoint, data=data)
 
     if response.status_code == 200:
         body = response.text
@@ -134,40 +338,54 @@ async def indieauth_done(request, datasette):
         except ValueError:
             info = dict(urllib.parse.parse_qsl(body))
         if "me" not in info:
-            return await indieauth_page(
-                request,
-                datasette,
-                error="Invalid authorization_code response from authorization server",
+            return await error_page(
+                "Invalid authorization_code response from authorization server"
             )
         me = info["me"]
 
         # Verify returned me - must be same domain and link to same authorization_endpoint
         me_error = None
-        if not verify_same_domain(me, original_me):
+        if not verify_same_domain(me, provider or original_me):
             me_error = '"me" value returned by authorization server had a domain that did not match the initial URL'
 
-        canonical_me, me_authorization_endpoint, _ = await utils.discover_endpoints(me)
-        if me_authorization_endpoint != authorization_endpoint:
-            me_error = '"me" value resolves to a different authorization_endpoint'
+        try:
+            canonical_me, me_authorization_endpoint, _ = await discover(datasette, me)
+        except (httpx.RequestError, DiscoverEndpointsError) as ex:
+            me_error = me_error or 'Could not verify "me" value: {}'.format(ex)
+        else:
+            if me_authorization_endpoint != authorization_endpoint:
+                me_error = '"me" value resolves to a different authorization_endpoint'
+            elif provider and not same_profile(canonical_me, provider):
+                # Any account on the provider would otherwise sign in as original_me
+                me_error = '"me" value returned by authorization server did not match the rel=me profile'
 
         if me_error:
-            return await indieauth_page(
-                request,
-                datasette,
-                error=me_error,
-            )
+            return await error_page(me_error)
+        # Only counted once it has signed someone in, so a profile page can't
+        # make this instance keep warm connections to any URL it names
+        popular_endpoints(datasette).add(authorization_endpoint)
 
         me = canonical_me
+        if provider:
+            # The provider profile and original_me link to each other
+            me = original_me
+        attempt["me"] = me
 
         actor = {
             "me": me,
             "display": display_url(me),
         }
+        if provider:
+            actor["relmeauth_provider"] = canonical_me
         if "scope" in info:
             actor["indieauth_scope"] = info["scope"]
 
         if "profile" in info and isinstance(info["profile"], dict):
             actor.update(info["profile"])
+        elif cached_plugin_config(datasette).config.get("hcard_profile"):
+            # Parsed from the profile page when it was fetched for discovery
+            actor.update(hcard_cache(datasette).get(me) or {})
+        await proxy_avatar(datasette, actor)
         response = Response.redirect(datasette.urls.instance())
         response.set_cookie(
             "ds_actor",
@@ -176,13 +394,63 @@ async def indieauth_done(request, datasette):
                 "actor",
             ),
         )
+        response.set_cookie("ds_indieauth", "", max_age=0)
         return response
     else:
-        return await indieauth_page(
-            request,
-            datasette,
-            error="Invalid response from authorization server",
-        )
+        return await error_page("Invalid response from authorization server")
+
+
+async def proxy_avatar(datasette, actor):
+    "Point the actor's photo at /-/indieauth/avatar/<hash> if avatars are cached"
+    avatars = avatar_cache(datasette, cached_plugin_config(datasette).config)
+    photo = actor.get("photo")
+    if (
+        avatars is None
+        or not isinstance(photo, str)
+        or not photo.startswith(("http://", "https://"))
+    ):
+        return
+    loop = asyncio.get_event_loop()
+    try:
+        hash = await loop.run_in_executor(None, avatars.register, photo)
+    except OSError:
+        return
+    actor["photo"] = datasette.urls.path("/-/indieauth/avatar/{}".format(hash))
+
+
+async def indieauth_avatar(request, datasette):
+    from datasette.utils.asgi import AsgiFileDownload, Response
+
+    avatars = avatar_cache(datasette, cached_plugin_config(datasette).config)
+    if avatars is None:
+        return Response.text("Not found", status=404)
+    hash = request.url_vars["hash"]
+    try:
+        meta = await avatars.get(http_client(datasette), hash)
+    except AvatarError:
+        return Response.text("Could not fetch avatar", status=502)
+    if meta is None:
+        return Response.text("Not found", status=404)
+    headers = {
+        "etag": meta["etag"],
+        "cache-control": AVATAR_CACHE_CONTROL,
+        "x-content-type-options": "nosniff",
+    }
+    if request.headers.get("if-none-match") == meta["etag"]:
+        return Response("", status=304, headers=headers)
+    # Streamed from disk rather than read into memory
+    return AsgiFileDownload(
+        avatars.path(hash), content_type=meta["content_type"], headers=headers
+    )
+
+
+def log_sign_in(
+    datasette, stage, start, me=None, authorization_endpoint=None, error=None
+):
+    log = audit_log(datasette, cached_plugin_config(datasette).config)
+    if log is not None:
+        latency_ms = (time.perf_counter() - start) * 1000
+        log.record(stage, me or None, authorization_endpoint, error, latency_ms)
 
 
 class Urls:
@@ -207,11 +475,144 @@ class Urls:
 
 
 @hookimpl
-def register_routes():
-    return [
+def register_routes(datasette):
+    login_routes = [
         (r"^/-/indieauth$", indieauth),
         (r"^/-/indieauth/done$", indieauth_done),
     ]
+    diag = diagnostics(datasette, datasette.plugin_config("datasette-indieauth") or {})
+    if diag is not None:
+        login_routes = [
+            (pattern, diag.wrap(view.__name__, view)) for pattern, view in login_routes
+        ]
+        login_routes.append((r"^/-/indieauth/diagnostics$", indieauth_diagnostics))
+    return login_routes + [
+        (r"^/-/indieauth/prefetch$", indieauth_prefetch),
+        (r"^/-/indieauth/avatar/(?P<hash>[0-9a-f]{64})$", indieauth_avatar),
+        (r"^/-/indieauth/status(?P<format>\.json)?$", indieauth_status),
+    ]
+
+
+async def indieauth_diagnostics(request, datasette):
+    from datasette.utils.asgi import Forbidden, Response
+
+    if not await datasette.permission_allowed(request.actor, "debug-menu"):
+        raise Forbidden("Permission denied")
+    diag = diagnostics(datasette, cached_plugin_config(datasette).config)
+    return Response.json(diag.summary())
+
+
+async def indieauth_status(request, datasette):
+    from datasette.utils.asgi import Forbidden, Response
+
+    if not await datasette.permission_allowed(request.actor, "debug-menu"):
+        raise Forbidden("Permission denied")
+    as_json = bool(request.url_vars.get("format"))
+    if request.method == "POST":
+        post = await request.post_vars()
+        action = post.get("action")
+        ok = True
+        if action == "invalidate" and post.get("url"):
+            cleared = invalidate_url(datasette, post["url"])
+            message = "Invalidated {}: {}".format(
+                post["url"], ", ".join(cleared) or "nothing was cached"
+            )
+        elif action == "flush" and flush_cache(datasette, post.get("cache") or ""):
+            message = "Flushed the {} cache".format(post["cache"])
+        else:
+            ok = False
+            message = "Unknown action"
+        if as_json:
+            return Response.json(
+                {"ok": ok, "message": message}, status=200 if ok else 400
+            )
+        datasette.add_message(
+            request, message, datasette.INFO if ok else datasette.ERROR
+        )
+        return Response.redirect(datasette.urls.path("/-/indieauth/status"))
+    data = status(datasette)
+    if as_json:
+        return Response.json(data)
+    return Response.html(
+        await datasette.render_template(
+            "indieauth_status.html", {"status": data}, request=request
+        )
+    )
+
+
+@hookimpl
+def register_commands(cli):
+    from .cli import register
+
+    register(cli)
+
+
+@hookimpl
+def startup(datasette):
+    plugin_config = datasette.plugin_config("datasette-indieauth") or {}
+    path = plugin_config.get("discovery_cache_file")
+    if path:
+        interval = plugin_config.get(
+            "discovery_cache_snapshot_interval", DISCOVERY_CACHE_SNAPSHOT_INTERVAL
+        )
+        # Load in the background so it does not delay the first request
+        _background_tasks.setdefault(datasette, []).extend(
+            [
+                asyncio.ensure_future(restore_discovery_cache(datasette, path)),
+                asyncio.ensure_future(snapshot_periodically(datasette, path, interval)),
+            ]
+        )
+    diag = diagnostics(datasette, plugin_config)
+    if diag is not None:
+        _background_tasks.setdefault(datasette, []).append(
+            asyncio.ensure_future(diag.monitor_loop_lag())
+        )
+    warm = plugin_config.get("warm_connections")
+    if warm:
+        interval = plugin_config.get(
+            "warm_connections_interval", WARM_CONNECTIONS_INTERVAL
+        )
+        _background_tasks.setdefault(datasette, []).append(
+            asyncio.ensure_future(warm_periodically(datasette, warm, interval))
+        )
+
+
+async def shutdown(datasette):
+    "Called when the server shuts down, to save state and close connections"
+    for task in _background_tasks.pop(datasette, []):
+        task.cancel()
+    plugin_config = datasette.plugin_config("datasette-indieauth") or {}
+    if plugin_config.get("discovery_cache_file"):
+        await snapshot_discovery_cache(datasette, plugin_config["discovery_cache_file"])
+    log = _audit_logs.pop(datasette, None)
+    if log is not None:
+        await log.close()
+    client = _clients.pop(datasette, None)
+    if client is not None:
+        await client.aclose()
+    pool = _parse_pools.pop(datasette, None)
+    if pool is not None:
+        pool.shutdown()
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap_with_shutdown(app):
+        async def wrapped_app(scope, receive, send):
+            if scope["type"] != "lifespan":
+                return await app(scope, receive, send)
+
+            async def wrapped_receive():
+                message = await receive()
+                if message["type"] == "lifespan.shutdown":
+                    await shutdown(datasette)
+                return message
+
+            await app(scope, wrapped_receive, send)
+
+        return wrapped_app
+
+    return wrap_with_shutdown
 
 
 @hookimpl
@@ -226,23 +627,59 @@ def menu_links(datasette, actor):
 
 
 @hookimpl
-def permission_allowed(datasette, actor, action):
-    if action != "view-instance":
-        return None
-    plugin_config = datasette.plugin_config("datasette-indieauth") or {}
-    if plugin_config.get("restrict_access") is None:
-        return None
+def permission_allowed(datasette, actor, action, resource):
+    config = cached_plugin_config(datasette)
+    if action == "view-instance" and config.config.get("restrict_access") is not None:
+        return restrict_access(datasette, config.config, actor)
+    if actor and actor.get("me"):
+        return config.rules.decide(actor["me"], action, resource)
+    return None
+
+
+def restrict_access(datasette, plugin_config, actor):
     # Only actors in the list are allowed
     if not actor:
         return False
     allowed_actors = plugin_config["restrict_access"]
+    if isinstance(allowed_actors, dict):
+        # {"database": ..., "table": ...} - look up actors in that table
+        allow_list = table_allow_list(datasette, allowed_actors)
+
+        async def inner():
+            return await allow_list.contains(actor.get("me"))
+
+        return inner
     if isinstance(allowed_actors, str):
         allowed_actors = allowed_actors.split()
     return actor.get("me") in allowed_actors
 
 
+def wants_html(request):
+    "False for requests that clearly want JSON, CSV or another non-HTML format"
+    last_segment = request.path.rsplit("/", 1)[-1]
+    if "." in last_segment and not last_segment.endswith(".html"):
+        return False
+    if request.args.get("_format"):
+        return False
+    accept = request.headers.get("accept")
+    if accept and "text/html" not in accept:
+        return False
+    return True
+
+
 @hookimpl
 def forbidden(request, datasette):
+    from datasette.utils.asgi import Response
+
+    plugin_config = datasette.plugin_config("datasette-indieauth") or {}
+    lightweight = plugin_config.get("lightweight_forbidden")
+    if lightweight and not wants_html(request):
+        if lightweight == "redirect":
+            return Response.redirect(datasette.urls.path("/-/indieauth"))
+        return Response(
+            FORBIDDEN_JSON, status=403, content_type="application/json; charset=utf-8"
+        )
+
     async def inner():
         return await indieauth_page(request, datasette, 403)
 
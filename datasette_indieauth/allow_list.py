@@ -0,0 +1,101 @@
+import asyncio
+from datasette.utils import escape_sqlite
+import sqlite3
+import time
+import weakref
+
+ALLOW_LIST_CHECK_INTERVAL = 1.0
+
+# TableAllowList instances per Datasette, keyed by (database, table, column)
+_allow_lists = weakref.WeakKeyDictionary()
+
+
+class TableAllowList:
+    """
+    Set of allowed actor "me" values loaded from a database table.
+
+    Lookups are against an in-memory set. At most once every check_interval
+    seconds PRAGMA data_version is read, using a dedicated connection, and
+    the set is only reloaded if another connection has written to the
+    database since the last check.
+    """
+
+    def __init__(
+        self,
+        datasette,
+        database,
+        table,
+        column="me",
+        check_interval=ALLOW_LIST_CHECK_INTERVAL,
+        timer=time.monotonic,
+    ):
+        self.datasette = datasette
+        self.database = database
+        self.table = table
+        self.column = column
+        self.check_interval = check_interval
+        self.timer = timer
+        self.allowed = frozenset()
+        self.data_version = None
+        self.checked = None
+        self.loads = 0
+        self._conn = None
+        self._lock = None
+
+    async def contains(self, me):
+        if self.checked is None or self.timer() - self.checked >= self.check_interval:
+            await self.refresh()
+        return me in self.allowed
+
+    async def refresh(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Another caller may have refreshed while we waited for the lock
+            if (
+                self.checked is not None
+                and self.timer() - self.checked < self.check_interval
+            ):
+                return
+            executor = self.datasette.executor
+            if executor is None:
+                self._check()
+            else:
+                await asyncio.get_event_loop().run_in_executor(executor, self._check)
+            self.checked = self.timer()
+
+    def _check(self):
+        try:
+            if self._conn is None:
+                self._conn = self.datasette.get_database(self.database).connect()
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return
+            rows = self._conn.execute(
+                "select {} from {}".format(
+                    escape_sqlite(self.column), escape_sqlite(self.table)
+                )
+            ).fetchall()
+        except (KeyError, sqlite3.Error):
+            # Missing database or table: deny everyone, try again later
+            self.allowed = frozenset()
+            self.data_version = None
+            return
+        self.allowed = frozenset(row[0] for row in rows)
+        self.data_version = data_version
+        self.loads += 1
+
+
+def table_allow_list(datasette, config):
+    "Returns the TableAllowList for a restrict_access table configuration"
+    allow_lists = _allow_lists.setdefault(datasette, {})
+    key = (config["database"], config["table"], config.get("column") or "me")
+    allow_list = allow_lists.get(key)
+    if allow_list is None:
+        allow_list = TableAllowList(
+            datasette,
+            *key,
+            check_interval=config.get("check_interval", ALLOW_LIST_CHECK_INTERVAL)
+        )
+        allow_lists[key] = allow_list
+    return allow_list
@@ -0,0 +1,150 @@
+import asyncio
+import collections
+import datetime
+from datasette.utils import escape_sqlite
+import weakref
+
+AUDIT_LOG_TABLE = "indieauth_audit_log"
+AUDIT_LOG_BATCH_SIZE = 100
+AUDIT_LOG_FLUSH_INTERVAL = 1.0
+AUDIT_LOG_MAX_QUEUE = 10000
+COLUMNS = (
+    "timestamp",
+    "stage",
+    "me",
+    "authorization_endpoint",
+    "success",
+    "error",
+    "latency_ms",
+)
+
+_audit_logs = weakref.WeakKeyDictionary()
+
+
+class AuditLog:
+    """
+    Records sign-in attempts to a table, in batches.
+
+    record() only appends to an in-memory queue. A background task writes
+    the queue using executemany() once batch_size rows are waiting or every
+    flush_interval seconds. If more than max_queue rows are waiting the
+    oldest are dropped.
+    """
+
+    def __init__(
+        self,
+        datasette,
+        database,
+        table=AUDIT_LOG_TABLE,
+        batch_size=AUDIT_LOG_BATCH_SIZE,
+        flush_interval=AUDIT_LOG_FLUSH_INTERVAL,
+        max_queue=AUDIT_LOG_MAX_QUEUE,
+    ):
+        self.datasette = datasette
+        self.database = database
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = collections.deque(maxlen=max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self._table_created = False
+        self._task = None
+        self._wake = None
+
+    def record(self, stage, me, authorization_endpoint, error, latency_ms):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(
+            (
+                datetime.datetime.utcnow().isoformat(),
+                stage,
+                me,
+                authorization_endpoint,
+                0 if error else 1,
+                error,
+                round(latency_ms, 3),
+            )
+        )
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        if len(self.queue) >= self.batch_size:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        while self.queue:
+            batch = [
+                self.queue.popleft()
+                for _ in range(min(self.batch_size, len(self.queue)))
+            ]
+            try:
+                db = self.datasette.get_database(self.database)
+                await db.execute_write_fn(lambda conn: self._write(conn, batch))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Missing or immutable database, or a SQLite error. Counted
+                # rather than raised, which would stop _run() for good
+                self.failed += len(batch)
+            else:
+                self.written += len(batch)
+
+    def _write(self, conn, batch):
+        table = escape_sqlite(self.table)
+        with conn:
+            if not self._table_created:
+                conn.execute("""
+                    create table if not exists {} (
+                        id integer primary key,
+                        timestamp text,
+                        stage text,
+                        me text,
+                        authorization_endpoint text,
+                        success integer,
+                        error text,
+                        latency_ms real
+                    )
+                    """.format(table))
+                self._table_created = True
+            conn.executemany(
+                "insert into {} ({}) values ({})".format(
+                    table, ", ".join(COLUMNS), ", ".join("?" for _ in COLUMNS)
+                ),
+                batch,
+            )
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+def audit_log(datasette, plugin_config):
+    "Returns the AuditLog for this instance, or None if audit_log is not configured"
+    config = plugin_config.get("audit_log")
+    if not config:
+        return None
+    log = _audit_logs.get(datasette)
+    if log is None:
+        log = AuditLog(
+            datasette,
+            config["database"],
+            table=config.get("table") or AUDIT_LOG_TABLE,
+            batch_size=config.get("batch_size", AUDIT_LOG_BATCH_SIZE),
+            flush_interval=config.get("flush_interval", AUDIT_LOG_FLUSH_INTERVAL),
+            max_queue=config.get("max_queue", AUDIT_LOG_MAX_QUEUE),
+        )
+        _audit_logs[datasette] = log
+    return log
@@ -0,0 +1,208 @@
+"""
+On-disk cache of actor photos, served from /-/indieauth/avatar/<hash> so
+pages showing them do not hotlink third-party hosts.
+"""
+
+import asyncio
+import hashlib
+import httpx
+import json
+import os
+import re
+import time
+import weakref
+from .utils import (
+    DiscoverEndpointsError,
+    ResponseLimits,
+    get_following_redirects,
+    read_limited_body,
+)
+
+AVATAR_CACHE_MAX_BYTES = 50 * 1024 * 1024
+AVATAR_MAX_BYTES = 1024 * 1024
+AVATAR_MAX_AGE = 7 * 24 * 60 * 60
+AVATAR_CACHE_CONTROL = "public, max-age={}".format(AVATAR_MAX_AGE)
+# SVG is left out because it can contain scripts
+AVATAR_CONTENT_TYPES = {
+    "image/avif",
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+}
+AVATAR_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+_avatar_caches = weakref.WeakKeyDictionary()
+
+
+class AvatarError(Exception):
+    pass
+
+
+def avatar_hash(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+class AvatarCache:
+    """
+    Photos stored in directory as <hash> with metadata in <hash>.json.
+
+    A file's modification time is its last use, so when the files add up to
+    more than max_bytes the least recently used are deleted first.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=AVATAR_CACHE_MAX_BYTES,
+        max_avatar_bytes=AVATAR_MAX_BYTES,
+        max_age=AVATAR_MAX_AGE,
+        timer=time.time,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.limits = ResponseLimits(max_avatar_bytes, max_avatar_bytes)
+        self.max_age = max_age
+        self.timer = timer
+        self.fetches = 0
+        self._in_flight = {}
+
+    def path(self, hash):
+        return os.path.join(self.directory, hash)
+
+    def register(self, url):
+        "Remember url so /-/indieauth/avatar/<hash> can fetch it, returns hash"
+        hash = avatar_hash(url)
+        meta_path = self.path(hash) + ".json"
+        if not os.path.exists(meta_path):
+            os.makedirs(self.directory, exist_ok=True)
+            self._write_json(meta_path, {"url": url})
+        return hash
+
+    def read_meta(self, hash):
+        try:
+            with open(self.path(hash) + ".json") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    async def get(self, client, hash):
+        """
+        Returns metadata for a cached photo, fetching it if needed, or None
+        if hash was never registered. Raises AvatarError if it can't be fetched.
+        """
+        if not AVATAR_HASH_RE.match(hash):
+            return None
+        loop = asyncio.get_event_loop()
+        meta = await loop.run_in_executor(None, self.read_meta, hash)
+        if meta is None:
+            return None
+        fresh = meta.get("fetched") and self.timer() - meta["fetched"] < self.max_age
+        if fresh and os.path.exists(self.path(hash)):
+            await loop.run_in_executor(None, self._touch, hash)
+            return meta
+        # Concurrent requests for the same photo share one fetch
+        task = self._in_flight.get(hash)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(client, hash, meta))
+            self._in_flight[hash] = task
+            task.add_done_callback(lambda task: self._in_flight.pop(hash, None))
+        try:
+            return await asyncio.shield(task)
+        except AvatarError:
+            if "etag" in meta and os.path.exists(self.path(hash)):
+                # Serve the stale copy rather than nothing
+                return meta
+            raise
+
+    async def _fetch(self, client, hash, meta):
+        self.fetches += 1
+        try:
+            response = await get_following_redirects(client, meta["url"])
+            try:
+                if response.status_code != 200:
+                    raise AvatarError("HTTP {}".format(response.status_code))
+                content_type = (
+                    response.headers.get("content-type", "")
+                    .split(";")[0]
+                    .strip()
+                    .lower()
+                )
+                if content_type not in AVATAR_CONTENT_TYPES:
+                    raise AvatarError("Unsupported content-type")
+                body = await asyncio.wait_for(
+                    read_limited_body(response, self.limits),
+                    self.limits.max_read_seconds,
+                )
+            finally:
+                await response.aclose()
+        except asyncio.TimeoutError:
+            raise AvatarError("Timed out")
+        except (httpx.HTTPError, DiscoverEndpointsError) as ex:
+            raise AvatarError(str(ex))
+        meta = dict(
+            meta,
+            content_type=content_type,
+            etag='"{}"'.format(hashlib.sha256(body).hexdigest()[:32]),
+            fetched=self.timer(),
+        )
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._store, hash, body, meta
+        )
+        return meta
+
+    def _store(self, hash, body, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path(hash) + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(body)
+        os.replace(tmp_path, self.path(hash))
+        self._write_json(self.path(hash) + ".json", meta)
+        self.evict()
+
+    def _write_json(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tmp_path, path)
+
+    def _touch(self, hash):
+        try:
+            os.utime(self.path(hash))
+        except OSError:
+            pass
+
+    def evict(self):
+        "Delete least recently used photos until they fit in max_bytes"
+        files = []
+        for entry in os.scandir(self.directory):
+            if AVATAR_HASH_RE.match(entry.name):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.name))
+        total = sum(size for _, size, _ in files)
+        for mtime, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            # Keep the .json so the photo can be fetched again if needed
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                continue
+            total -= size
+
+
+def avatar_cache(datasette, plugin_config):
+    "Returns the AvatarCache, or None if avatar_cache_dir is not configured"
+    directory = plugin_config.get("avatar_cache_dir")
+    if not directory:
+        return None
+    cache = _avatar_caches.get(datasette)
+    if cache is None:
+        cache = AvatarCache(
+            directory,
+            max_bytes=plugin_config.get(
+                "avatar_cache_max_bytes", AVATAR_CACHE_MAX_BYTES
+            ),
+        )
+        _avatar_caches[datasette] = cache
+    return cache
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import time
+
+
+class TTLCache:
+    """
+    Bounded least-recently-used cache where entries expire after ``ttl`` seconds.
+
+    Expiry times are wall-clock timestamps so entries can be persisted.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self.timer():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None, expires=None):
+        if expires is None:
+            ttl = self.ttl if ttl is None else ttl
+            expires = None if ttl is None else self.timer() + ttl
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        expires, value = self._data.pop(key, (None, default))
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self):
+        "Yields (key, value, expires) for entries that have not yet expired"
+        now = self.timer()
+        for key, (expires, value) in list(self._data.items()):
+            if expires is None or expires > now:
+                yield key, value, expires
+
+    def __contains__(self, key):
+        if key not in self._data:
+            return False
+        expires = self._data[key][0]
+        return expires is None or expires > self.timer()
+
+    def __len__(self):
+        return len(self._data)
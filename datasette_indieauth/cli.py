@@ -0,0 +1,130 @@
+import asyncio
+import click
+import httpx
+import json
+import sys
+import time
+from .cache import TTLCache
+from .discovery import read_cache_file, write_cache_file
+from .utils import (
+    DiscoverEndpointsError,
+    canonicalize_url,
+    discover_endpoints,
+    verify_profile_url,
+)
+
+
+async def discover_many(urls, concurrency=20, client=None, redirect_cache=None):
+    """
+    Run discovery for each URL, at most concurrency at a time.
+
+    Yields a result dictionary for each URL in the order they complete.
+    """
+    if client is None:
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(max_redirects=5, limits=limits) as client:
+            async for result in discover_many(
+                urls, concurrency, client, redirect_cache
+            ):
+                yield result
+        return
+    if redirect_cache is None:
+        redirect_cache = TTLCache()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def discover_one(url):
+        result = {
+            "url": url,
+            "me": None,
+            "canonical_url": None,
+            "authorization_endpoint": None,
+            "token_endpoint": None,
+            "ms": None,
+            "error": None,
+        }
+        me = canonicalize_url(url)
+        if not verify_profile_url(me):
+            result["error"] = "Invalid IndieAuth identifier"
+            return result
+        result["me"] = me
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                (
+                    result["canonical_url"],
+                    result["authorization_endpoint"],
+                    result["token_endpoint"],
+                ) = await discover_endpoints(
+                    me, client=client, redirect_cache=redirect_cache
+                )
+            except (httpx.RequestError, DiscoverEndpointsError) as ex:
+                result["error"] = "{}: {}".format(ex.__class__.__name__, ex)
+            result["ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return result
+
+    for future in asyncio.as_completed([discover_one(url) for url in urls]):
+        yield await future
+
+
+def register(cli):
+    @cli.group()
+    def indieauth():
+        "Commands for datasette-indieauth"
+
+    @indieauth.command()
+    @click.argument("urls_file", type=click.File("r"), default="-")
+    @click.option(
+        "-c",
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=20,
+        help="Number of discoveries to run at once",
+    )
+    @click.option(
+        "--cache-file",
+        type=click.Path(dir_okay=False),
+        help="Write successful results to this discovery cache file",
+    )
+    @click.option(
+        "--ttl",
+        type=click.IntRange(min=1),
+        default=60 * 60,
+        help="Seconds until results written to --cache-file expire",
+    )
+    def discover(urls_file, concurrency, cache_file, ttl):
+        """
+        Discover IndieAuth endpoints for a list of profile URLs
+
+        Reads one URL per line from URLS_FILE, or standard input, and outputs
+        newline-delimited JSON.
+        """
+        urls = [line.strip() for line in urls_file if line.strip()]
+        cache = None
+        if cache_file:
+            existing = read_cache_file(cache_file)
+            # Room for everything already in the file plus every new URL, so
+            # a small run never evicts entries the plugin has warmed
+            cache = TTLCache(maxsize=len(existing) + len(urls) or 1)
+            for key, value, expires in existing:
+                cache.set(key, value, expires=expires)
+
+        async def run():
+            async for result in discover_many(urls, concurrency):
+                sys.stdout.write(json.dumps(result) + "\n")
+                sys.stdout.flush()
+                # A profile without an authorization_endpoint cannot be used
+                # to sign in, so caching it would only delay a retry
+                if cache is not None and result["authorization_endpoint"]:
+                    cache.set(
+                        result["me"],
+                        (
+                            result["canonical_url"],
+                            result["authorization_endpoint"],
+                            result["token_endpoint"],
+                        ),
+                        ttl=ttl,
+                    )
+
+        asyncio.run(run())
+        if cache is not None:
+            write_cache_file(cache_file, cache.items())
@@ -0,0 +1,176 @@
+"""
+Opt-in diagnostics for the IndieAuth routes: an event loop lag monitor and
+cProfile captures of slow requests. Nothing here runs unless the
+"diagnostics" plugin setting is present.
+"""
+
+import asyncio
+import collections
+import itertools
+import os
+import time
+import weakref
+
+DIAGNOSTICS_SLOW_MS = 500
+DIAGNOSTICS_MAX_PROFILES = 50
+DIAGNOSTICS_LAG_INTERVAL = 0.1
+DIAGNOSTICS_LAG_THRESHOLD_MS = 50
+DIAGNOSTICS_MAX_STALLS = 100
+
+_diagnostics = weakref.WeakKeyDictionary()
+
+
+class Diagnostics:
+    """
+    Tracks which IndieAuth handlers are running, so that event loop stalls
+    can be blamed on them, and profiles requests to those handlers.
+
+    cProfile sees every coroutine that runs while a profiled request is
+    waiting, and only one profiler can be active at a time, so concurrent
+    requests are not profiled.
+    """
+
+    def __init__(
+        self,
+        profile_dir=None,
+        slow_ms=DIAGNOSTICS_SLOW_MS,
+        max_profiles=DIAGNOSTICS_MAX_PROFILES,
+        lag_interval=DIAGNOSTICS_LAG_INTERVAL,
+        lag_threshold_ms=DIAGNOSTICS_LAG_THRESHOLD_MS,
+    ):
+        self.profile_dir = profile_dir
+        self.slow_ms = slow_ms
+        self.max_profiles = max_profiles
+        self.lag_interval = lag_interval
+        self.lag_threshold_ms = lag_threshold_ms
+        # {request number: handler name} for requests being handled
+        self.active = {}
+        # Handlers that finished since the lag monitor last woke up
+        self.recent = set()
+        self.stalls = collections.deque(maxlen=DIAGNOSTICS_MAX_STALLS)
+        self.stalls_by_handler = collections.Counter()
+        self.max_lag_ms = 0.0
+        self._counter = itertools.count()
+        self._profiling = False
+
+    def wrap(self, name, handler):
+        "Wrap a route handler so it is tracked and profiled"
+
+        async def wrapped(request, datasette):
+            number = next(self._counter)
+            self.active[number] = name
+            profiler = self._start_profile()
+            start = time.perf_counter()
+            try:
+                return await handler(request, datasette)
+            finally:
+                duration_ms = (time.perf_counter() - start) * 1000
+                self.active.pop(number, None)
+                self.recent.add(name)
+                if profiler is not None:
+                    profiler.disable()
+                    self._profiling = False
+                    if duration_ms >= self.slow_ms:
+                        await asyncio.get_event_loop().run_in_executor(
+                            None, self.save_profile, profiler, name, duration_ms, number
+                        )
+
+        wrapped.__name__ = handler.__name__
+        return wrapped
+
+    def _start_profile(self):
+        if self.profile_dir is None or self._profiling:
+            return None
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler, such as a coverage tool, is already active
+            return None
+        self._profiling = True
+        return profiler
+
+    def save_profile(self, profiler, name, duration_ms, number=0):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        filename = "{}-{}-{}-{}ms.prof".format(
+            time.strftime("%Y%m%dT%H%M%S"), number, name, int(duration_ms)
+        )
+        profiler.dump_stats(os.path.join(self.profile_dir, filename))
+        # Delete the oldest profiles beyond max_profiles
+        for old in self.profiles()[self.max_profiles :]:
+            try:
+                os.remove(os.path.join(self.profile_dir, old["name"]))
+            except OSError:
+                pass
+        return filename
+
+    def profiles(self):
+        "Returns details of saved profiles, newest first"
+        if self.profile_dir is None or not os.path.isdir(self.profile_dir):
+            return []
+        profiles = []
+        for entry in os.scandir(self.profile_dir):
+            if entry.name.endswith(".prof"):
+                stat = entry.stat()
+                profiles.append(
+                    {
+                        "name": entry.name,
+                        "size": stat.st_size,
+                        "created": stat.st_mtime,
+                    }
+                )
+        profiles.sort(key=lambda profile: (profile["created"], profile["name"]))
+        return list(reversed(profiles))
+
+    def record_lag(self, lag_ms):
+        self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+        if lag_ms < self.lag_threshold_ms:
+            return
+        # A handler that blocked the loop may have finished before we woke
+        handlers = sorted(set(self.active.values()) | self.recent)
+        self.stalls.append(
+            {"at": time.time(), "lag_ms": round(lag_ms, 1), "handlers": handlers}
+        )
+        for handler in handlers or ["(none)"]:
+            self.stalls_by_handler[handler] += 1
+
+    async def monitor_loop_lag(self):
+        "Measure how late each sleep(lag_interval) wakes up, forever"
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            lag = time.perf_counter() - start - self.lag_interval
+            self.record_lag(max(lag, 0) * 1000)
+            self.recent.clear()
+
+    def summary(self):
+        return {
+            "active": sorted(self.active.values()),
+            "max_lag_ms": round(self.max_lag_ms, 1),
+            "stalls_by_handler": dict(self.stalls_by_handler),
+            "recent_stalls": list(self.stalls),
+            "profiles": self.profiles(),
+        }
+
+
+def diagnostics(datasette, plugin_config):
+    "Returns the Diagnostics for this instance, or None if they are not enabled"
+    config = plugin_config.get("diagnostics")
+    if not config:
+        return None
+    instance = _diagnostics.get(datasette)
+    if instance is None:
+        if not isinstance(config, dict):
+            config = {}
+        instance = Diagnostics(
+            profile_dir=config.get("profile_dir"),
+            slow_ms=config.get("slow_ms", DIAGNOSTICS_SLOW_MS),
+            max_profiles=config.get("max_profiles", DIAGNOSTICS_MAX_PROFILES),
+            lag_threshold_ms=config.get(
+                "lag_threshold_ms", DIAGNOSTICS_LAG_THRESHOLD_MS
+            ),
+        )
+        _diagnostics[datasette] = instance
+    return instance
@@ -0,0 +1,284 @@
+"""
+Per-instance state for endpoint discovery: the shared HTTP client, the
+redirect and discovery caches and discoveries that are currently running.
+"""
+
+import asyncio
+import httpx
+import json
+import os
+import time
+import urllib.request
+import weakref
+from .cache import TTLCache
+from .hosts import MIN_TIMEOUT, HostTracker
+from .permissions import cached_plugin_config
+from .utils import (
+    PARSE_INLINE_MAX,
+    PARSE_WORKERS,
+    ParsePool,
+    TokenBucket,
+    discover_endpoints,
+)
+
+# Idle connections in the shared client's pool are kept this long
+KEEPALIVE_EXPIRY = 60
+REDIRECT_CACHE_SIZE = 1000
+REDIRECT_CACHE_TTL = 24 * 60 * 60
+DISCOVERY_CACHE_SIZE = 1000
+DISCOVERY_CACHE_TTL = 5 * 60
+HCARD_CACHE_SIZE = 1000
+HCARD_CACHE_TTL = 60 * 60
+REL_ME_CACHE_SIZE = 1000
+REL_ME_CACHE_TTL = 60 * 60
+# Background discoveries started by /-/indieauth/prefetch
+PREFETCH_MAX_IN_FLIGHT = 20
+PREFETCH_RATE = 10
+PREFETCH_BURST = 20
+
+# One pooled httpx.AsyncClient per Datasette instance
+_clients = weakref.WeakKeyDictionary()
+# DNS answers for the shared client, per Datasette instance
+_resolvers = weakref.WeakKeyDictionary()
+# Permanent redirects seen during discovery, per Datasette instance
+_redirect_caches = weakref.WeakKeyDictionary()
+# Results of discover_endpoints(), per Datasette instance
+_discovery_caches = weakref.WeakKeyDictionary()
+# h-cards parsed from profile pages, keyed by canonical URL, per Datasette instance
+_hcard_caches = weakref.WeakKeyDictionary()
+# rel="me" links of profile pages, keyed by canonical URL, per Datasette instance
+_rel_me_caches = weakref.WeakKeyDictionary()
+# {url: asyncio.Task} of discoveries currently running, per Datasette instance
+_in_flight = weakref.WeakKeyDictionary()
+_prefetch_limiters = weakref.WeakKeyDictionary()
+# Threads for parsing large profile pages, per Datasette instance
+_parse_pools = weakref.WeakKeyDictionary()
+# Latency and error rates of profile hosts, per Datasette instance
+_host_trackers = weakref.WeakKeyDictionary()
+
+
+def http_client(datasette):
+    "Returns the shared httpx.AsyncClient used for outbound requests"
+    client = _clients.get(datasette)
+    if client is None:
+        limits = httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        from .resolver import PinnedTransport
+
+        transport = None
+        # With a proxy the proxy resolves hostnames, so addresses can't be pinned
+        if not any(
+            key in urllib.request.getproxies() for key in ("http", "https", "all")
+        ):
+            transport = PinnedTransport(resolver(datasette), limits=limits)
+        client = httpx.AsyncClient(max_redirects=5, limits=limits, transport=transport)
+        _clients[datasette] = client
+    return client
+
+
+def resolver(datasette):
+    "Returns the caching Resolver used by the shared client"
+    resolver = _resolvers.get(datasette)
+    if resolver is None:
+        # Imported here as httpcore is slow to import
+        from .resolver import Resolver
+
+        config = cached_plugin_config(datasette).config
+        resolver = Resolver(allow=config.get("allow_private_addresses"))
+        _resolvers[datasette] = resolver
+    return resolver
+
+
+def redirect_cache(datasette):
+    "Returns the cache of permanent redirects used by discover_endpoints()"
+    cache = _redirect_caches.get(datasette)
+    if cache is None:
+        cache = TTLCache(maxsize=REDIRECT_CACHE_SIZE, ttl=REDIRECT_CACHE_TTL)
+        _redirect_caches[datasette] = cache
+    return cache
+
+
+def discovery_cache(datasette):
+    "Returns the cache of (canonical_url, authorization_endpoint, token_endpoint)"
+    cache = _discovery_caches.get(datasette)
+    if cache is None:
+        cache = TTLCache(maxsize=DISCOVERY_CACHE_SIZE, ttl=DISCOVERY_CACHE_TTL)
+        _discovery_caches[datasette] = cache
+    return cache
+
+
+def host_tracker(datasette):
+    "Returns the HostTracker used to pick per-host discovery timeouts"
+    tracker = _host_trackers.get(datasette)
+    if tracker is None:
+        config = cached_plugin_config(datasette).config
+        tracker = HostTracker(
+            min_timeout=config.get("discovery_min_timeout", MIN_TIMEOUT)
+        )
+        _host_trackers[datasette] = tracker
+    return tracker
+
+
+def hcard_cache(datasette):
+    "Returns the cache of {name, photo, url} dicts parsed from profile pages"
+    cache = _hcard_caches.get(datasette)
+    if cache is None:
+        cache = TTLCache(maxsize=HCARD_CACHE_SIZE, ttl=HCARD_CACHE_TTL)
+        _hcard_caches[datasette] = cache
+    return cache
+
+
+def rel_me_cache(datasette):
+    "Returns the cache of rel=me link lists parsed from profile pages"
+    cache = _rel_me_caches.get(datasette)
+    if cache is None:
+        cache = TTLCache(maxsize=REL_ME_CACHE_SIZE, ttl=REL_ME_CACHE_TTL)
+        _rel_me_caches[datasette] = cache
+    return cache
+
+
+def parse_pool(datasette):
+    "Returns the ParsePool used to parse large profile pages"
+    pool = _parse_pools.get(datasette)
+    if pool is None:
+        config = cached_plugin_config(datasette).config
+        pool = ParsePool(
+            max_workers=config.get("parse_workers", PARSE_WORKERS),
+            inline_max=config.get("parse_inline_max", PARSE_INLINE_MAX),
+        )
+        _parse_pools[datasette] = pool
+    return pool
+
+
+def read_cache_file(path, now=None):
+    "Returns [(key, value, expires)] for unexpired entries in a cache file"
+    if not os.path.exists(path):
+        return []
+    now = time.time() if now is None else now
+    entries = []
+    with open(path) as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+                key, value, expires = entry["key"], entry["value"], entry["expires"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            if expires is not None and expires <= now:
+                continue
+            entries.append((key, tuple(value), expires))
+    return entries
+
+
+def write_cache_file(path, entries):
+    "Atomically write (key, value, expires) entries as newline-delimited JSON"
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as fp:
+        for key, value, expires in entries:
+            fp.write(
+                json.dumps({"key": key, "value": list(value), "expires": expires})
+                + "\n"
+            )
+    os.replace(tmp_path, path)
+
+
+async def restore_discovery_cache(datasette, path):
+    "Load a cache file in a thread, without replacing any newer entries"
+    loop = asyncio.get_event_loop()
+    try:
+        entries = await loop.run_in_executor(None, read_cache_file, path)
+    except OSError:
+        return 0
+    cache = discovery_cache(datasette)
+    for key, value, expires in entries:
+        if key not in cache:
+            cache.set(key, value, expires=expires)
+    return len(entries)
+
+
+async def snapshot_discovery_cache(datasette, path):
+    entries = list(discovery_cache(datasette).items())
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, write_cache_file, path, entries)
+
+
+async def snapshot_periodically(datasette, path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await snapshot_discovery_cache(datasette, path)
+        except OSError:
+            pass
+
+
+def discovery_options(datasette):
+    "Returns the keyword arguments for discover_endpoints() for this instance"
+    config = cached_plugin_config(datasette).config
+    return {
+        "client": http_client(datasette),
+        "redirect_cache": redirect_cache(datasette),
+        "hosts": host_tracker(datasette),
+        "hedge": bool(config.get("hedge_discovery")),
+        "parse_pool": parse_pool(datasette),
+        "hcards": hcard_cache(datasette) if config.get("hcard_profile") else None,
+        "rel_me": rel_me_cache(datasette) if config.get("relmeauth") else None,
+    }
+
+
+def start_discovery(datasette, url):
+    "Returns the asyncio.Task discovering url, starting one if none is running"
+    in_flight = _in_flight.setdefault(datasette, {})
+    task = in_flight.get(url)
+    if task is not None:
+        return task
+    cache = discovery_cache(datasette)
+    task = asyncio.ensure_future(
+        discover_endpoints(url, **discovery_options(datasette))
+    )
+    in_flight[url] = task
+
+    def done(task):
+        in_flight.pop(url, None)
+        # Calling .exception() also stops "exception was never retrieved"
+        if task.cancelled() or task.exception() is not None:
+            return
+        # Without an authorization_endpoint - an error response, or a page
+        # that is being edited - the next attempt should look again
+        result = task.result()
+        if result[1]:
+            cache.set(url, result)
+
+    task.add_done_callback(done)
+    return task
+
+
+async def discover(datasette, url):
+    """
+    Cached discover_endpoints() for url, returns the same tuple.
+
+    Concurrent calls for the same URL share a single request.
+    """
+    result = discovery_cache(datasette).get(url)
+    if result is not None:
+        return result
+    # shield() so one caller giving up does not cancel it for the others
+    return await asyncio.shield(start_discovery(datasette, url))
+
+
+def prefetch(datasette, url):
+    "Start discovering url in the background, returns True if it was started"
+    if url in discovery_cache(datasette):
+        return False
+    in_flight = _in_flight.get(datasette) or {}
+    if url in in_flight:
+        return False
+    limiter = _prefetch_limiters.get(datasette)
+    if limiter is None:
+        limiter = TokenBucket(rate=PREFETCH_RATE, burst=PREFETCH_BURST)
+        _prefetch_limiters[datasette] = limiter
+    if len(in_flight) >= PREFETCH_MAX_IN_FLIGHT or not limiter.consume():
+        return False
+    start_discovery(datasette, url)
+    return True
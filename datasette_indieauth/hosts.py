@@ -0,0 +1,98 @@
+from collections import OrderedDict, deque
+import math
+
+HOST_STATS_SIZE = 1000
+# Weight given to each new sample in the moving averages
+EWMA_ALPHA = 0.125
+EWMA_BETA = 0.25
+# The shortest timeout a host is given, httpx's default - so a host that is
+# usually fast does not fail sign-in the one time it is slow
+MIN_TIMEOUT = 5.0
+MAX_TIMEOUT = 10.0
+# Latencies kept per host for estimating the 95th percentile
+LATENCY_WINDOW = 50
+HEDGE_MIN_SAMPLES = 10
+HEDGE_MIN_DELAY = 0.05
+
+
+class HostStats:
+    "Moving averages of latency and error rate for requests to one host"
+
+    __slots__ = ("latency", "deviation", "error_rate", "samples", "recent")
+
+    def __init__(self):
+        self.latency = None
+        self.deviation = 0.0
+        self.error_rate = 0.0
+        self.samples = 0
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, latency, error=False):
+        self.samples += 1
+        self.error_rate += EWMA_ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+        if self.latency is None:
+            self.latency = latency
+            self.deviation = latency / 2
+        else:
+            # Same smoothing as TCP's retransmission timer, RFC 6298
+            self.deviation += EWMA_BETA * (abs(latency - self.latency) - self.deviation)
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.recent.append(latency)
+
+    def timeout(self, min_timeout=MIN_TIMEOUT):
+        # A host that keeps failing - usually by timing out - is given up to
+        # twice as long before the next request is abandoned
+        timeout = (self.latency + 4 * self.deviation) * (1 + self.error_rate)
+        return min(max(timeout, min_timeout), max(MAX_TIMEOUT, min_timeout))
+
+    def p95(self):
+        ordered = sorted(self.recent)
+        return ordered[math.ceil(0.95 * len(ordered)) - 1]
+
+
+class HostTracker:
+    """
+    Latency and error statistics for the hosts contacted during discovery,
+    for the least recently used ``maxsize`` hosts.
+    """
+
+    def __init__(self, maxsize=HOST_STATS_SIZE, min_timeout=MIN_TIMEOUT):
+        self.maxsize = maxsize
+        self.min_timeout = min_timeout
+        self._hosts = OrderedDict()
+
+    def get(self, host):
+        return self._hosts.get(host)
+
+    def record(self, host, latency, error=False):
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = HostStats()
+            self._hosts[host] = stats
+            if len(self._hosts) > self.maxsize:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+        stats.record(latency, error)
+
+    def timeout(self, host):
+        "Timeout in seconds for a request to host, or None if it is unknown"
+        stats = self._hosts.get(host)
+        if stats is None:
+            return None
+        return stats.timeout(self.min_timeout)
+
+    def hedge_delay(self, host):
+        "Seconds to wait before sending a second request, or None to not hedge"
+        stats = self._hosts.get(host)
+        if stats is None or len(stats.recent) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(stats.p95(), HEDGE_MIN_DELAY)
+
+    def items(self):
+        "Yields (host, HostStats), most recently used first"
+        for host in reversed(list(self._hosts)):
+            yield host, self._hosts[host]
+
+    def __len__(self):
+        return len(self._hosts)
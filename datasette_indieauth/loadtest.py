@@ -0,0 +1,281 @@
+"""
+Load-test harness for the IndieAuth sign-in flow.
+
+Runs an in-process Datasette instance against a local ASGI mock of the
+profile hosts and authorization server, so no network access is needed:
+
+    python -m datasette_indieauth.loadtest --users 2000 --concurrency 200
+
+Each simulated user submits the /-/indieauth form, follows the redirect to
+the mock authorization server, then returns to /-/indieauth/done.
+"""
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import math
+import random
+import secrets
+import time
+from urllib.parse import parse_qs, parse_qsl, urlencode
+
+import httpx
+
+from .utils import encode_challenge
+
+AUTH_HOST = "auth.example"
+BROWSER_HEADER = "x-loadtest-browser"
+
+
+class MockProvider:
+    """
+    ASGI app that acts as both the profile hosts and the authorization server.
+
+    Any host other than auth.example serves a profile page. Profile pages
+    redirect through ``redirects`` permanent redirects before returning HTML
+    of roughly ``body_size`` bytes. ``latency`` seconds are added to every
+    response and ``failure_rate`` is the fraction of requests that get a 500.
+    """
+
+    def __init__(self, latency=0.0, body_size=0, redirects=0, failure_rate=0.0):
+        self.latency = latency
+        self.body_size = body_size
+        self.redirects = redirects
+        self.failure_rate = failure_rate
+        self.authorization_endpoint = "https://{}/auth".format(AUTH_HOST)
+        self.codes = {}
+        # Requests made by Datasette, keyed by (method, host kind)
+        self.outbound = collections.Counter()
+        self._random = random.Random()
+
+    def seed(self, seed):
+        self._random.seed(seed)
+
+    def profile_url(self, n):
+        return "https://user{}.example/".format(n)
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        headers = dict(scope["headers"])
+        host = headers.get(b"host", b"").decode("latin-1")
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        is_browser = BROWSER_HEADER.encode("latin-1") in headers
+        if not is_browser:
+            kind = "auth" if host == AUTH_HOST else "profile"
+            self.outbound[(scope["method"], kind)] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if (
+            not is_browser
+            and self.failure_rate
+            and self._random.random() < self.failure_rate
+        ):
+            status, response_headers, content = 500, [], b"error"
+        elif host == AUTH_HOST:
+            status, response_headers, content = self.authorization_server(scope, body)
+        else:
+            status, response_headers, content = self.profile(host, scope["path"])
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-length", str(len(content)).encode("latin-1"))]
+                + [
+                    (k.encode("latin-1"), v.encode("latin-1"))
+                    for k, v in response_headers
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": content})
+
+    def profile(self, host, path):
+        if self.redirects:
+            hop = 0 if path == "/" else int(path.lstrip("/r") or 0)
+            if hop < self.redirects:
+                return 301, [("location", "/r{}".format(hop + 1))], b""
+        html = '<link rel="authorization_endpoint" href="{}">\n'.format(
+            self.authorization_endpoint
+        )
+        if len(html) < self.body_size:
+            html += "<!--{}-->".format("x" * (self.body_size - len(html) - 7))
+        return 200, [("content-type", "text/html; charset=utf-8")], html.encode("utf-8")
+
+    def authorization_server(self, scope, body):
+        if scope["method"] == "GET":
+            # The user has approved the request - redirect back with a code
+            args = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+            code = secrets.token_hex(8)
+            self.codes[code] = args
+            location = "{}?{}".format(
+                args["redirect_uri"], urlencode({"code": code, "state": args["state"]})
+            )
+            return 302, [("location", location)], b""
+        # Redeem the authorization code
+        data = {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+        args = self.codes.pop(data.get("code"), None)
+        if args is None:
+            return 400, [], b'{"error": "invalid_grant"}'
+        challenge = encode_challenge(
+            hashlib.sha256(data.get("code_verifier", "").encode("ascii")).digest()
+        )
+        if (
+            challenge != args["code_challenge"]
+            or data.get("client_id") != args["client_id"]
+            or data.get("redirect_uri") != args["redirect_uri"]
+        ):
+            return 400, [], b'{"error": "invalid_grant"}'
+        return (
+            200,
+            [("content-type", "application/json")],
+            json.dumps({"me": args["me"]}).encode("utf-8"),
+        )
+
+
+def percentile(values, pct):
+    "Nearest-rank percentile of a list of numbers"
+    if not values:
+        return None
+    values = sorted(values)
+    rank = math.ceil(pct / 100.0 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+async def simulate_login(browser, provider, n):
+    "Runs a single sign-in, returns True if it resulted in a ds_actor cookie"
+    response = await browser.get("http://localhost/-/indieauth")
+    csrftoken = response.cookies["ds_csrftoken"]
+    response = await browser.post(
+        "http://localhost/-/indieauth",
+        data={"csrftoken": csrftoken, "me": provider.profile_url(n)},
+    )
+    if response.status_code != 302:
+        return False
+    # The browser visits the authorization server, which redirects back
+    response = await browser.get(
+        response.headers["location"], headers={BROWSER_HEADER: "1"}
+    )
+    response = await browser.get(response.headers["location"])
+    return response.status_code == 302 and "ds_actor" in response.cookies
+
+
+async def run_load_test(
+    users=100,
+    concurrency=50,
+    latency=0.0,
+    body_size=0,
+    redirects=0,
+    failure_rate=0.0,
+    seed=None,
+    datasette=None,
+):
+    """
+    Drive ``users`` simulated sign-ins through an in-process Datasette, at most
+    ``concurrency`` at a time. Returns a dictionary of results.
+    """
+    from datasette.app import Datasette
+    from .discovery import _clients
+
+    provider = MockProvider(
+        latency=latency,
+        body_size=body_size,
+        redirects=redirects,
+        failure_rate=failure_rate,
+    )
+    if seed is not None:
+        provider.seed(seed)
+    if datasette is None:
+        datasette = Datasette([], memory=True)
+    await datasette.invoke_startup()
+    transport = httpx.ASGITransport(app=provider)
+    _clients[datasette] = httpx.AsyncClient(transport=transport, max_redirects=5)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    durations = []
+    failures = 0
+
+    app_transport = httpx.ASGITransport(app=datasette.app())
+
+    async def one_user(n):
+        nonlocal failures
+        # Each user gets their own cookie jar, like a real browser
+        mounts = {"http://localhost": app_transport}
+        async with semaphore:
+            async with httpx.AsyncClient(transport=transport, mounts=mounts) as browser:
+                start = time.perf_counter()
+                try:
+                    ok = await simulate_login(browser, provider, n)
+                except httpx.HTTPError:
+                    ok = False
+            if ok:
+                durations.append(time.perf_counter() - start)
+            else:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_user(n) for n in range(users)))
+    elapsed = time.perf_counter() - start
+
+    await _clients.pop(datasette).aclose()
+    outbound = sum(provider.outbound.values())
+    return {
+        "users": users,
+        "concurrency": concurrency,
+        "successes": len(durations),
+        "failures": failures,
+        "elapsed": elapsed,
+        "logins_per_second": users / elapsed if elapsed else None,
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "p99": percentile(durations, 99),
+        "outbound_requests": outbound,
+        "outbound_requests_per_login": outbound / users if users else None,
+        "outbound_by_kind": {
+            "{} {}".format(method, kind): count
+            for (method, kind), count in sorted(provider.outbound.items())
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test the datasette-indieauth sign-in flow"
+    )
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added per mock response"
+    )
+    parser.add_argument(
+        "--body-size", type=int, default=0, help="Size of profile pages in bytes"
+    )
+    parser.add_argument(
+        "--redirects", type=int, default=0, help="301 redirects before each profile"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="Fraction of 500 responses"
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    results = asyncio.run(
+        run_load_test(
+            users=args.users,
+            concurrency=args.concurrency,
+            latency=args.latency,
+            body_size=args.body_size,
+            redirects=args.redirects,
+            failure_rate=args.failure_rate,
+            seed=args.seed,
+        )
+    )
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
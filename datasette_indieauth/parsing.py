@@ -0,0 +1,170 @@
+"""
+HTML parsers for profile pages. Imported on first use, so that html.parser
+is not loaded until someone signs in.
+"""
+
+from html.parser import HTMLParser
+import httpx
+from urllib.parse import urlparse
+
+
+class LinkRelParser(HTMLParser):
+    "Collects the attributes of <link rel> elements and of <a rel=me> links"
+
+    def __init__(self):
+        super().__init__()
+        self.link_rels = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "link" and "rel" in attrs:
+            self.link_rels.append(attrs)
+        elif tag == "a" and "me" in (attrs.get("rel") or "").lower().split():
+            # RelMeAuth accepts rel="me" on visible links too
+            self.link_rels.append(attrs)
+
+
+def parse_link_rels(html):
+    parser = LinkRelParser()
+    parser.feed(html)
+    return parser.link_rels
+
+
+# Elements that never have an end tag
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+HCARD_MAX_NAME = 200
+HCARD_MAX_URL = 2048
+
+
+class ProfilePageParser(LinkRelParser):
+    """
+    Collects link rels and the name, photo and url of each top-level h-card.
+
+    This covers the parts of the microformats2 parsing rules needed for a
+    profile: explicit p-name, u-photo and u-url properties, plus an implied
+    name from the h-card's text.
+    """
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+        self.hcards = []
+        # (tag, h-card started by this element or None, text being collected)
+        self.stack = []
+
+    def current_hcard(self):
+        for tag, hcard, text in reversed(self.stack):
+            if hcard is not None:
+                return hcard
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        super().handle_starttag(tag, attrs)
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        parent = self.current_hcard()
+        started = None
+        text = None
+        if parent is None and "h-card" in classes:
+            started = {"properties": {}, "text": [], "has_p": False}
+            self.hcards.append(started)
+            if tag == "img":
+                started["properties"]["name"] = attrs.get("alt")
+                started["properties"]["photo"] = self.url(attrs.get("src"))
+        elif parent is not None and any(c.startswith("h-") for c in classes):
+            # Properties of nested microformats are not ours
+            started = {"properties": {}, "text": [], "has_p": True}
+        elif parent is not None:
+            properties = parent["properties"]
+            if any(c.startswith("p-") for c in classes):
+                parent["has_p"] = True
+            if "p-name" in classes:
+                if tag in ("img", "area"):
+                    properties.setdefault("name", attrs.get("alt"))
+                else:
+                    text = []
+            if "u-photo" in classes:
+                properties.setdefault(
+                    "photo", self.url(attrs.get("src") or attrs.get("href"))
+                )
+            if "u-url" in classes:
+                properties.setdefault("url", self.url(attrs.get("href")))
+        if tag not in VOID_ELEMENTS:
+            self.stack.append((tag, started, text))
+
+    def handle_endtag(self, tag):
+        if not any(frame[0] == tag for frame in self.stack):
+            return
+        # Pop to the matching element, closing any left open
+        while self.stack:
+            open_tag, hcard, text = self.stack.pop()
+            if text is not None:
+                parent = self.current_hcard()
+                parent["properties"].setdefault("name", " ".join("".join(text).split()))
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        for tag, hcard, text in self.stack:
+            if text is not None:
+                text.append(data)
+        hcard = self.current_hcard()
+        if hcard is not None:
+            hcard["text"].append(data)
+
+    def url(self, url):
+        if not url:
+            return None
+        try:
+            return str(httpx.URL(self.base_url).join(url.strip()))
+        except httpx.InvalidURL:
+            return None
+
+    def representative_hcard(self):
+        """
+        Returns {"name": ..., "photo": ..., "url": ...} for the h-card whose
+        url is the page URL, or the first h-card, leaving out missing values
+        """
+        cards = []
+        for hcard in self.hcards:
+            properties = dict(hcard["properties"])
+            if not properties.get("name") and not hcard["has_p"]:
+                properties["name"] = " ".join("".join(hcard["text"]).split())
+            cards.append(properties)
+        if not cards:
+            return {}
+        matching = [card for card in cards if card.get("url") == self.base_url]
+        card = (matching or cards)[0]
+        result = {}
+        if card.get("name"):
+            result["name"] = card["name"][:HCARD_MAX_NAME]
+        for key in ("photo", "url"):
+            value = card.get(key)
+            if (
+                value
+                and len(value) <= HCARD_MAX_URL
+                and urlparse(value).scheme in ("http", "https")
+            ):
+                result[key] = value
+        return result
+
+
+def parse_profile_page(html, base_url):
+    "Returns (link_rels, representative h-card dict)"
+    parser = ProfilePageParser(base_url)
+    parser.feed(html)
+    return parser.link_rels, parser.representative_hcard()
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+import time
+from urllib.parse import urlparse
+import weakref
+
+CONFIG_CHECK_INTERVAL = 1.0
+DECISION_CACHE_SIZE = 10000
+
+_plugin_configs = weakref.WeakKeyDictionary()
+_MISSING = object()
+
+
+class Rule:
+    def __init__(self, config):
+        actors = config.get("actors") or []
+        if isinstance(actors, str):
+            actors = actors.split()
+        self.any_actor = "*" in actors
+        self.actors = frozenset(actors)
+        domains = config.get("domains") or []
+        if isinstance(domains, str):
+            domains = domains.split()
+        self.domains = tuple(domain.lower() for domain in domains)
+        self.database = config.get("database")
+        self.resource = config.get("table") or config.get("query")
+        self.allow = bool(config.get("allow", True))
+
+    def matches_actor(self, me):
+        if self.any_actor or me in self.actors:
+            return True
+        if self.domains:
+            host = (urlparse(me).hostname or "").lower()
+            return any(
+                host == domain or host.endswith("." + domain) for domain in self.domains
+            )
+        return False
+
+    def matches_resource(self, resource):
+        if self.database is None:
+            return True
+        if isinstance(resource, str):
+            return resource == self.database and self.resource is None
+        if isinstance(resource, (tuple, list)):
+            return resource[0] == self.database and (
+                self.resource is None or resource[1] == self.resource
+            )
+        return False
+
+
+class PermissionRules:
+    """
+    Compiled version of the "permissions" plugin setting.
+
+    Decisions are memoized per (me, action, resource) in a bounded LRU, since
+    Datasette checks the same permissions many times per page.
+    """
+
+    def __init__(self, config, cache_size=DECISION_CACHE_SIZE):
+        self.by_action = {}
+        wildcard = []
+        for index, rule_config in enumerate(config or []):
+            rule = (index, Rule(rule_config))
+            actions = rule_config.get("actions") or []
+            if isinstance(actions, str):
+                actions = actions.split()
+            if "*" in actions:
+                wildcard.append(rule)
+            for action in actions:
+                if action != "*":
+                    self.by_action.setdefault(action, []).append(rule)
+        # Wildcard rules apply to every action, in their original order
+        self.wildcard = [rule for _, rule in wildcard]
+        for action, rules in self.by_action.items():
+            self.by_action[action] = [rule for _, rule in sorted(rules + wildcard)]
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._decisions = OrderedDict()
+
+    def decide(self, me, action, resource):
+        "Returns True, False or None if no rule applies"
+        if isinstance(resource, list):
+            resource = tuple(resource)
+        key = (me, action, resource)
+        decision = self._decisions.get(key, _MISSING)
+        if decision is not _MISSING:
+            self._decisions.move_to_end(key)
+            self.hits += 1
+            return decision
+        self.misses += 1
+        decision = None
+        for rule in self.by_action.get(action, self.wildcard):
+            if rule.matches_actor(me) and rule.matches_resource(resource):
+                decision = rule.allow
+                break
+        self._decisions[key] = decision
+        if len(self._decisions) > self.cache_size:
+            self._decisions.popitem(last=False)
+        return decision
+
+
+class PluginConfig:
+    """
+    The datasette-indieauth plugin configuration, re-read at most once
+    every check_interval seconds. The compiled permission rules and their
+    decision cache are replaced whenever the "permissions" setting changes.
+    """
+
+    def __init__(self, datasette, check_interval=CONFIG_CHECK_INTERVAL):
+        self.datasette = datasette
+        self.check_interval = check_interval
+        self.timer = time.monotonic
+        self.checked = None
+        self.config = {}
+        self.rules = PermissionRules([])
+        self._raw_rules = None
+
+    def refresh(self):
+        now = self.timer()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return self
+        self.checked = now
+        self.config = self.datasette.plugin_config("datasette-indieauth") or {}
+        raw_rules = self.config.get("permissions")
+        if raw_rules != self._raw_rules:
+            self.rules = PermissionRules(raw_rules)
+            self._raw_rules = raw_rules
+        return self
+
+
+def cached_plugin_config(datasette):
+    "Returns the PluginConfig for this Datasette instance, refreshed if needed"
+    config = _plugin_configs.get(datasette)
+    if config is None:
+        config = PluginConfig(datasette)
+        _plugin_configs[datasette] = config
+    return config.refresh()
@@ -0,0 +1,81 @@
+"""
+Tracks which authorization endpoints are used most, so the shared HTTP
+client can keep connections to them open ahead of the code exchange POST.
+"""
+
+import asyncio
+import httpx
+import weakref
+from .discovery import http_client
+
+HEAVY_HITTERS_CAPACITY = 64
+WARM_CONNECTIONS_INTERVAL = 30
+WARM_REQUEST_TIMEOUT = 5.0
+
+_popular_endpoints = weakref.WeakKeyDictionary()
+
+
+class HeavyHitters:
+    """
+    Approximate counts of the most frequently seen keys, using at most
+    ``capacity`` counters (the Space-Saving algorithm).
+
+    A key seen more than 1/capacity of the time is guaranteed to be
+    tracked. Counts may be overestimated by up to the smallest count.
+    """
+
+    def __init__(self, capacity=HEAVY_HITTERS_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, key):
+        if key in self.counts or len(self.counts) < self.capacity:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return
+        # Replace the least counted key, inheriting its count
+        smallest = min(self.counts, key=self.counts.get)
+        self.counts[key] = self.counts.pop(smallest) + 1
+
+    def top(self, n):
+        "Returns the n keys with the highest counts, highest first"
+        return sorted(self.counts, key=self.counts.get, reverse=True)[:n]
+
+
+def popular_endpoints(datasette):
+    "Returns the HeavyHitters of authorization endpoints used by indieauth_done"
+    hitters = _popular_endpoints.get(datasette)
+    if hitters is None:
+        hitters = HeavyHitters()
+        _popular_endpoints[datasette] = hitters
+    return hitters
+
+
+async def warm_connections(datasette, n):
+    """
+    Send a HEAD request to each of the n most popular authorization
+    endpoints, so the shared client has an open connection to each one.
+    """
+    client = http_client(datasette)
+    endpoints = popular_endpoints(datasette).top(n)
+
+    async def head(url):
+        try:
+            await client.head(url, timeout=WARM_REQUEST_TIMEOUT)
+        # InvalidURL, for a malformed href, is not an HTTPError
+        except (httpx.HTTPError, httpx.InvalidURL):
+            pass
+
+    await asyncio.gather(*(head(url) for url in endpoints))
+    return endpoints
+
+
+async def warm_periodically(datasette, n, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await warm_connections(datasette, n)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Warming is best effort, it must not stop for good on one error
+            pass
@@ -0,0 +1,85 @@
+"""
+RelMeAuth fallback for profile pages without an authorization_endpoint.
+
+The profile's rel="me" links are checked concurrently for one that links
+back to the profile and has an authorization_endpoint of its own. Signing
+in to that profile then proves control of the original one.
+"""
+
+import asyncio
+import httpx
+from .discovery import (
+    discover,
+    discovery_cache,
+    discovery_options,
+    rel_me_cache,
+)
+from .utils import DiscoverEndpointsError, discover_endpoints, same_profile
+
+# Most rel="me" links fetched at the same time for one sign-in
+REL_ME_FAN_OUT = 4
+
+
+async def rel_me_links(datasette, url):
+    "Returns the rel=me links of the profile page at url"
+    # Collected by the discovery that just found no authorization_endpoint
+    canonical_url = url
+    links = rel_me_cache(datasette).get(url)
+    if links is None:
+        canonical_url, _, _ = await discover(datasette, url)
+        links = rel_me_cache(datasette).get(canonical_url)
+    if links is None:
+        # Discovered before its rel=me links were collected, or they expired
+        discovery_cache(datasette).pop(url)
+        canonical_url, _, _ = await discover(datasette, url)
+        links = rel_me_cache(datasette).get(canonical_url)
+    return [link for link in links or [] if not same_profile(link, canonical_url)]
+
+
+async def check_provider(datasette, url, me):
+    """
+    Returns (canonical_url, authorization_endpoint) if the page at url links
+    back to me with rel=me and supports IndieAuth, otherwise None.
+    """
+    # Not discover(), so that cancelling this cancels the request
+    options = dict(discovery_options(datasette), rel_me=rel_me_cache(datasette))
+    options["hcards"] = None
+    try:
+        result = await discover_endpoints(url, **options)
+    except (httpx.HTTPError, DiscoverEndpointsError):
+        return None
+    canonical_url, authorization_endpoint, _ = result
+    if not authorization_endpoint:
+        return None
+    # Saves discovering it again when the sign-in completes
+    discovery_cache(datasette).set(url, result)
+    links = rel_me_cache(datasette).get(canonical_url) or []
+    if not any(same_profile(link, me) for link in links):
+        return None
+    return canonical_url, authorization_endpoint
+
+
+async def find_rel_me_provider(datasette, me, fan_out=REL_ME_FAN_OUT):
+    """
+    Returns (provider profile URL, authorization_endpoint) for the first of
+    me's rel=me links to verify, or None. Checks still running once one has
+    verified are cancelled.
+    """
+    links = await rel_me_links(datasette, me)
+    semaphore = asyncio.Semaphore(fan_out)
+
+    async def check(url):
+        async with semaphore:
+            return await check_provider(datasette, url, me)
+
+    tasks = [asyncio.ensure_future(check(url)) for url in links]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result is not None:
+                return result
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,134 @@
+from datasette.utils import escape_sqlite
+import sqlite3
+import time
+import weakref
+
+# A state is only accepted by /-/indieauth/done this long after it was issued
+STATE_MAX_AGE = 10 * 60
+REPLAY_GUARD_SLOTS = 10
+REPLAY_GUARD_TABLE = "indieauth_used_states"
+
+_replay_guards = weakref.WeakKeyDictionary()
+
+
+class ReplayGuard:
+    """
+    Remembers values that have been used for at least ``ttl`` seconds.
+
+    Values are stored in a time wheel of ``slots + 1`` sets, each covering
+    ttl / slots seconds. Inserts and lookups touch a fixed number of sets and
+    a set is cleared when the wheel comes back around to it, so memory is
+    bounded by the number of values used in the last ttl seconds.
+    """
+
+    def __init__(self, ttl=STATE_MAX_AGE, slots=REPLAY_GUARD_SLOTS, timer=time.time):
+        self.ttl = ttl
+        self.granularity = ttl / slots
+        self.timer = timer
+        self.wheel = [set() for _ in range(slots + 1)]
+        self.tick = None
+
+    def _advance(self):
+        tick = int(self.timer() // self.granularity)
+        if self.tick is not None:
+            # Clear every slot the wheel has moved past, at most once each
+            for passed in range(
+                self.tick + 1, min(tick, self.tick + len(self.wheel)) + 1
+            ):
+                self.wheel[passed % len(self.wheel)].clear()
+        if self.tick is None or tick > self.tick:
+            self.tick = tick
+
+    def consume(self, value):
+        "Returns True the first time value is seen, False if it has been used"
+        self._advance()
+        if any(value in slot for slot in self.wheel):
+            return False
+        self.wheel[self.tick % len(self.wheel)].add(value)
+        return True
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.wheel)
+
+
+class ReplayGuardError(Exception):
+    pass
+
+
+class DatabaseReplayGuard:
+    """
+    Records used values in a table, so every Datasette process using the
+    same database file rejects a value that any of them has already seen.
+    """
+
+    def __init__(
+        self, datasette, database, table=REPLAY_GUARD_TABLE, ttl=STATE_MAX_AGE
+    ):
+        self.datasette = datasette
+        self.database = database
+        self.table = table
+        self.ttl = ttl
+        self.purged = None
+        self._table_created = False
+
+    async def consume(self, value):
+        """
+        Returns True the first time value is seen, False if it has been used.
+
+        Raises ReplayGuardError if the database is missing or cannot be
+        written to.
+        """
+        try:
+            db = self.datasette.get_database(self.database)
+            return await db.execute_write_fn(lambda conn: self._consume(conn, value))
+        # Datasette asserts that the database is mutable before writing
+        except (KeyError, AssertionError, sqlite3.Error) as ex:
+            raise ReplayGuardError(
+                'replay_guard database "{}" could not be written to: {}'.format(
+                    self.database, ex.__class__.__name__
+                )
+            )
+
+    def _consume(self, conn, value):
+        table = escape_sqlite(self.table)
+        now = time.time()
+        with conn:
+            if not self._table_created:
+                conn.execute(
+                    "create table if not exists {} (value text primary key, expires real)".format(
+                        table
+                    )
+                )
+                self._table_created = True
+            if self.purged is None or now - self.purged > self.ttl / REPLAY_GUARD_SLOTS:
+                conn.execute("delete from {} where expires < ?".format(table), [now])
+                self.purged = now
+            try:
+                conn.execute(
+                    "insert into {} (value, expires) values (?, ?)".format(table),
+                    [value, now + self.ttl],
+                )
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+
+def replay_guards(datasette, plugin_config):
+    """
+    Returns (ReplayGuard, DatabaseReplayGuard or None) for this instance.
+
+    The database guard is only used if "replay_guard" is configured.
+    """
+    guards = _replay_guards.get(datasette)
+    if guards is None:
+        config = plugin_config.get("replay_guard") or {}
+        shared = None
+        if config.get("database"):
+            shared = DatabaseReplayGuard(
+                datasette,
+                config["database"],
+                table=config.get("table") or REPLAY_GUARD_TABLE,
+            )
+        guards = (ReplayGuard(), shared)
+        _replay_guards[datasette] = guards
+    return guards
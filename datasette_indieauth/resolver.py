@@ -0,0 +1,134 @@
+"""
+DNS resolution for the plugin's HTTP client. Hostnames are resolved once,
+cached, checked against private address ranges and connections are made
+to the checked address, so a hostname cannot be re-resolved to an internal
+address between the check and the connection.
+"""
+
+import asyncio
+import httpcore
+import httpx
+import ipaddress
+import socket
+from .cache import TTLCache
+
+DNS_CACHE_SIZE = 1000
+# getaddrinfo() does not report record TTLs, so every answer gets this one
+DNS_CACHE_TTL = 60
+
+
+class UnsafeAddressError(httpcore.ConnectError):
+    pass
+
+
+def is_public_address(address):
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class Resolver:
+    """
+    Resolves hostnames to public IP addresses, caching the results.
+
+    allow is True to accept any address, or a list of hostnames and
+    networks such as "10.0.0.0/8" that may resolve to non-public addresses.
+    """
+
+    def __init__(
+        self, maxsize=DNS_CACHE_SIZE, ttl=DNS_CACHE_TTL, getaddrinfo=None, allow=None
+    ):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._getaddrinfo = getaddrinfo
+        self.allow_all = allow is True
+        self.allowed_hosts = set()
+        self.allowed_networks = []
+        if not self.allow_all:
+            for entry in allow or ():
+                try:
+                    self.allowed_networks.append(
+                        ipaddress.ip_network(entry, strict=False)
+                    )
+                except ValueError:
+                    self.allowed_hosts.add(entry.lower())
+
+    def is_allowed(self, host, address):
+        if self.allow_all or host.lower() in self.allowed_hosts:
+            return True
+        ip = ipaddress.ip_address(address)
+        return is_public_address(address) or any(
+            ip in network for network in self.allowed_networks
+        )
+
+    async def getaddrinfo(self, host, port):
+        if self._getaddrinfo is not None:
+            return await self._getaddrinfo(host, port)
+        return await asyncio.get_event_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+
+    async def resolve(self, host, port):
+        "Returns a list of IP addresses, raises UnsafeAddressError for private ones"
+        key = (host, port)
+        addresses = self.cache.get(key)
+        if addresses is None:
+            try:
+                infos = await self.getaddrinfo(host, port)
+            except socket.gaierror as ex:
+                raise httpcore.ConnectError("Could not resolve {}: {}".format(host, ex))
+            addresses = []
+            for family, type_, proto, canonname, sockaddr in infos:
+                if sockaddr[0] not in addresses:
+                    addresses.append(sockaddr[0])
+            self.cache.set(key, addresses)
+        # Reject the host if any address is private, not just the first
+        for address in addresses:
+            if not self.is_allowed(host, address):
+                raise UnsafeAddressError(
+                    "{} resolves to a non-public address".format(host)
+                )
+        return addresses
+
+
+class PinnedNetworkBackend(httpcore.AsyncNetworkBackend):
+    "Connects to the addresses returned by a Resolver instead of the hostname"
+
+    def __init__(self, resolver, backend=None):
+        self.resolver = resolver
+        self.backend = backend or httpcore.AnyIOBackend()
+
+    async def connect_tcp(
+        self, host, port, timeout=None, local_address=None, socket_options=None
+    ):
+        addresses = await self.resolver.resolve(host, port)
+        error = httpcore.ConnectError("No addresses found for {}".format(host))
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(
+                    address,
+                    port,
+                    timeout=timeout,
+                    local_address=local_address,
+                    socket_options=socket_options,
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as ex:
+                error = ex
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(
+            path, timeout=timeout, socket_options=socket_options
+        )
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+class PinnedTransport(httpx.AsyncHTTPTransport):
+    "httpx transport that makes every connection through a PinnedNetworkBackend"
+
+    def __init__(self, resolver, **kwargs):
+        super().__init__(**kwargs)
+        # httpx does not accept a network backend, so give it to the pool
+        self._pool._network_backend = PinnedNetworkBackend(resolver)
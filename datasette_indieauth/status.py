@@ -0,0 +1,148 @@
+"""
+What the plugin is holding for one Datasette instance - caches, the shared
+HTTP client's connections, running discoveries and per-host statistics -
+for /-/indieauth/status, plus the actions that page offers to operators.
+"""
+
+import collections
+import time
+from .discovery import (
+    _clients,
+    _in_flight,
+    _resolvers,
+    discovery_cache,
+    hcard_cache,
+    host_tracker,
+    redirect_cache,
+    rel_me_cache,
+)
+from .utils import canonicalize_url, forget_cached_redirects
+
+STATUS_TOP_ENTRIES = 10
+
+
+def caches(datasette):
+    "Returns {name: TTLCache} of the caches an operator can inspect and flush"
+    named = {
+        "discovery": discovery_cache(datasette),
+        "redirects": redirect_cache(datasette),
+        "hcards": hcard_cache(datasette),
+        "rel_me": rel_me_cache(datasette),
+    }
+    # Only created once the shared client makes its first request
+    resolver = _resolvers.get(datasette)
+    if resolver is not None:
+        named["dns"] = resolver.cache
+    return named
+
+
+def cache_key(key):
+    if isinstance(key, tuple):
+        # The DNS cache is keyed by (host, port)
+        return ":".join(str(part) for part in key)
+    return str(key)
+
+
+def cache_status(cache, top=STATUS_TOP_ENTRIES, now=None):
+    now = time.time() if now is None else now
+    lookups = cache.hits + cache.misses
+    entries = list(cache.items())
+    return {
+        "size": len(entries),
+        "maxsize": cache.maxsize,
+        "ttl": cache.ttl,
+        "hits": cache.hits,
+        "misses": cache.misses,
+        "hit_rate": round(cache.hits / lookups, 3) if lookups else None,
+        # Most recently used first
+        "top": [
+            {
+                "key": cache_key(key),
+                "expires_in": None if expires is None else round(expires - now, 1),
+            }
+            for key, value, expires in reversed(entries[-top:])
+        ],
+    }
+
+
+def pool_status(client):
+    "Connections held by the client's pool, per origin"
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    if pool is None:
+        return None
+    hosts = collections.defaultdict(lambda: {"connections": 0, "idle": 0})
+    for connection in pool.connections:
+        origin = str(getattr(connection, "_origin", "unknown"))
+        hosts[origin]["connections"] += 1
+        if connection.is_idle():
+            hosts[origin]["idle"] += 1
+    return {
+        "connections": len(pool.connections),
+        "max_connections": getattr(pool, "_max_connections", None),
+        "queued_requests": len(getattr(pool, "_requests", [])),
+        "hosts": dict(sorted(hosts.items())),
+    }
+
+
+def hosts_status(datasette, top=STATUS_TOP_ENTRIES * 5):
+    tracker = host_tracker(datasette)
+    hosts = {}
+    for host, stats in tracker.items():
+        if len(hosts) >= top:
+            break
+        hosts[host] = {
+            "samples": stats.samples,
+            "latency_ms": round(stats.latency * 1000, 1),
+            "p95_ms": round(stats.p95() * 1000, 1),
+            "error_rate": round(stats.error_rate, 3),
+            "timeout": round(stats.timeout(tracker.min_timeout), 2),
+        }
+    return hosts
+
+
+def status(datasette):
+    client = _clients.get(datasette)
+    in_flight = _in_flight.get(datasette) or {}
+    return {
+        "caches": {
+            name: cache_status(cache) for name, cache in caches(datasette).items()
+        },
+        "pool": None if client is None else pool_status(client),
+        "in_flight_discoveries": {
+            "count": len(in_flight),
+            "urls": sorted(in_flight)[:STATUS_TOP_ENTRIES],
+        },
+        "hosts": hosts_status(datasette),
+    }
+
+
+def invalidate_url(datasette, url):
+    "Forget everything cached about a profile URL, returns the caches it was in"
+    url = canonicalize_url(url)
+    named = caches(datasette)
+    cleared = []
+    discovered = named["discovery"].pop(url)
+    if discovered is not None:
+        cleared.append("discovery")
+    # Redirects and parsed pages are keyed by the canonical URL too
+    urls = {url}
+    if discovered is not None:
+        urls.add(discovered[0])
+    if any(u in named["redirects"] for u in urls):
+        cleared.append("redirects")
+    for u in urls:
+        forget_cached_redirects(u, named["redirects"])
+    for name in ("hcards", "rel_me"):
+        popped = [named[name].pop(u) for u in urls]
+        if any(value is not None for value in popped):
+            cleared.append(name)
+    return cleared
+
+
+def flush_cache(datasette, name):
+    "Empty the named cache, returns False if there is no such cache"
+    cache = caches(datasette).get(name)
+    if cache is None:
+        return False
+    cache.clear()
+    return True
@@ -0,0 +1,102 @@
+"""
+Benchmark of the state and ds_indieauth cookie encodings:
+
+    python -m datasette_indieauth.tokenbench --iterations 20000
+
+Compares the compact encoding in tokens.py with the JSON format signed by
+datasette.sign() that it replaced, reporting payload sizes and how many
+values per second each can sign and unsign.
+"""
+
+import argparse
+import json
+import secrets
+import time
+
+from .tokens import sign_cookie, sign_state, unsign_cookie, unsign_state
+from .utils import challenge_verifier_pair
+
+STATE_NAMESPACE = "datasette-indieauth-state"
+COOKIE_NAMESPACE = "datasette-indieauth-cookie"
+
+
+def per_second(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed if elapsed else None
+
+
+def benchmark_tokens(
+    iterations=10000,
+    me="https://indieauth.simonwillison.net/index.php/author/simonw/",
+    authorization_endpoint="https://indieauth.simonwillison.net/auth",
+    datasette=None,
+):
+    "Returns sizes and sign/unsign rates for the legacy and compact encodings"
+    from datasette.app import Datasette
+
+    if datasette is None:
+        datasette = Datasette([], memory=True)
+    state_bits = {
+        "a": authorization_endpoint,
+        "n": secrets.token_hex(8),
+        "t": int(time.time()),
+    }
+    _, verifier = challenge_verifier_pair()
+    cookie_bits = {"v": verifier, "m": me}
+
+    encodings = {
+        "legacy": {
+            "state": (
+                lambda: datasette.sign(state_bits, STATE_NAMESPACE),
+                lambda token: datasette.unsign(token, STATE_NAMESPACE),
+            ),
+            "cookie": (
+                lambda: datasette.sign(cookie_bits, COOKIE_NAMESPACE),
+                lambda token: datasette.unsign(token, COOKIE_NAMESPACE),
+            ),
+        },
+        "compact": {
+            "state": (
+                lambda: sign_state(datasette, state_bits, STATE_NAMESPACE),
+                lambda token: unsign_state(datasette, token, STATE_NAMESPACE),
+            ),
+            "cookie": (
+                lambda: sign_cookie(datasette, verifier, me, COOKIE_NAMESPACE),
+                lambda token: unsign_cookie(datasette, token, COOKIE_NAMESPACE),
+            ),
+        },
+    }
+    results = {"iterations": iterations}
+    for encoding, kinds in encodings.items():
+        results[encoding] = {}
+        for kind, (sign, unsign) in kinds.items():
+            token = sign()
+            results[encoding][kind] = {
+                "bytes": len(token),
+                "signs_per_second": per_second(sign, iterations),
+                "unsigns_per_second": per_second(lambda: unsign(token), iterations),
+            }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the datasette-indieauth state and cookie encodings"
+    )
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--me", help="Profile URL signed into the cookie")
+    parser.add_argument("--authorization-endpoint", help="URL signed into the state")
+    args = parser.parse_args(argv)
+    kwargs = {}
+    if args.me:
+        kwargs["me"] = args.me
+    if args.authorization_endpoint:
+        kwargs["authorization_endpoint"] = args.authorization_endpoint
+    print(json.dumps(benchmark_tokens(args.iterations, **kwargs), indent=4))
+
+
+if __name__ == "__main__":
+    main()
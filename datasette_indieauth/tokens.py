@@ -0,0 +1,177 @@
+"""
+Compact signed encodings of the sign-in state and the ds_indieauth cookie.
+
+Both are small versioned binary payloads followed by a truncated
+HMAC-SHA256 signature, base64url encoded as a single string. The state
+refers to the authorization endpoint by a short ID from an EndpointRegistry
+rather than carrying the whole URL.
+
+Values signed in the older format, JSON signed by datasette.sign(), are
+still accepted.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import itsdangerous
+import struct
+import weakref
+from .cache import TTLCache
+
+TOKEN_VERSION = 1
+SIGNATURE_BYTES = 16
+ENDPOINT_ID_BYTES = 8
+ENDPOINT_REGISTRY_SIZE = 1000
+
+# version, nonce, issued at, endpoint ID
+STATE_FORMAT = struct.Struct(">B8sI{}s".format(ENDPOINT_ID_BYTES))
+# version, verifier length - followed by the verifier, the me URL and, for
+# RelMeAuth, a NUL then the provider profile URL (URLs never contain NUL)
+COOKIE_FORMAT = struct.Struct(">BB")
+
+_keys = weakref.WeakKeyDictionary()
+_endpoint_registries = weakref.WeakKeyDictionary()
+
+
+def endpoint_id(url):
+    return hashlib.sha256(url.encode("utf-8")).digest()[:ENDPOINT_ID_BYTES]
+
+
+class EndpointRegistry:
+    """
+    Authorization endpoints this instance has signed into a state, by ID.
+
+    IDs are derived from the URL, so every process agrees on them. A process
+    that does not know an ID can discover the endpoint again and check it
+    against the ID with matches().
+    """
+
+    def __init__(self, maxsize=ENDPOINT_REGISTRY_SIZE):
+        self.endpoints = TTLCache(maxsize=maxsize)
+
+    def register(self, url):
+        id = endpoint_id(url)
+        self.endpoints.set(id, url)
+        return id
+
+    def lookup(self, id):
+        return self.endpoints.get(id)
+
+    def matches(self, id, url):
+        if not hmac.compare_digest(endpoint_id(url), id):
+            return False
+        self.endpoints.set(id, url)
+        return True
+
+
+def endpoint_registry(datasette):
+    registry = _endpoint_registries.get(datasette)
+    if registry is None:
+        registry = EndpointRegistry()
+        _endpoint_registries[datasette] = registry
+    return registry
+
+
+def _key(datasette, namespace):
+    keys = _keys.get(datasette)
+    if keys is None:
+        keys = _keys[datasette] = {}
+    key = keys.get(namespace)
+    if key is None:
+        secret = datasette._secret
+        if isinstance(secret, str):
+            secret = secret.encode("utf-8")
+        key = hmac.new(
+            secret, b"datasette-indieauth:" + namespace.encode("utf-8"), hashlib.sha256
+        ).digest()
+        keys[namespace] = key
+    return key
+
+
+def sign_bytes(datasette, payload, namespace):
+    signature = hmac.new(_key(datasette, namespace), payload, hashlib.sha256)
+    token = base64.urlsafe_b64encode(payload + signature.digest()[:SIGNATURE_BYTES])
+    return token.decode("ascii").rstrip("=")
+
+
+def unsign_bytes(datasette, token, namespace):
+    "Returns the payload from sign_bytes(), raises itsdangerous.BadSignature"
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        raise itsdangerous.BadSignature("Invalid token")
+    payload, signature = raw[:-SIGNATURE_BYTES], raw[-SIGNATURE_BYTES:]
+    expected = hmac.new(_key(datasette, namespace), payload, hashlib.sha256)
+    if not payload or not hmac.compare_digest(
+        expected.digest()[:SIGNATURE_BYTES], signature
+    ):
+        raise itsdangerous.BadSignature("Signature does not match")
+    if payload[0] != TOKEN_VERSION:
+        raise itsdangerous.BadSignature("Unknown token version")
+    return payload
+
+
+def sign_state(datasette, state_bits, namespace):
+    "Signs the state dictionary from build_authorization_url()"
+    id = endpoint_registry(datasette).register(state_bits["a"])
+    payload = STATE_FORMAT.pack(
+        TOKEN_VERSION, bytes.fromhex(state_bits["n"]), state_bits["t"], id
+    )
+    return sign_bytes(datasette, payload, namespace)
+
+
+def unsign_state(datasette, token, namespace):
+    """
+    Returns {"a", "i", "n", "t"} where "i" is the endpoint ID - "a" is None if
+    this process does not know the ID. Raises itsdangerous.BadSignature.
+    """
+    if token.startswith(".") or token.startswith("eyJ"):
+        # The old format: optionally compressed base64 JSON
+        state_bits = datasette.unsign(token, namespace)
+        return dict(state_bits, i=None) if isinstance(state_bits, dict) else {}
+    payload = unsign_bytes(datasette, token, namespace)
+    if len(payload) != STATE_FORMAT.size:
+        raise itsdangerous.BadSignature("Invalid state")
+    _, nonce, issued, id = STATE_FORMAT.unpack(payload)
+    return {
+        "a": endpoint_registry(datasette).lookup(id),
+        "i": id,
+        "n": nonce.hex(),
+        "t": issued,
+    }
+
+
+def sign_cookie(datasette, verifier, me, namespace, provider=None):
+    raw_verifier = bytes.fromhex(verifier)
+    payload = (
+        COOKIE_FORMAT.pack(TOKEN_VERSION, len(raw_verifier))
+        + raw_verifier
+        + me.encode("utf-8")
+    )
+    if provider:
+        payload += b"\0" + provider.encode("utf-8")
+    return sign_bytes(datasette, payload, namespace)
+
+
+def unsign_cookie(datasette, token, namespace):
+    """
+    Returns {"v": verifier, "m": me} plus "p" for the RelMeAuth provider, if
+    there is one. Raises itsdangerous.BadSignature.
+    """
+    if token.startswith(".") or token.startswith("eyJ"):
+        cookie_bits = datasette.unsign(token, namespace)
+        return cookie_bits if isinstance(cookie_bits, dict) else {}
+    payload = unsign_bytes(datasette, token, namespace)
+    if len(payload) < COOKIE_FORMAT.size:
+        raise itsdangerous.BadSignature("Invalid cookie")
+    _, length = COOKIE_FORMAT.unpack_from(payload)
+    start = COOKIE_FORMAT.size
+    try:
+        urls = [url.decode("utf-8") for url in payload[start + length :].split(b"\0")]
+    except UnicodeDecodeError:
+        raise itsdangerous.BadSignature("Invalid cookie")
+    cookie_bits = {"v": payload[start : start + length].hex(), "m": urls[0]}
+    if len(urls) > 1:
+        cookie_bits["p"] = urls[1]
+    return cookie_bits
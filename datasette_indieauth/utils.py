@@ -1,10 +1,32 @@
+import asyncio
 import base64
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import hashlib
-from html.parser import HTMLParser
 import httpx
 import ipaddress
 from urllib.parse import urlencode, urlparse, urlsplit, urlunsplit
 import secrets
+import time
+import zlib
+
+# Caps on reading a profile page during discovery. Peak memory for one
+# in-flight discovery is roughly max_decompressed_bytes for the body plus
+# the decoded str - up to 4 bytes per character - and the parsed link rels.
+ResponseLimits = namedtuple(
+    "ResponseLimits",
+    ("max_compressed_bytes", "max_decompressed_bytes", "max_read_seconds"),
+    defaults=(1024 * 1024, 2 * 1024 * 1024, 10.0),
+)
+DEFAULT_LIMITS = ResponseLimits()
+# We decompress bodies ourselves so only offer encodings zlib can bound
+ACCEPT_ENCODING = "gzip, deflate"
+# Pages longer than this many characters are parsed by a ParsePool thread
+PARSE_INLINE_MAX = 64 * 1024
+PARSE_WORKERS = 2
+# Most rel="me" links collected from one profile page
+REL_ME_MAX_LINKS = 10
 
 
 def verify_profile_url(url):
@@ -89,21 +111,43 @@ def canonicalize_url(url):
     return urlunsplit((scheme, netloc, path, query, fragment))
 
 
-class LinkRelParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.link_rels = []
+def parse_link_rels(html):
+    from .parsing import parse_link_rels
+
+    return parse_link_rels(html)
 
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-        if tag == "link" and "rel" in attrs:
-            self.link_rels.append(attrs)
 
+def parse_profile_page(html, base_url):
+    "Returns (link_rels, representative h-card dict)"
+    from .parsing import parse_profile_page
 
-def parse_link_rels(html):
-    parser = LinkRelParser()
-    parser.feed(html)
-    return parser.link_rels
+    return parse_profile_page(html, base_url)
+
+
+class ParsePool:
+    """
+    Runs parse functions in a pool of threads for pages longer than
+    inline_max characters, so large pages do not block the event loop.
+    Shorter pages are parsed inline, where a thread handoff would cost more
+    than the parse.
+    """
+
+    def __init__(self, max_workers=PARSE_WORKERS, inline_max=PARSE_INLINE_MAX):
+        self.inline_max = inline_max
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="datasette-indieauth-parse"
+        )
+
+    async def parse(self, fn, html):
+        if len(html) <= self.inline_max:
+            return fn(html)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn, html)
+
+    async def parse_link_rels(self, html):
+        return await self.parse(parse_link_rels, html)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
 
 
 def resolve_permanent_redirects(start_url, responses):
@@ -124,21 +168,261 @@ class DiscoverEndpointsError(Exception):
     pass
 
 
-async def discover_endpoints(url):
-    "Returns canonical_url, authorization_endpoint, token_endpoint"
+class ResponseTooLargeError(DiscoverEndpointsError):
+    pass
+
+
+def remember_permanent_redirects(start_url, responses, redirect_cache):
+    "Record each 301/308 hop at the start of a redirect chain in redirect_cache"
+    url = httpx.URL(start_url)
+    for response in responses:
+        if response.status_code not in (301, 308):
+            break
+        location = url.join(response.headers["location"])
+        redirect_cache.set(str(url), str(location))
+        url = location
+
+
+def follow_cached_redirects(url, redirect_cache, max_hops=10):
+    "Returns the URL reached by following cached permanent redirects from url"
+    seen = {url}
+    for _ in range(max_hops):
+        next_url = redirect_cache.get(url)
+        if next_url is None or next_url in seen:
+            break
+        seen.add(next_url)
+        url = next_url
+    return url
+
+
+def forget_cached_redirects(url, redirect_cache, max_hops=10):
+    for _ in range(max_hops):
+        url = redirect_cache.pop(url)
+        if url is None:
+            break
+
+
+def build_discovery_request(client, url, timeout=None):
+    kwargs = {} if timeout is None else {"timeout": timeout}
+    return client.build_request(
+        "GET", url, headers={"accept-encoding": ACCEPT_ENCODING}, **kwargs
+    )
+
+
+async def send_hedged(client, build_request, delay):
+    """
+    Send build_request() and, if no response has arrived after delay
+    seconds, a second copy of it. Returns whichever response arrives first.
+
+    Only use this for idempotent requests.
+    """
+    tasks = [asyncio.ensure_future(client.send(build_request(), stream=True))]
+    winner = None
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            winner = tasks[0]
+            return winner.result()
+        tasks.append(asyncio.ensure_future(client.send(build_request(), stream=True)))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    return task.result()
+        # Every attempt failed, raise the error from the first one
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif task is not winner and not task.cancelled():
+                if task.exception() is None:
+                    await task.result().aclose()
+
+
+async def get_following_redirects(client, url, hosts=None, hedge=False):
+    """
+    GET url following redirects, without reading the body of any response.
+
+    Returns the final response, still open for streaming, with .history set.
+
+    If hosts is a HostTracker each request uses that host's timeout and
+    its latency is recorded. If hedge is true slow hosts are sent a second
+    request after their 95th percentile latency.
+    """
+    history = []
+    while True:
+        host = httpx.URL(url).host
+        timeout = hedge_delay = None
+        if hosts is not None:
+            timeout = hosts.timeout(host)
+            if hedge:
+                hedge_delay = hosts.hedge_delay(host)
+        start = time.perf_counter()
+        try:
+            if hedge_delay is not None:
+                response = await send_hedged(
+                    client,
+                    lambda: build_discovery_request(client, url, timeout),
+                    hedge_delay,
+                )
+            else:
+                response = await client.send(
+                    build_discovery_request(client, url, timeout), stream=True
+                )
+        except httpx.RequestError:
+            if hosts is not None:
+                hosts.record(host, time.perf_counter() - start, error=True)
+            raise
+        if hosts is not None:
+            hosts.record(
+                host, time.perf_counter() - start, error=response.status_code >= 500
+            )
+        if not response.has_redirect_location:
+            response.history = history
+            return response
+        await response.aclose()
+        history.append(response)
+        if len(history) > client.max_redirects:
+            raise DiscoverEndpointsError("Exceeded maximum allowed redirects.")
+        url = response.url.join(response.headers["location"])
+
+
+async def read_limited_body(response, limits=DEFAULT_LIMITS):
+    "Read and decompress a streamed response body, enforcing limits"
+    content_length = response.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > limits.max_compressed_bytes:
+        raise ResponseTooLargeError(
+            "Content-Length of {} exceeds {} bytes".format(
+                content_length, limits.max_compressed_bytes
+            )
+        )
+    encoding = response.headers.get("content-encoding", "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    elif encoding == "deflate":
+        decompressor = zlib.decompressobj()
+    elif encoding in ("identity", ""):
+        decompressor = None
+    else:
+        raise DiscoverEndpointsError(
+            "Unsupported content-encoding: {}".format(encoding)
+        )
+    chunks = []
+    size = 0
+    async for raw in response.aiter_raw():
+        if response.num_bytes_downloaded > limits.max_compressed_bytes:
+            raise ResponseTooLargeError(
+                "Response exceeded {} bytes".format(limits.max_compressed_bytes)
+            )
+        if decompressor is None:
+            data = raw
+        else:
+            remaining = limits.max_decompressed_bytes - size
+            try:
+                # Never inflate more than one byte beyond the limit
+                data = decompressor.decompress(raw, remaining + 1)
+            except zlib.error as e:
+                raise DiscoverEndpointsError(
+                    "Could not decompress response: {}".format(e)
+                )
+        size += len(data)
+        if size > limits.max_decompressed_bytes:
+            raise ResponseTooLargeError(
+                "Decompressed response exceeded {} bytes".format(
+                    limits.max_decompressed_bytes
+                )
+            )
+        chunks.append(data)
+    return b"".join(chunks)
+
+
+def decode_body(response, body):
+    try:
+        return body.decode(response.charset_encoding or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+async def discover_endpoints(
+    url,
+    client=None,
+    redirect_cache=None,
+    limits=DEFAULT_LIMITS,
+    hosts=None,
+    hedge=False,
+    parse_pool=None,
+    hcards=None,
+    rel_me=None,
+):
+    """
+    Returns canonical_url, authorization_endpoint, token_endpoint
+
+    If a redirect_cache is provided, permanent redirects seen previously
+    are followed without making a request for each hop. hosts and hedge
+    are passed to get_following_redirects(). If a ParsePool is provided
+    large pages are parsed using it.
+
+    If an hcards cache is provided and does not yet have an entry for the
+    canonical URL, the page's h-card is parsed from the same response and
+    stored in it. A rel_me cache is filled in the same way with the page's
+    rel="me" links.
+
+    Raises ResponseTooLargeError if the profile page exceeds the limits.
+    """
+    if client is None:
+        async with httpx.AsyncClient(max_redirects=5) as client:
+            return await discover_endpoints(
+                url,
+                client=client,
+                redirect_cache=redirect_cache,
+                limits=limits,
+                hosts=hosts,
+                hedge=hedge,
+                parse_pool=parse_pool,
+                hcards=hcards,
+                rel_me=rel_me,
+            )
     authorization_endpoint = None
     token_endpoint = None
-    canonical_url = None
-    chunk = None
-    async with httpx.AsyncClient(max_redirects=5) as client:
-        try:
-            response = await client.get(url, follow_redirects=True)
-        except httpx.TooManyRedirects as e:
-            raise DiscoverEndpointsError(e)
+    fetch_url = url
+    if redirect_cache is not None:
+        fetch_url = follow_cached_redirects(url, redirect_cache)
+    try:
+        response = await get_following_redirects(
+            client, fetch_url, hosts=hosts, hedge=hedge
+        )
+    except httpx.RequestError:
+        if fetch_url == url:
+            raise
+        response = None
+    if fetch_url != url and (response is None or response.status_code >= 400):
+        # The cached redirect may be stale - try again from the original URL
+        if response is not None:
+            await response.aclose()
+        forget_cached_redirects(url, redirect_cache)
+        return await discover_endpoints(
+            url,
+            client=client,
+            redirect_cache=redirect_cache,
+            limits=limits,
+            hosts=hosts,
+            hedge=hedge,
+            parse_pool=parse_pool,
+            hcards=hcards,
+            rel_me=rel_me,
+        )
+    try:
+        if redirect_cache is not None:
+            remember_permanent_redirects(fetch_url, response.history, redirect_cache)
         # The canonical_url is found by following 301/308 redirects as far
         # as possible. The authorization_endpoint may be found using content
         # from a URL that follows additional 302/303/307 redirects.
-        canonical_url = resolve_permanent_redirects(response.url, response.history)
+        canonical_url = resolve_permanent_redirects(fetch_url, response.history)
 
         # Check response.links for Link: headers first
         if "authorization_endpoint" in response.links and response.links[
@@ -149,10 +433,43 @@ async def discover_endpoints(url):
             "url"
         ):
             token_endpoint = response.links["token_endpoint"]["url"]
-        if authorization_endpoint and token_endpoint:
+        want_hcard = hcards is not None and canonical_url not in hcards
+        want_rel_me = rel_me is not None and canonical_url not in rel_me
+        if (
+            authorization_endpoint
+            and token_endpoint
+            and not want_hcard
+            and not want_rel_me
+        ):
             return canonical_url, authorization_endpoint, token_endpoint
-        chunk = response.text
-    rels = parse_link_rels(chunk)
+        try:
+            body = await asyncio.wait_for(
+                read_limited_body(response, limits), limits.max_read_seconds
+            )
+        except asyncio.TimeoutError:
+            raise DiscoverEndpointsError(
+                "Timed out after {}s reading {}".format(
+                    limits.max_read_seconds, response.url
+                )
+            )
+    finally:
+        await response.aclose()
+    html = decode_body(response, body)
+    if want_hcard:
+        parse = functools.partial(parse_profile_page, base_url=str(response.url))
+    else:
+        parse = parse_link_rels
+    if parse_pool is not None:
+        parsed = await parse_pool.parse(parse, html)
+    else:
+        parsed = parse(html)
+    if want_hcard:
+        rels, hcard = parsed
+        hcards.set(canonical_url, hcard)
+    else:
+        rels = parsed
+    if want_rel_me:
+        rel_me.set(canonical_url, rel_me_urls(rels, str(response.url)))
     if authorization_endpoint is None:
         matches = [r["href"] for r in rels if r["rel"] == "authorization_endpoint"]
         if matches:
@@ -164,6 +481,29 @@ async def discover_endpoints(url):
     return canonical_url, authorization_endpoint, token_endpoint
 
 
+def rel_me_urls(rels, base_url):
+    "Returns the absolute http(s) URLs of the rel=me links in rels"
+    urls = []
+    for rel in rels:
+        if "me" not in (rel.get("rel") or "").lower().split() or not rel.get("href"):
+            continue
+        try:
+            url = str(httpx.URL(base_url).join(rel["href"].strip()))
+        except httpx.InvalidURL:
+            continue
+        if urlparse(url).scheme in ("http", "https") and url not in urls:
+            urls.append(url)
+    return urls[:REL_ME_MAX_LINKS]
+
+
+def same_profile(url, other_url):
+    "Do two profile URLs match, ignoring http/https and a missing trailing /"
+    return (
+        canonicalize_url(url).split("://", 1)[1]
+        == canonicalize_url(other_url).split("://", 1)[1]
+    )
+
+
 def display_url(url):
     # Strips http:// or https:// and path if path == "/"
     url = canonicalize_url(url)
@@ -205,9 +545,12 @@ def build_authorization_url(
 ):
     "Returns (URL, state, verifier)"
     challenge, verifier = challenge_verifier_pair(verifier_length)
+    # n makes every state unique so it can only be used once, t is when it was issued
     state = signing_function(
         {
             "a": authorization_endpoint,
+            "n": secrets.token_hex(8),
+            "t": int(time.time()),
         }
     )
     args = {
@@ -225,6 +568,26 @@ def build_authorization_url(
     return url, state, verifier
 
 
+class TokenBucket:
+    "Allows bursts of up to burst events, refilling at rate per second"
+
+    def __init__(self, rate, burst, timer=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.timer = timer
+        self.tokens = burst
+        self.updated = timer()
+
+    def consume(self):
+        now = self.timer()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
 def verify_same_domain(url, other_url):
     url_bits = urlparse(url)
     other_url_bits = urlparse(other_url)
@@ -0,0 +1,54 @@
+from datasette.app import Datasette
+import pytest
+import urllib
+
+
+@pytest.fixture
+def non_mocked_hosts():
+    # Requests to Datasette itself through ds.client are not mocked
+    return ["localhost"]
+
+
+@pytest.fixture
+def make_datasette():
+    "Returns a function that builds a Datasette with these plugin settings"
+
+    def make(**plugin_config):
+        return Datasette(
+            [],
+            memory=True,
+            metadata={"plugins": {"datasette-indieauth": plugin_config}},
+        )
+
+    return make
+
+
+@pytest.fixture
+def start_sign_in():
+    "Returns a function that submits the sign-in form, returning the response"
+
+    async def start(ds, me):
+        csrftoken = (await ds.client.get("/-/indieauth")).cookies["ds_csrftoken"]
+        return await ds.client.post(
+            "/-/indieauth",
+            data={"csrftoken": csrftoken, "me": me},
+            cookies={"ds_csrftoken": csrftoken},
+        )
+
+    return start
+
+
+@pytest.fixture
+def finish_sign_in():
+    "Returns a function that calls /-/indieauth/done for a started sign-in"
+
+    async def finish(ds, post_response, code="123"):
+        query = post_response.headers["location"].split("?", 1)[1]
+        state = dict(urllib.parse.parse_qsl(query))["state"]
+        return await ds.client.get(
+            "/-/indieauth/done",
+            params={"state": state, "code": code},
+            cookies={"ds_indieauth": post_response.cookies["ds_indieauth"]},
+        )
+
+    return finish
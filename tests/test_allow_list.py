@@ -0,0 +1,112 @@
+from datasette.app import Datasette
+from datasette.database import Database
+from datasette_indieauth.allow_list import table_allow_list
+import asyncio
+import pytest
+import secrets
+
+
+def actor_cookies(ds, me):
+    return {"ds_actor": ds.sign({"a": {"me": me, "display": me}}, "actor")}
+
+
+async def add_allowed_actors(ds):
+    db = ds.add_database(Database(ds, memory_name=secrets.token_hex()), name="auth")
+    await db.execute_write("create table allowed_actors (me text primary key)")
+    await db.execute_write(
+        "insert into allowed_actors (me) values (?)", ["https://simonwillison.net/"]
+    )
+    return db
+
+
+@pytest.mark.asyncio
+async def test_restrict_access_table(make_datasette):
+    ds = make_datasette(
+        restrict_access={
+            "database": "auth",
+            "table": "allowed_actors",
+            "check_interval": 0,
+        }
+    )
+    db = await add_allowed_actors(ds)
+    response = await ds.client.get("/")
+    assert response.status_code == 403
+    response = await ds.client.get(
+        "/", cookies=actor_cookies(ds, "https://simonwillison.net/")
+    )
+    assert response.status_code == 200
+    other = actor_cookies(ds, "https://example.com/")
+    response = await ds.client.get("/", cookies=other)
+    assert response.status_code == 403
+    # Edits to the table take effect without a restart
+    await db.execute_write(
+        "insert into allowed_actors (me) values (?)", ["https://example.com/"]
+    )
+    response = await ds.client.get("/", cookies=other)
+    assert response.status_code == 200
+    await db.execute_write("delete from allowed_actors")
+    response = await ds.client.get("/", cookies=other)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_allow_list_only_reloads_on_change():
+    ds = Datasette([], memory=True)
+    db = await add_allowed_actors(ds)
+    now = [0.0]
+    allow_list = table_allow_list(ds, {"database": "auth", "table": "allowed_actors"})
+    allow_list.timer = lambda: now[0]
+    assert await allow_list.contains("https://simonwillison.net/")
+    assert allow_list.loads == 1
+    await db.execute_write(
+        "insert into allowed_actors (me) values (?)", ["https://example.com/"]
+    )
+    # Within check_interval the in-memory set is used as-is
+    assert not await allow_list.contains("https://example.com/")
+    now[0] = 5
+    assert await allow_list.contains("https://example.com/")
+    assert allow_list.loads == 2
+    # No writes, so checking again does not reload
+    now[0] = 10
+    assert await allow_list.contains("https://example.com/")
+    assert allow_list.loads == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "config",
+    (
+        {"database": "missing", "table": "allowed_actors"},
+        {"database": "auth", "table": "missing"},
+        {"database": "auth", "table": "allowed_actors", "column": "missing"},
+    ),
+)
+async def test_allow_list_missing_table_denies_everyone(make_datasette, config):
+    ds = make_datasette(restrict_access=config)
+    await add_allowed_actors(ds)
+    response = await ds.client.get(
+        "/", cookies=actor_cookies(ds, "https://simonwillison.net/")
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_allow_list_concurrent_refresh_loads_once():
+    ds = Datasette([], memory=True)
+    await add_allowed_actors(ds)
+    allow_list = table_allow_list(ds, {"database": "auth", "table": "allowed_actors"})
+    results = await asyncio.gather(
+        *(allow_list.contains("https://simonwillison.net/") for _ in range(5))
+    )
+    assert results == [True] * 5
+    assert allow_list.loads == 1
+
+
+@pytest.mark.asyncio
+async def test_allow_list_without_sql_threads():
+    # num_sql_threads=0 runs queries on the event loop thread
+    ds = Datasette([], memory=True, settings={"num_sql_threads": 0})
+    await add_allowed_actors(ds)
+    allow_list = table_allow_list(ds, {"database": "auth", "table": "allowed_actors"})
+    assert await allow_list.contains("https://simonwillison.net/")
+    assert allow_list.loads == 1
@@ -0,0 +1,201 @@
+from datasette.app import Datasette
+from datasette.database import Database
+from datasette_indieauth import shutdown
+from datasette_indieauth.audit import AuditLog, audit_log
+import asyncio
+import pytest
+import secrets
+import sqlite3
+
+
+def add_audit_database(ds):
+    return ds.add_database(Database(ds, memory_name=secrets.token_hex()), name="audit")
+
+
+async def audit_rows(db, table="indieauth_audit_log"):
+    return [
+        dict(row)
+        for row in (
+            await db.execute(
+                "select stage, me, authorization_endpoint, success, error from {} order by id".format(
+                    table
+                )
+            )
+        ).rows
+    ]
+
+
+@pytest.mark.asyncio
+async def test_audit_log_not_configured():
+    ds = Datasette([], memory=True)
+    assert audit_log(ds, {}) is None
+
+
+@pytest.mark.asyncio
+async def test_audit_log_batches_writes():
+    ds = Datasette([], memory=True)
+    db = add_audit_database(ds)
+    log = AuditLog(ds, "audit", batch_size=3, flush_interval=60)
+    calls = []
+    original = db.execute_write_fn
+
+    async def counting_execute_write_fn(fn, *args, **kwargs):
+        calls.append(fn)
+        return await original(fn, *args, **kwargs)
+
+    db.execute_write_fn = counting_execute_write_fn
+    for i in range(2):
+        log.record("start", "https://example.com/{}".format(i), None, None, 1.5)
+    await asyncio.sleep(0.05)
+    # Fewer than batch_size rows are held back until flush_interval
+    assert calls == []
+    for i in range(2, 7):
+        log.record("start", "https://example.com/{}".format(i), None, None, 1.5)
+    await asyncio.sleep(0.05)
+    # Each write is a single executemany() of up to batch_size rows
+    assert log.written == 7
+    assert len(calls) == 3
+    await log.close()
+    rows = await audit_rows(db)
+    assert [row["me"] for row in rows] == [
+        "https://example.com/{}".format(i) for i in range(7)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_audit_log_flush_interval():
+    ds = Datasette([], memory=True)
+    db = add_audit_database(ds)
+    log = AuditLog(ds, "audit", batch_size=100, flush_interval=0.01)
+    log.record("done", "https://example.com/", "https://auth.example/", "Bad", 1.0)
+    await asyncio.sleep(0.1)
+    assert log.written == 1
+    assert await audit_rows(db) == [
+        {
+            "stage": "done",
+            "me": "https://example.com/",
+            "authorization_endpoint": "https://auth.example/",
+            "success": 0,
+            "error": "Bad",
+        }
+    ]
+    await log.close()
+
+
+@pytest.mark.asyncio
+async def test_audit_log_drops_oldest():
+    ds = Datasette([], memory=True)
+    db = add_audit_database(ds)
+    log = AuditLog(ds, "audit", batch_size=100, flush_interval=60, max_queue=2)
+    for i in range(5):
+        log.record("start", str(i), None, None, 1.0)
+    assert log.dropped == 3
+    await log.close()
+    assert [row["me"] for row in await audit_rows(db)] == ["3", "4"]
+
+
+@pytest.mark.asyncio
+async def test_audit_log_missing_database():
+    ds = Datasette([], memory=True)
+    db = add_audit_database(ds)
+    log = AuditLog(ds, "missing", flush_interval=60)
+    log.record("start", "https://example.com/", None, None, 1.0)
+    await log.close()
+    assert log.failed == 1
+    assert log.written == 0
+
+
+@pytest.mark.asyncio
+async def test_audit_log_keeps_running_after_write_errors(tmpdir):
+    path = str(tmpdir / "audit.db")
+    sqlite3.connect(path).close()
+    ds = Datasette([], memory=True)
+    # Writing to an immutable database fails an assertion in Datasette
+    ds.add_database(Database(ds, path=path, is_mutable=False), name="audit")
+    log = AuditLog(ds, "audit", batch_size=1, flush_interval=60)
+    log.record("start", "https://example.com/", None, None, 1.0)
+    await asyncio.sleep(0.05)
+    assert log.failed == 1
+    assert not log._task.done()
+    ds.remove_database("audit")
+    db = add_audit_database(ds)
+    log.record("start", "https://example.com/2", None, None, 1.0)
+    await asyncio.sleep(0.05)
+    assert log.written == 1
+    await log.close()
+    assert [row["me"] for row in await audit_rows(db)] == ["https://example.com/2"]
+
+
+@pytest.mark.asyncio
+async def test_audit_log_task_can_be_cancelled_mid_write():
+    ds = Datasette([], memory=True)
+    db = add_audit_database(ds)
+
+    async def slow_execute_write_fn(fn):
+        await asyncio.sleep(5)
+
+    db.execute_write_fn = slow_execute_write_fn
+    log = AuditLog(ds, "audit", batch_size=1, flush_interval=60)
+    log.record("start", "https://example.com/", None, None, 1.0)
+    await asyncio.sleep(0.01)
+    task = log._task
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert log.failed == 0
+
+
+@pytest.mark.asyncio
+async def test_audit_log_records_sign_in(
+    httpx_mock, make_datasette, start_sign_in, finish_sign_in
+):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth",
+        method="POST",
+        text="me=https%3A%2F%2Fsimonwillison.net%2F",
+    )
+    ds = make_datasette(
+        audit_log={"database": "audit", "table": "logins", "flush_interval": 60}
+    )
+    db = add_audit_database(ds)
+    await start_sign_in(ds, "")
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    response = await finish_sign_in(ds, post_response)
+    assert "ds_actor" in response.cookies
+    await ds.client.get("/-/indieauth/done", params={"state": "bad"})
+    # Rows are written when the server shuts down
+    await shutdown(ds)
+    assert await audit_rows(db, "logins") == [
+        {
+            "stage": "start",
+            "me": None,
+            "authorization_endpoint": None,
+            "success": 0,
+            "error": "Invalid IndieAuth identifier",
+        },
+        {
+            "stage": "start",
+            "me": "https://simonwillison.net/",
+            "authorization_endpoint": "https://indieauth.simonwillison.net/auth",
+            "success": 1,
+            "error": None,
+        },
+        {
+            "stage": "done",
+            "me": "https://simonwillison.net/",
+            "authorization_endpoint": "https://indieauth.simonwillison.net/auth",
+            "success": 1,
+            "error": None,
+        },
+        {
+            "stage": "done",
+            "me": None,
+            "authorization_endpoint": None,
+            "success": 0,
+            "error": "Invalid state",
+        },
+    ]
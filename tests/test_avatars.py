@@ -0,0 +1,185 @@
+from datasette.app import Datasette
+from datasette_indieauth.avatars import (
+    AvatarCache,
+    AvatarError,
+    _avatar_caches,
+    avatar_hash,
+)
+import asyncio
+import httpx
+import os
+import pytest
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+
+@pytest.fixture
+def sign_in(httpx_mock, start_sign_in, finish_sign_in):
+    "Returns a function that signs in, returning an actor with this photo"
+
+    async def sign_in(ds, photo):
+        httpx_mock.add_response(
+            url="https://simonwillison.net/",
+            text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+        )
+        httpx_mock.add_response(
+            url="https://indieauth.simonwillison.net/auth",
+            method="POST",
+            json={"me": "https://simonwillison.net/", "profile": {"photo": photo}},
+        )
+        post_response = await start_sign_in(ds, "https://simonwillison.net/")
+        response = await finish_sign_in(ds, post_response)
+        return ds.unsign(response.cookies["ds_actor"], "actor")["a"]
+
+    return sign_in
+
+
+@pytest.mark.asyncio
+async def test_avatar_proxy(httpx_mock, tmpdir, make_datasette, sign_in):
+    photo = "https://photos.example.com/simon.png"
+    ds = make_datasette(avatar_cache_dir=str(tmpdir / "avatars"))
+    actor = await sign_in(ds, photo)
+    path = "/-/indieauth/avatar/{}".format(avatar_hash(photo))
+    assert actor["photo"] == path
+    httpx_mock.add_response(
+        url=photo, content=PNG, headers={"content-type": "image/png"}
+    )
+    response = await ds.client.get(path)
+    assert response.status_code == 200
+    assert response.content == PNG
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["cache-control"] == "public, max-age=604800"
+    etag = response.headers["etag"]
+    # Served from disk without fetching again
+    response = await ds.client.get(path)
+    assert response.content == PNG
+    assert response.headers["etag"] == etag
+    assert len([r for r in httpx_mock.get_requests() if r.url == photo]) == 1
+    response = await ds.client.get(path, headers={"if-none-match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+@pytest.mark.asyncio
+async def test_avatar_cache_dir_not_writable(tmpdir, make_datasette, sign_in):
+    # A file where the directory should be
+    path = tmpdir / "avatars"
+    path.write("")
+    ds = make_datasette(avatar_cache_dir=str(path))
+    photo = "https://photos.example.com/simon.png"
+    actor = await sign_in(ds, photo)
+    assert actor["photo"] == photo
+
+
+@pytest.mark.asyncio
+async def test_avatar_proxy_not_configured(sign_in):
+    ds = Datasette([], memory=True)
+    photo = "https://photos.example.com/simon.png"
+    actor = await sign_in(ds, photo)
+    assert actor["photo"] == photo
+    response = await ds.client.get("/-/indieauth/avatar/{}".format(avatar_hash(photo)))
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_avatar_unknown_hash(tmpdir, make_datasette):
+    ds = make_datasette(avatar_cache_dir=str(tmpdir / "avatars"))
+    response = await ds.client.get("/-/indieauth/avatar/{}".format("a" * 64))
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "response_kwargs",
+    (
+        {"content": b"<svg></svg>", "headers": {"content-type": "image/svg+xml"}},
+        {"status_code": 404, "content": b"", "headers": {"content-type": "image/png"}},
+        {"content": b"\x00" * 2000, "headers": {"content-type": "image/png"}},
+    ),
+)
+async def test_avatar_errors(httpx_mock, tmpdir, make_datasette, response_kwargs):
+    photo = "https://photos.example.com/simon.png"
+    cache = AvatarCache(str(tmpdir), max_avatar_bytes=1000)
+    hash = cache.register(photo)
+    httpx_mock.add_response(url=photo, **response_kwargs)
+    ds = make_datasette(avatar_cache_dir=str(tmpdir))
+    _avatar_caches[ds] = cache
+    response = await ds.client.get("/-/indieauth/avatar/{}".format(hash))
+    assert response.status_code == 502
+    assert not os.path.exists(cache.path(hash))
+
+
+@pytest.mark.asyncio
+async def test_avatar_cache_lru_eviction(httpx_mock, tmpdir):
+    cache = AvatarCache(str(tmpdir), max_bytes=250)
+    urls = ["https://photos.example.com/{}.png".format(i) for i in range(3)]
+    for url in urls:
+        httpx_mock.add_response(
+            url=url, content=PNG, headers={"content-type": "image/png"}
+        )
+    hashes = [cache.register(url) for url in urls]
+    async with httpx.AsyncClient() as client:
+        await cache.get(client, hashes[0])
+        await cache.get(client, hashes[1])
+        # The first photo was used more recently than the second
+        os.utime(cache.path(hashes[1]), (1000, 1000))
+        os.utime(cache.path(hashes[0]), (2000, 2000))
+        await cache.get(client, hashes[2])
+    assert os.path.exists(cache.path(hashes[0]))
+    assert not os.path.exists(cache.path(hashes[1]))
+    assert os.path.exists(cache.path(hashes[2]))
+    # Metadata is kept, so an evicted photo is fetched again when requested
+    assert cache.read_meta(hashes[1])["url"] == urls[1]
+
+
+@pytest.mark.asyncio
+async def test_avatar_stale_copy_served_on_error(httpx_mock, tmpdir):
+    now = [0.0]
+    cache = AvatarCache(str(tmpdir), max_age=60, timer=lambda: now[0])
+    photo = "https://photos.example.com/simon.png"
+    hash = cache.register(photo)
+    httpx_mock.add_response(
+        url=photo, content=PNG, headers={"content-type": "image/png"}
+    )
+    httpx_mock.add_response(url=photo, status_code=500)
+    async with httpx.AsyncClient() as client:
+        assert await cache.get(client, "not-a-hash") is None
+        meta = await cache.get(client, hash)
+        now[0] = 120
+        assert await cache.get(client, hash) == meta
+        # Without a stored copy the error is raised
+        os.remove(cache.path(hash))
+        httpx_mock.add_response(url=photo, status_code=500)
+        with pytest.raises(AvatarError):
+            await cache.get(client, hash)
+    assert cache.fetches == 3
+
+
+@pytest.mark.asyncio
+async def test_avatar_fetch_timeout(httpx_mock, tmpdir):
+    cache = AvatarCache(str(tmpdir))
+    cache.limits = cache.limits._replace(max_read_seconds=0.05)
+    photo = "https://photos.example.com/simon.png"
+    hash = cache.register(photo)
+
+    class SlowStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            await asyncio.sleep(1)
+            yield PNG
+
+    httpx_mock.add_response(
+        url=photo, stream=SlowStream(), headers={"content-type": "image/png"}
+    )
+    async with httpx.AsyncClient() as client:
+        with pytest.raises(AvatarError) as ex:
+            await cache.get(client, hash)
+    assert str(ex.value) == "Timed out"
+
+
+def test_avatar_cache_ignores_missing_files(tmpdir):
+    cache = AvatarCache(str(tmpdir), max_bytes=0)
+    # Photos deleted by something else are skipped
+    cache._touch("a" * 64)
+    tmpdir.mkdir("b" * 64)
+    cache.evict()
+    assert os.path.isdir(cache.path("b" * 64))
@@ -0,0 +1,51 @@
+from datasette_indieauth.cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_get_set_and_stats():
+    cache = TTLCache(maxsize=10)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert "a" in cache
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert [key for key, _, _ in cache.items()] == ["a", "c"]
+
+
+def test_ttl_cache_expiry():
+    timer = FakeTimer()
+    cache = TTLCache(ttl=10, timer=timer)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=100)
+    cache.set("c", 3, expires=1005.0)
+    assert list(cache.items()) == [
+        ("a", 1, 1010.0),
+        ("b", 2, 1100.0),
+        ("c", 3, 1005.0),
+    ]
+    timer.now = 1010.0
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert [key for key, _, _ in cache.items()] == ["b"]
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,171 @@
+import asyncio
+from click.testing import CliRunner
+from datasette.cli import cli
+from datasette_indieauth import _background_tasks
+from datasette_indieauth.discovery import (
+    discovery_cache,
+    read_cache_file,
+    write_cache_file,
+)
+import json
+
+LINK = '<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">'
+
+
+def test_discover(httpx_mock):
+    httpx_mock.add_response(url="https://simonwillison.net/", text=LINK)
+    httpx_mock.add_response(
+        url="http://example.com/",
+        status_code=301,
+        headers={"location": "https://example.com/"},
+    )
+    httpx_mock.add_response(url="https://example.com/", text="No links here")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["indieauth", "discover", "-c", "2"],
+        input="https://simonwillison.net/\n\nexample.com\nmailto:simon@example.com\n",
+    )
+    assert result.exit_code == 0, result.output
+    results = sorted(
+        (json.loads(line) for line in result.output.splitlines()),
+        key=lambda r: r["url"],
+    )
+    # Timings are only recorded for valid URLs
+    assert [isinstance(r.pop("ms"), float) for r in results] == [True, True, False]
+    assert results == [
+        {
+            "url": "example.com",
+            "me": "http://example.com/",
+            "canonical_url": "https://example.com/",
+            "authorization_endpoint": None,
+            "token_endpoint": None,
+            "error": None,
+        },
+        {
+            "url": "https://simonwillison.net/",
+            "me": "https://simonwillison.net/",
+            "canonical_url": "https://simonwillison.net/",
+            "authorization_endpoint": "https://indieauth.simonwillison.net/auth",
+            "token_endpoint": None,
+            "error": None,
+        },
+        {
+            "url": "mailto:simon@example.com",
+            "me": None,
+            "canonical_url": None,
+            "authorization_endpoint": None,
+            "token_endpoint": None,
+            "error": "Invalid IndieAuth identifier",
+        },
+    ]
+
+
+def test_discover_error(httpx_mock):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        status_code=301,
+        headers={"location": "https://simonwillison.net/"},
+        is_reusable=True,
+    )
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["indieauth", "discover"], input="https://simonwillison.net/\n"
+    )
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)["error"] == (
+        "DiscoverEndpointsError: Exceeded maximum allowed redirects."
+    )
+
+
+def test_discover_cache_file_warms_plugin_cache(
+    httpx_mock, tmpdir, make_datasette, start_sign_in
+):
+    cache_file = str(tmpdir / "discovery.jsonl")
+    httpx_mock.add_response(url="https://simonwillison.net/", text=LINK)
+    (tmpdir / "urls.txt").write_text("https://simonwillison.net/\n", "utf-8")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "indieauth",
+            "discover",
+            str(tmpdir / "urls.txt"),
+            "--cache-file",
+            cache_file,
+            "--ttl",
+            "100",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    entries = [json.loads(line) for line in open(cache_file)]
+    assert [(e["key"], e["value"]) for e in entries] == [
+        (
+            "https://simonwillison.net/",
+            [
+                "https://simonwillison.net/",
+                "https://indieauth.simonwillison.net/auth",
+                None,
+            ],
+        )
+    ]
+    # An expired entry in the file should be ignored
+    with open(cache_file, "a") as fp:
+        fp.write(
+            json.dumps(
+                {"key": "https://example.com/", "value": ["x", "y", None], "expires": 1}
+            )
+            + "\n"
+        )
+    ds = make_datasette(discovery_cache_file=cache_file)
+    asyncio.run(_sign_in_with_warm_cache(ds, start_sign_in))
+    assert len(httpx_mock.get_requests()) == 1
+
+
+async def _sign_in_with_warm_cache(ds, start_sign_in):
+    await ds.invoke_startup()
+    # Wait for the cache file to finish loading in the background
+    await _background_tasks[ds][0]
+    assert [key for key, _, _ in discovery_cache(ds).items()] == [
+        "https://simonwillison.net/"
+    ]
+    # Signing in uses the cached endpoints without any HTTP requests
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    assert post_response.status_code == 302
+    assert post_response.headers["location"].startswith(
+        "https://indieauth.simonwillison.net/auth?"
+    )
+
+
+def test_discover_cache_file_keeps_existing_entries(httpx_mock, tmpdir):
+    cache_file = str(tmpdir / "discovery.jsonl")
+    write_cache_file(
+        cache_file,
+        [
+            (
+                "https://user{}.example.com/".format(i),
+                (
+                    "https://user{}.example.com/".format(i),
+                    "https://auth.example/",
+                    None,
+                ),
+                None,
+            )
+            for i in range(100)
+        ],
+    )
+    httpx_mock.add_response(url="https://simonwillison.net/", text=LINK)
+    httpx_mock.add_response(url="https://example.com/", text="No links here")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["indieauth", "discover", "--cache-file", cache_file],
+        input="https://simonwillison.net/\nhttps://example.com/\n",
+    )
+    assert result.exit_code == 0, result.output
+    keys = [key for key, _, _ in read_cache_file(cache_file)]
+    assert len(keys) == 101
+    assert "https://user0.example.com/" in keys
+    assert "https://simonwillison.net/" in keys
+    # No authorization_endpoint, so not something to sign in with
+    assert "https://example.com/" not in keys
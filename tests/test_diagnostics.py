@@ -0,0 +1,123 @@
+from datasette.app import Datasette
+from datasette_indieauth import _background_tasks, indieauth, register_routes
+from datasette_indieauth.diagnostics import Diagnostics
+import asyncio
+import cProfile
+import os
+import pstats
+import pytest
+import time
+
+
+@pytest.mark.asyncio
+async def test_diagnostics_disabled_by_default():
+    ds = Datasette([], memory=True)
+    routes = dict(register_routes(ds))
+    # The handlers are not wrapped at all
+    assert routes[r"^/-/indieauth$"] is indieauth
+    assert r"^/-/indieauth/diagnostics$" not in routes
+    await ds.invoke_startup()
+    assert ds not in _background_tasks
+    response = await ds.client.get("/-/indieauth/diagnostics")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_loop_lag_blamed_on_active_handler():
+    diag = Diagnostics(lag_interval=0.01, lag_threshold_ms=30)
+
+    async def slow_handler(request, datasette):
+        await asyncio.sleep(0.02)
+        # Blocks the event loop
+        time.sleep(0.1)
+        return "done"
+
+    wrapped = diag.wrap("slow_handler", slow_handler)
+    monitor = asyncio.ensure_future(diag.monitor_loop_lag())
+    await asyncio.sleep(0.03)
+    assert await wrapped(None, None) == "done"
+    await asyncio.sleep(0.03)
+    monitor.cancel()
+    assert diag.max_lag_ms >= 80
+    assert diag.stalls_by_handler["slow_handler"] == 1
+    assert diag.stalls[-1]["handlers"] == ["slow_handler"]
+    assert diag.active == {}
+
+
+@pytest.mark.asyncio
+async def test_slow_requests_are_profiled(tmpdir, make_datasette):
+    profile_dir = str(tmpdir / "profiles")
+    ds = make_datasette(
+        diagnostics={"profile_dir": profile_dir, "slow_ms": 0, "max_profiles": 2}
+    )
+    for _ in range(3):
+        response = await ds.client.get("/-/indieauth")
+        assert response.status_code == 200
+    names = sorted(os.listdir(profile_dir))
+    assert len(names) == 2
+    assert all("-indieauth-" in name for name in names)
+    stats = pstats.Stats(os.path.join(profile_dir, names[0]))
+    assert any(
+        function_name == "indieauth_page"
+        for (_, _, function_name) in stats.stats.keys()
+    )
+    # Requests faster than slow_ms are not written
+    ds2 = make_datasette(
+        diagnostics={"profile_dir": str(tmpdir / "other"), "slow_ms": 60000}
+    )
+    await ds2.client.get("/-/indieauth")
+    assert not os.path.exists(str(tmpdir / "other"))
+
+
+@pytest.mark.asyncio
+async def test_diagnostics_route(tmpdir, make_datasette):
+    ds = make_datasette(diagnostics={"profile_dir": str(tmpdir), "slow_ms": 0})
+    await ds.client.get("/-/indieauth")
+    response = await ds.client.get("/-/indieauth/diagnostics")
+    assert response.status_code == 403
+    response = await ds.client.get(
+        "/-/indieauth/diagnostics",
+        cookies={"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert set(data) == {
+        "active",
+        "max_lag_ms",
+        "stalls_by_handler",
+        "recent_stalls",
+        "profiles",
+    }
+    assert len(data["profiles"]) == 1
+
+
+@pytest.mark.asyncio
+async def test_diagnostics_without_profiles(make_datasette):
+    ds = make_datasette(diagnostics=True)
+    response = await ds.client.get(
+        "/-/indieauth/diagnostics",
+        cookies={"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")},
+    )
+    assert response.status_code == 200
+    assert response.json()["profiles"] == []
+
+
+def test_profiling_skipped_if_another_profiler_is_active(monkeypatch, tmpdir):
+    class ActiveProfile(cProfile.Profile):
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(cProfile, "Profile", ActiveProfile)
+    diag = Diagnostics(profile_dir=str(tmpdir))
+    assert diag._start_profile() is None
+    assert not diag._profiling
+
+
+def test_save_profile_ignores_undeletable_profiles(tmpdir):
+    diag = Diagnostics(profile_dir=str(tmpdir), max_profiles=1)
+    # A directory can't be removed with os.remove()
+    old = tmpdir.mkdir("old.prof")
+    os.utime(str(old), (1000, 1000))
+    profiler = cProfile.Profile()
+    filename = diag.save_profile(profiler, "indieauth", 5)
+    assert sorted(os.listdir(str(tmpdir))) == sorted([filename, "old.prof"])
@@ -0,0 +1,116 @@
+import asyncio
+from datasette.app import Datasette
+from datasette_indieauth import _background_tasks
+from datasette_indieauth.discovery import (
+    _clients,
+    discovery_cache,
+    http_client,
+    read_cache_file,
+    restore_discovery_cache,
+    snapshot_periodically,
+    write_cache_file,
+)
+import json
+import pytest
+import time
+
+
+def test_read_write_cache_file(tmpdir):
+    path = str(tmpdir / "cache.jsonl")
+    assert read_cache_file(path) == []
+    write_cache_file(
+        path,
+        [
+            ("https://a.com/", ("https://a.com/", "https://a.com/auth", None), 200),
+            ("https://b.com/", ("https://b.com/", None, None), 50),
+            ("https://c.com/", ("https://c.com/", None, None), None),
+        ],
+    )
+    with open(path, "a") as fp:
+        fp.write("not JSON\n")
+        fp.write(json.dumps({"key": "https://d.com/"}) + "\n")
+    assert read_cache_file(path, now=100) == [
+        ("https://a.com/", ("https://a.com/", "https://a.com/auth", None), 200),
+        ("https://c.com/", ("https://c.com/", None, None), None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_restore_keeps_newer_entries(tmpdir):
+    path = str(tmpdir / "cache.jsonl")
+    expires = time.time() + 100
+    write_cache_file(
+        path,
+        [
+            ("https://a.com/", ("old", None, None), expires),
+            ("https://b.com/", ("https://b.com/", None, None), expires),
+        ],
+    )
+    ds = Datasette([], memory=True)
+    discovery_cache(ds).set("https://a.com/", ("new", None, None))
+    assert await restore_discovery_cache(ds, path) == 2
+    assert discovery_cache(ds).get("https://a.com/") == ("new", None, None)
+    assert discovery_cache(ds).get("https://b.com/") == ("https://b.com/", None, None)
+
+
+@pytest.mark.asyncio
+async def test_restore_unreadable_file(tmpdir):
+    ds = Datasette([], memory=True)
+    # A directory where the file should be
+    assert await restore_discovery_cache(ds, str(tmpdir)) == 0
+    assert len(discovery_cache(ds)) == 0
+
+
+@pytest.mark.asyncio
+async def test_snapshot_periodically_survives_write_errors(tmpdir):
+    ds = Datasette([], memory=True)
+    discovery_cache(ds).set("https://a.com/", ("https://a.com/", None, None))
+    path = str(tmpdir / "missing" / "cache.jsonl")
+    task = asyncio.ensure_future(snapshot_periodically(ds, path, 0.01))
+    await asyncio.sleep(0.05)
+    assert not task.done()
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_periodically(tmpdir, make_datasette):
+    path = str(tmpdir / "cache.jsonl")
+    ds = make_datasette(
+        discovery_cache_file=path, discovery_cache_snapshot_interval=0.01
+    )
+    await ds.invoke_startup()
+    discovery_cache(ds).set("https://a.com/", ("https://a.com/", None, None))
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if read_cache_file(path):
+            break
+    assert [key for key, _, _ in read_cache_file(path)] == ["https://a.com/"]
+    for task in _background_tasks.pop(ds):
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_lifespan_shutdown_saves_cache_and_closes_client(tmpdir, make_datasette):
+    path = str(tmpdir / "cache.jsonl")
+    ds = make_datasette(discovery_cache_file=path)
+    app = ds.app()
+    await ds.invoke_startup()
+    tasks = _background_tasks[ds]
+    discovery_cache(ds).set("https://a.com/", ("https://a.com/", None, None))
+    client = http_client(ds)
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    await app({"type": "lifespan"}, receive, send)
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert [key for key, _, _ in read_cache_file(path)] == ["https://a.com/"]
+    assert client.is_closed
+    assert ds not in _clients
+    await asyncio.sleep(0)
+    assert all(task.done() for task in tasks)
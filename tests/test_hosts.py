@@ -0,0 +1,194 @@
+from datasette_indieauth.discovery import host_tracker
+from datasette_indieauth.hosts import MAX_TIMEOUT, MIN_TIMEOUT, HostTracker
+from datasette_indieauth.utils import (
+    discover_endpoints,
+    get_following_redirects,
+    send_hedged,
+)
+import asyncio
+import httpx
+import pytest
+import time
+
+PROFILE = '<link rel="authorization_endpoint" href="https://auth.example.com/auth">'
+
+
+def test_host_tracker_timeouts():
+    hosts = HostTracker(min_timeout=1.0)
+    assert hosts.timeout("example.com") is None
+    for _ in range(20):
+        hosts.record("fast.example.com", 0.02)
+        hosts.record("slow.example.com", 3.0)
+        hosts.record("slower.example.com", 30.0)
+    assert hosts.timeout("fast.example.com") == 1.0
+    assert 3.0 < hosts.timeout("slow.example.com") < 4.0
+    assert hosts.timeout("slower.example.com") == MAX_TIMEOUT
+    # Errors push the timeout up
+    for _ in range(10):
+        hosts.record("slow.example.com", 3.0, error=True)
+    stats = hosts.get("slow.example.com")
+    assert stats.error_rate > 0.5
+    assert hosts.timeout("slow.example.com") > 4.5
+
+
+def test_host_tracker_default_min_timeout():
+    hosts = HostTracker()
+    for _ in range(20):
+        hosts.record("fast.example.com", 0.02)
+        hosts.record("slower.example.com", 30.0)
+    # No shorter than httpx's default, so one slow response does not fail
+    assert hosts.timeout("fast.example.com") == MIN_TIMEOUT == 5.0
+    assert hosts.timeout("slower.example.com") == MAX_TIMEOUT
+    # A floor above MAX_TIMEOUT is used for every host
+    hosts.min_timeout = 15.0
+    assert hosts.timeout("slower.example.com") == 15.0
+
+
+@pytest.mark.parametrize("setting,expected", ((None, MIN_TIMEOUT), (0.5, 0.5)))
+def test_discovery_min_timeout_setting(make_datasette, setting, expected):
+    if setting is None:
+        ds = make_datasette()
+    else:
+        ds = make_datasette(discovery_min_timeout=setting)
+    hosts = host_tracker(ds)
+    hosts.record("example.com", 0.01)
+    assert hosts.timeout("example.com") == expected
+
+
+def test_host_tracker_hedge_delay():
+    hosts = HostTracker()
+    for i in range(9):
+        hosts.record("example.com", 0.1)
+    # Not enough samples to know the tail latency yet
+    assert hosts.hedge_delay("example.com") is None
+    hosts.record("example.com", 2.0)
+    assert hosts.hedge_delay("example.com") == 2.0
+    for i in range(40):
+        hosts.record("example.com", 0.1 + i / 1000)
+    assert hosts.hedge_delay("example.com") == pytest.approx(0.138)
+
+
+def test_host_tracker_is_bounded():
+    hosts = HostTracker(maxsize=2)
+    hosts.record("a.com", 0.1)
+    hosts.record("b.com", 0.1)
+    hosts.record("a.com", 0.1)
+    hosts.record("c.com", 0.1)
+    assert len(hosts) == 2
+    assert hosts.get("b.com") is None
+
+
+def primed(host, latency=0.01):
+    hosts = HostTracker()
+    for _ in range(20):
+        hosts.record(host, latency)
+    return hosts
+
+
+@pytest.mark.asyncio
+async def test_per_host_timeout_is_used(httpx_mock):
+    httpx_mock.add_response(url="https://example.com/", text=PROFILE)
+    hosts = primed("example.com")
+    async with httpx.AsyncClient() as client:
+        response = await get_following_redirects(
+            client, "https://example.com/", hosts=hosts
+        )
+        await response.aclose()
+    request = httpx_mock.get_request()
+    assert request.extensions["timeout"]["read"] == MIN_TIMEOUT
+    assert hosts.get("example.com").samples == 21
+
+
+@pytest.mark.asyncio
+async def test_hedged_discovery(httpx_mock):
+    calls = []
+
+    async def profile(request):
+        calls.append(time.perf_counter())
+        if len(calls) == 1:
+            # The first request hits the slow tail
+            await asyncio.sleep(2)
+        return httpx.Response(200, text=PROFILE)
+
+    httpx_mock.add_callback(profile, url="https://example.com/", is_reusable=True)
+    hosts = primed("example.com")
+    start = time.perf_counter()
+    result = await discover_endpoints("https://example.com/", hosts=hosts, hedge=True)
+    assert result == ("https://example.com/", "https://auth.example.com/auth", None)
+    assert time.perf_counter() - start < 1
+    assert len(calls) == 2
+    # The hedge was sent after the host's p95 latency
+    assert calls[1] - calls[0] >= 0.04
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_for_fast_response(httpx_mock):
+    httpx_mock.add_response(url="https://example.com/", text=PROFILE)
+    hosts = primed("example.com", latency=1.0)
+    await discover_endpoints("https://example.com/", hosts=hosts, hedge=True)
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_discovery_both_fail(httpx_mock):
+    async def fail(request):
+        await asyncio.sleep(0.1)
+        raise httpx.ConnectError("Connection refused")
+
+    httpx_mock.add_callback(fail, url="https://example.com/", is_reusable=True)
+    hosts = primed("example.com")
+    with pytest.raises(httpx.ConnectError):
+        await discover_endpoints("https://example.com/", hosts=hosts, hedge=True)
+    assert len(httpx_mock.get_requests()) == 2
+    assert hosts.get("example.com").error_rate > 0
+
+
+@pytest.mark.asyncio
+async def test_send_hedged_closes_the_losing_response():
+    release = asyncio.Event()
+    responses = []
+
+    class Client:
+        async def send(self, request, stream=False):
+            await release.wait()
+            responses.append(httpx.Response(200, stream=httpx.ByteStream(b"")))
+            return responses[-1]
+
+    task = asyncio.ensure_future(send_hedged(Client(), lambda: None, 0.01))
+    await asyncio.sleep(0.05)
+    # Both requests have been sent, now they respond at the same time
+    release.set()
+    winner = await task
+    assert len(responses) == 2
+    loser = [response for response in responses if response is not winner][0]
+    assert loser.is_closed
+    assert not winner.is_closed
+
+
+@pytest.mark.asyncio
+async def test_code_exchange_post_is_never_hedged(
+    httpx_mock, make_datasette, start_sign_in, finish_sign_in
+):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+
+    async def slow_token_exchange(request):
+        await asyncio.sleep(0.3)
+        return httpx.Response(200, text="me=https%3A%2F%2Fsimonwillison.net%2F")
+
+    httpx_mock.add_callback(
+        slow_token_exchange,
+        url="https://indieauth.simonwillison.net/auth",
+        method="POST",
+    )
+    ds = make_datasette(hedge_discovery=True)
+    hosts = host_tracker(ds)
+    for _ in range(20):
+        hosts.record("indieauth.simonwillison.net", 0.01)
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    response = await finish_sign_in(ds, post_response)
+    assert "ds_actor" in response.cookies
+    posts = [r for r in httpx_mock.get_requests() if r.method == "POST"]
+    assert len(posts) == 1
@@ -0,0 +1,40 @@
+import re
+import subprocess
+import sys
+
+# Importing the plugin took around 200ms while it pulled in httpcore (and
+# with it trio) and around 35ms once that was deferred to the first request
+IMPORT_BUDGET_MS = 100
+
+DEFERRED_MODULES = ("httpcore", "trio", "html.parser", "cProfile")
+
+SCRIPT = """
+import sys
+sys._called_from_test = True
+import datasette.app
+import datasette_indieauth
+print(",".join(m for m in {!r} if m in sys.modules))
+""".format(DEFERRED_MODULES)
+
+
+def import_plugin():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    match = re.search(r"\|\s+(\d+) \| datasette_indieauth$", result.stderr, re.M)
+    return int(match.group(1)) / 1000, result.stdout.strip()
+
+
+def test_import_does_not_load_deferred_modules():
+    _, loaded = import_plugin()
+    assert loaded == ""
+
+
+def test_import_time_budget():
+    # Best of three, so a busy machine does not fail the test
+    cumulative_ms = min(import_plugin()[0] for _ in range(3))
+    assert cumulative_ms < IMPORT_BUDGET_MS
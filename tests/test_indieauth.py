@@ -1,16 +1,14 @@
 from datasette.app import Datasette
+from datasette_indieauth.tokens import unsign_cookie
+import asyncio
 import json
 import pytest
 import httpx
 import mf2py
+import time
 import urllib
 
 
-@pytest.fixture
-def non_mocked_hosts():
-    return ["localhost"]
-
-
 @pytest.mark.asyncio
 async def test_plugin_is_installed():
     ds = Datasette([], memory=True)
@@ -172,7 +170,7 @@ async def test_indieauth_flow(
     assert post_response.status_code == 302
     assert "ds_indieauth" in post_response.cookies
     ds_indieauth = post_response.cookies["ds_indieauth"]
-    ds_indieauth_bits = ds.unsign(ds_indieauth, "datasette-indieauth-cookie")
+    ds_indieauth_bits = unsign_cookie(ds, ds_indieauth, "datasette-indieauth-cookie")
     verifier = ds_indieauth_bits["v"]
     assert ds_indieauth_bits["m"] == me
     # Verify the location is in the right shape
@@ -245,6 +243,11 @@ async def test_indieauth_done_no_params_error():
             {},
             "Invalid IndieAuth identifier",
         ),
+        (
+            "https://simonwillison.net/",
+            {"https://simonwillison.net/": "x" * (1024 * 1024 + 1)},
+            "Invalid IndieAuth identifier: Content-Length of 1048577 exceeds 1048576 bytes",
+        ),
     ),
 )
 async def test_indieauth_errors(httpx_mock, me, bodies, expected_error):
@@ -270,7 +273,9 @@ async def test_indieauth_errors(httpx_mock, me, bodies, expected_error):
 )
 async def test_invalid_ds_indieauth_cookie(bad_cookie):
     ds = Datasette([], memory=True)
-    state = ds.sign({"a": "auth-url"}, "datasette-indieauth-state")
+    state = ds.sign(
+        {"a": "auth-url", "n": "1", "t": int(time.time())}, "datasette-indieauth-state"
+    )
     if isinstance(bad_cookie, dict):
         ds_indieauth = ds.sign(bad_cookie, "datasette-indieauth-cookie")
     else:
@@ -348,6 +353,355 @@ async def test_non_matching_authorization_endpoint(httpx_mock):
     )
 
 
+@pytest.mark.asyncio
+async def test_returned_me_too_large_to_verify(
+    httpx_mock, start_sign_in, finish_sign_in
+):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth",
+        method="POST",
+        text="me=https%3A%2F%2Fsimonwillison.net%2Fme",
+    )
+    httpx_mock.add_response(
+        url="https://simonwillison.net/me", text="x" * (1024 * 1024 + 1)
+    )
+    ds = Datasette([], memory=True)
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    response = await finish_sign_in(ds, post_response)
+    assert "ds_actor" not in response.cookies
+    assert (
+        "Could not verify &#34;me&#34; value: Content-Length of 1048577 exceeds"
+        in response.text
+    )
+
+
+@pytest.mark.asyncio
+async def test_state_cannot_be_replayed(httpx_mock, start_sign_in, finish_sign_in):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth",
+        method="POST",
+        text="me=https%3A%2F%2Fsimonwillison.net%2F",
+    )
+    ds = Datasette([], memory=True)
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    response = await finish_sign_in(ds, post_response)
+    assert "ds_actor" in response.cookies
+    # The ds_indieauth cookie is cleared on success
+    assert 'ds_indieauth=""' in response.headers["set-cookie"]
+    replay = await finish_sign_in(ds, post_response)
+    assert replay.status_code == 400
+    assert "Sign-in attempt has already been used" in replay.text
+    assert "ds_actor" not in replay.cookies
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("hcard_profile", (True, False))
+async def test_hcard_profile(httpx_mock, hcard_profile, start_sign_in, finish_sign_in):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text=(
+            '<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">'
+            '<div class="h-card"><img class="u-photo" src="/simon.jpg">'
+            '<span class="p-name">Simon Willison</span></div>'
+        ),
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth",
+        method="POST",
+        text="me=https%3A%2F%2Fsimonwillison.net%2F",
+    )
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={"plugins": {"datasette-indieauth": {"hcard_profile": hcard_profile}}},
+    )
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    response = await finish_sign_in(ds, post_response)
+    actor = ds.unsign(response.cookies["ds_actor"], "actor")["a"]
+    expected = {"me": "https://simonwillison.net/", "display": "simonwillison.net"}
+    if hcard_profile:
+        expected.update(
+            {
+                "name": "Simon Willison",
+                "photo": "https://simonwillison.net/simon.jpg",
+            }
+        )
+    assert actor == expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "hcard",
+    (
+        '<img class="u-photo" src="http://\x01x/">',
+        '<a class="u-url" href="https://simonwillison.net:abc/">Home</a>',
+    ),
+)
+async def test_hcard_profile_invalid_urls(httpx_mock, hcard, start_sign_in):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text=(
+            '<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">'
+            '<div class="h-card">{}</div>'.format(hcard)
+        ),
+    )
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={"plugins": {"datasette-indieauth": {"hcard_profile": True}}},
+    )
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    assert post_response.status_code == 302
+    assert post_response.headers["location"].startswith(
+        "https://indieauth.simonwillison.net/auth?"
+    )
+
+
+@pytest.mark.asyncio
+async def test_expired_state():
+    ds = Datasette([], memory=True)
+    state = ds.sign(
+        {"a": "auth-url", "n": "1", "t": int(time.time()) - 3600},
+        "datasette-indieauth-state",
+    )
+    response = await ds.client.get(
+        "/-/indieauth/done", params={"state": state, "code": "123"}
+    )
+    assert "Sign-in attempt has expired" in response.text
+
+
+@pytest.mark.asyncio
+async def test_login_page_cache_matches_full_render():
+    from datasette_indieauth import _login_pages
+
+    ds = Datasette([], memory=True, metadata={"title": "<Cached>"})
+    first = await ds.client.get("/-/indieauth")
+    csrftoken = first.cookies["ds_csrftoken"]
+    assert len(_login_pages[ds]) == 1
+    # Signed-in users bypass the cache, so render the same page uncached
+    # by passing ?_context= and compare
+    uncached = await ds.client.get(
+        "/-/indieauth?_context=1", cookies={"ds_csrftoken": csrftoken}
+    )
+    cached = await ds.client.get("/-/indieauth", cookies={"ds_csrftoken": csrftoken})
+    assert cached.text == uncached.text
+    assert 'value="{}"'.format(csrftoken) in cached.text
+    assert "&lt;Cached&gt;" in cached.text
+    assert "message-error" not in cached.text
+
+
+@pytest.mark.asyncio
+async def test_login_page_cache_custom_template(tmpdir):
+    from datasette_indieauth import _login_pages
+
+    (tmpdir / "indieauth.html").write_text(
+        '<form method="post"><input type="hidden" name="csrftoken" '
+        'value="{{ csrftoken() }}"><input type="text" name="me"></form>'
+        '{% if error %}<div class="oops">{{ error }}</div>{% endif %}',
+        "utf-8",
+    )
+    ds = Datasette([], memory=True, template_dir=str(tmpdir))
+    first = await ds.client.get("/-/indieauth")
+    csrftoken = first.cookies["ds_csrftoken"]
+    # No standard error markup to substitute, so it is rendered every time
+    assert list(_login_pages[ds].values()) == [None]
+    assert 'value="{}"'.format(csrftoken) in first.text
+    assert "etag" not in first.headers
+    response = await ds.client.post(
+        "/-/indieauth",
+        data={"csrftoken": csrftoken, "me": "mailto:simon@example.com"},
+        cookies={"ds_csrftoken": csrftoken},
+    )
+    assert '<div class="oops">Invalid IndieAuth identifier</div>' in response.text
+    assert "indieauth-" not in response.text
+
+
+@pytest.mark.asyncio
+async def test_login_page_cache_evicts_least_recently_used():
+    from datasette_indieauth import LOGIN_PAGE_CACHE_SIZE, _login_pages
+
+    ds = Datasette([], memory=True)
+    hosts = ["site{}.example.com".format(i) for i in range(LOGIN_PAGE_CACHE_SIZE + 1)]
+    for host in hosts:
+        response = await ds.client.get("/-/indieauth", headers={"host": host})
+        assert response.status_code == 200
+    cached_urls = [url for _, url in _login_pages[ds]]
+    assert len(cached_urls) == LOGIN_PAGE_CACHE_SIZE
+    assert "http://{}/".format(hosts[0]) not in cached_urls
+    assert "http://{}/".format(hosts[-1]) in cached_urls
+
+
+@pytest.mark.asyncio
+async def test_login_page_etag():
+    ds = Datasette([], memory=True)
+    first = await ds.client.get("/-/indieauth")
+    csrftoken = first.cookies["ds_csrftoken"]
+    etag = first.headers["etag"]
+    second = await ds.client.get(
+        "/-/indieauth",
+        cookies={"ds_csrftoken": csrftoken},
+        headers={"if-none-match": etag},
+    )
+    assert second.status_code == 304
+    assert second.text == ""
+    # A different csrftoken means a different page
+    third = await ds.client.get(
+        "/-/indieauth",
+        cookies={"ds_csrftoken": "other"},
+        headers={"if-none-match": etag},
+    )
+    assert third.status_code == 200
+    assert third.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_login_page_cache_error_and_status():
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-indieauth": {"restrict_access": "https://simonwillison.net/"}
+            }
+        },
+    )
+    forbidden = await ds.client.get("/")
+    assert forbidden.status_code == 403
+    assert "etag" not in forbidden.headers
+    assert "message-error" not in forbidden.text
+    response = await ds.client.get("/-/indieauth/done?state=<script>")
+    assert response.status_code == 400
+    assert '<p class="message-error">Invalid state</p>' in response.text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("me", ("", "mailto:simon@example.com", "https://1.2.3.4/"))
+async def test_prefetch_invalid(me):
+    ds = Datasette([], memory=True)
+    response = await ds.client.get("/-/indieauth/prefetch", params={"me": me})
+    assert response.status_code == 400
+    assert response.json() == {"ok": False, "error": "Invalid me"}
+
+
+@pytest.mark.asyncio
+async def test_prefetch_warms_discovery_cache(httpx_mock, start_sign_in):
+    from datasette_indieauth.discovery import _in_flight
+
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    ds = Datasette([], memory=True)
+    response = await ds.client.get(
+        "/-/indieauth/prefetch", params={"me": "https://SimonWillison.net"}
+    )
+    assert response.json() == {
+        "ok": True,
+        "me": "https://simonwillison.net/",
+        "started": True,
+    }
+    # Prefetching again while it is running is a no-op
+    response = await ds.client.get(
+        "/-/indieauth/prefetch", params={"me": "https://simonwillison.net/"}
+    )
+    assert response.json()["started"] is False
+    await asyncio.gather(*_in_flight[ds].values())
+    # Submitting the form now uses the cached discovery
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    assert post_response.status_code == 302
+    assert post_response.headers["location"].startswith(
+        "https://indieauth.simonwillison.net/auth?"
+    )
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "status_code,text", ((503, "Service Unavailable"), (200, "No links here"))
+)
+async def test_discovery_without_endpoint_not_cached(
+    httpx_mock, status_code, text, start_sign_in
+):
+    from datasette_indieauth.discovery import _in_flight, discovery_cache
+
+    httpx_mock.add_response(
+        url="https://simonwillison.net/", status_code=status_code, text=text
+    )
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    ds = Datasette([], memory=True)
+    response = await ds.client.get(
+        "/-/indieauth/prefetch", params={"me": "https://simonwillison.net/"}
+    )
+    assert response.json()["started"] is True
+    await asyncio.gather(*_in_flight[ds].values())
+    assert "https://simonwillison.net/" not in discovery_cache(ds)
+    # Once the homepage is back, signing in fetches it again
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    assert post_response.status_code == 302
+    assert len(httpx_mock.get_requests()) == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_discoveries_share_a_request(httpx_mock):
+    from datasette_indieauth.discovery import discover
+
+    async def profile(request):
+        await asyncio.sleep(0.05)
+        return httpx.Response(
+            200,
+            text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+        )
+
+    httpx_mock.add_callback(profile, url="https://simonwillison.net/")
+    ds = Datasette([], memory=True)
+    results = await asyncio.gather(
+        *(discover(ds, "https://simonwillison.net/") for _ in range(3))
+    )
+    assert len(set(results)) == 1
+    assert len(httpx_mock.get_requests()) == 1
+    # Now cached, so there is nothing to prefetch
+    response = await ds.client.get(
+        "/-/indieauth/prefetch", params={"me": "https://simonwillison.net/"}
+    )
+    assert response.json()["started"] is False
+
+
+@pytest.mark.asyncio
+@pytest.mark.httpx_mock(assert_all_responses_were_requested=False)
+async def test_prefetch_limits_discoveries_in_flight(httpx_mock):
+    from datasette_indieauth.discovery import PREFETCH_MAX_IN_FLIGHT, _in_flight
+
+    release = asyncio.Event()
+
+    async def profile(request):
+        await release.wait()
+        return httpx.Response(200, text="")
+
+    httpx_mock.add_callback(profile, is_reusable=True)
+    ds = Datasette([], memory=True)
+    started = []
+    for i in range(PREFETCH_MAX_IN_FLIGHT + 1):
+        response = await ds.client.get(
+            "/-/indieauth/prefetch",
+            params={"me": "https://user{}.example.com/".format(i)},
+        )
+        started.append(response.json()["started"])
+    assert started == [True] * PREFETCH_MAX_IN_FLIGHT + [False]
+    release.set()
+    await asyncio.gather(*_in_flight[ds].values())
+
+
 async def _get_csrftoken(ds):
     return (await ds.client.get("/-/indieauth")).cookies["ds_csrftoken"]
 
@@ -357,3 +711,42 @@ async def test_menu():
     ds = Datasette()
     index = await ds.client.get("/")
     assert '<li><a href="/-/indieauth">Sign in IndieAuth</a></li>' in index.text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lightweight_forbidden", (None, "403", "redirect"))
+@pytest.mark.parametrize(
+    "path,headers,expected_html",
+    (
+        ("/", {"accept": "text/html,application/xhtml+xml,*/*;q=0.8"}, True),
+        ("/_memory", {"accept": "text/html"}, True),
+        # httpx sends Accept: */* by default, as do most scrapers
+        ("/", {}, False),
+        ("/_memory", {"accept": "application/json"}, False),
+        ("/_memory.json", {}, False),
+        ("/_memory.csv?sql=select+1", {}, False),
+        ("/_memory?sql=select+1&_format=json", {}, False),
+    ),
+)
+async def test_lightweight_forbidden(
+    lightweight_forbidden, path, headers, expected_html
+):
+    plugin_config = {"restrict_access": "https://simonwillison.net/"}
+    if lightweight_forbidden:
+        plugin_config["lightweight_forbidden"] = lightweight_forbidden
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={"plugins": {"datasette-indieauth": plugin_config}},
+    )
+    response = await ds.client.get(path, headers=headers)
+    if expected_html or not lightweight_forbidden:
+        assert response.status_code == 403
+        assert '<form action="/-/indieauth" method="post">' in response.text
+    elif lightweight_forbidden == "redirect":
+        assert response.status_code == 302
+        assert response.headers["location"] == "/-/indieauth"
+    else:
+        assert response.status_code == 403
+        assert response.headers["content-type"] == "application/json; charset=utf-8"
+        assert response.json() == {"ok": False, "error": "Forbidden", "status": 403}
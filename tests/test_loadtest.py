@@ -0,0 +1,112 @@
+from datasette_indieauth import loadtest
+from datasette_indieauth.loadtest import MockProvider, percentile, run_load_test
+import httpx
+import json
+import pytest
+import runpy
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "redirects,expected_outbound",
+    (
+        # GET profile, POST code to authorization_endpoint - the returned
+        # me is the same URL so its discovery comes from the cache
+        (0, {"GET profile": 5, "POST auth": 5}),
+        # Two 301s on the initial GET, then returned me is the /r2 URL
+        (2, {"GET profile": 20, "POST auth": 5}),
+    ),
+)
+async def test_run_load_test(redirects, expected_outbound):
+    results = await run_load_test(
+        users=5, concurrency=2, redirects=redirects, body_size=1024
+    )
+    assert results["successes"] == 5
+    assert results["failures"] == 0
+    assert results["outbound_by_kind"] == expected_outbound
+    assert results["outbound_requests_per_login"] == (
+        sum(expected_outbound.values()) / 5
+    )
+    assert results["p50"] <= results["p95"] <= results["p99"]
+
+
+@pytest.mark.asyncio
+async def test_run_load_test_failures():
+    results = await run_load_test(users=3, failure_rate=1.0)
+    assert results["successes"] == 0
+    assert results["failures"] == 3
+    assert results["p50"] is None
+
+
+@pytest.mark.asyncio
+async def test_run_load_test_seeded_failures():
+    # The same seed fails the same requests
+    results = [
+        await run_load_test(users=10, failure_rate=0.5, latency=0.001, seed=1)
+        for _ in range(2)
+    ]
+    assert 0 < results[0]["failures"] < 10
+    assert results[0]["failures"] == results[1]["failures"]
+
+
+@pytest.mark.asyncio
+async def test_run_load_test_http_errors(monkeypatch):
+    async def simulate_login(browser, provider, n):
+        raise httpx.ConnectError("Connection refused")
+
+    monkeypatch.setattr(loadtest, "simulate_login", simulate_login)
+    results = await run_load_test(users=2)
+    assert results["failures"] == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "data",
+    (
+        {"code": "unknown"},
+        {"code": "abc", "code_verifier": "wrong"},
+    ),
+)
+async def test_mock_provider_rejects_invalid_grant(data):
+    provider = MockProvider()
+    provider.codes["abc"] = {
+        "code_challenge": "challenge",
+        "client_id": "https://example.com/",
+        "redirect_uri": "https://example.com/done",
+        "me": "https://user0.example/",
+    }
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=provider)) as client:
+        response = await client.post("https://auth.example/auth", data=data)
+    assert response.status_code == 400
+    assert response.json() == {"error": "invalid_grant"}
+
+
+def test_main(capsys):
+    loadtest.main(["--users", "2", "--concurrency", "1", "--seed", "1"])
+    results = json.loads(capsys.readouterr().out)
+    assert results["users"] == 2
+    assert results["successes"] == 2
+    assert results["outbound_by_kind"] == {"GET profile": 2, "POST auth": 2}
+
+
+# The module is already imported, which runpy warns about
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_python_m(capsys, monkeypatch):
+    monkeypatch.setattr("sys.argv", ["loadtest", "--help"])
+    with pytest.raises(SystemExit):
+        runpy.run_module("datasette_indieauth.loadtest", run_name="__main__")
+    assert "Load test the datasette-indieauth sign-in flow" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "values,pct,expected",
+    (
+        ([], 50, None),
+        ([3, 1, 2], 50, 2),
+        (list(range(1, 101)), 95, 95),
+        (list(range(1, 101)), 99, 99),
+        ([5], 99, 5),
+    ),
+)
+def test_percentile(values, pct, expected):
+    assert percentile(values, pct) == expected
@@ -0,0 +1,147 @@
+"""
+Allocation budgets for the sign-in flow, measured with tracemalloc against
+the load test's mock provider. Peak is the most memory allocated at once
+during a measurement, retained is what is still allocated afterwards.
+"""
+
+from datasette.app import Datasette
+from datasette_indieauth import utils
+from datasette_indieauth.discovery import discovery_cache
+from datasette_indieauth.loadtest import MockProvider, run_load_test
+from datasette_indieauth.tokens import sign_state
+import gc
+import httpx
+import pytest
+import tracemalloc
+
+# Measured at about 1KB per KB of HTML
+PARSE_PEAK_PER_KB = 2 * 1024
+# Measured at about 3KB per KB: the raw body, the decoded str and the mock
+# transport's copy of the response
+DISCOVER_PEAK_PER_KB = 4 * 1024
+DISCOVER_RETAINED = 16 * 1024
+# Measured at about 2KB. Signing with datasette.sign() instead peaks at about
+# 300KB, most of it zlib's compression state
+BUILD_AUTHORIZATION_URL_PEAK = 16 * 1024
+# Once warmed up, a login keeps only its used state nonce - about 100 bytes
+LOGIN_RETAINED_PER_LOGIN = 1024
+# A batch of logins at LOGIN_CONCURRENCY, plus a share per KB of profile HTML
+# for each login in flight. Measured at about 1.2MB, plus about 1KB per KB
+LOGIN_PEAK = 2 * 1024 * 1024
+LOGIN_PEAK_PER_KB = 2 * 1024
+LOGIN_USERS = 50
+LOGIN_CONCURRENCY = 10
+
+
+class Allocations:
+    "Traces allocations made inside the with block"
+
+    def __enter__(self):
+        gc.collect()
+        tracemalloc.start()
+        self.start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def checkpoint(self):
+        "Returns (retained, peak) so far, after collecting garbage"
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        return current - self.start, peak - self.start
+
+    def __exit__(self, *exc):
+        self.retained, self.peak = self.checkpoint()
+        tracemalloc.stop()
+
+
+def profile_page(size):
+    html = '<link rel="authorization_endpoint" href="https://auth.example/auth">\n'
+    return html + "<!--{}-->".format("x" * (size - len(html) - 7))
+
+
+@pytest.mark.parametrize("size_kb", (64, 256))
+def test_parse_link_rels_memory(size_kb):
+    html = profile_page(size_kb * 1024)
+    # Imports and regex compilation on first use are not per-page costs
+    utils.parse_link_rels(html[:1024])
+    with Allocations() as allocations:
+        rels = utils.parse_link_rels(html)
+        del rels
+    assert allocations.peak / size_kb < PARSE_PEAK_PER_KB
+    assert allocations.retained < 4 * 1024
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size_kb", (64, 512))
+async def test_discover_endpoints_memory(size_kb):
+    provider = MockProvider(body_size=size_kb * 1024)
+    transport = httpx.ASGITransport(app=provider)
+    async with httpx.AsyncClient(transport=transport) as client:
+        await utils.discover_endpoints(provider.profile_url(0), client=client)
+        with Allocations() as allocations:
+            result = await utils.discover_endpoints(
+                provider.profile_url(1), client=client
+            )
+            del result
+    assert allocations.peak / size_kb < DISCOVER_PEAK_PER_KB
+    assert allocations.retained < DISCOVER_RETAINED
+
+
+def test_build_authorization_url_memory():
+    ds = Datasette([], memory=True)
+
+    def build():
+        return utils.build_authorization_url(
+            authorization_endpoint="https://auth.example/auth",
+            client_id="https://datasette.example/-/indieauth",
+            redirect_uri="https://datasette.example/-/indieauth/done",
+            me="https://user.example/",
+            signing_function=lambda bits: sign_state(
+                ds, bits, "datasette-indieauth-state"
+            ),
+        )
+
+    build()
+    with Allocations() as allocations:
+        build()
+    assert allocations.peak < BUILD_AUTHORIZATION_URL_PEAK
+    with Allocations() as allocations:
+        for _ in range(1000):
+            build()
+    assert allocations.retained < 1024
+
+
+def live_clients():
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, httpx.AsyncClient))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("body_kb", (0, 64))
+async def test_login_memory(body_kb):
+    ds = Datasette([], memory=True)
+
+    async def logins():
+        # So every login fetches and parses its profile page again
+        discovery_cache(ds).clear()
+        results = await run_load_test(
+            users=LOGIN_USERS,
+            concurrency=LOGIN_CONCURRENCY,
+            body_size=body_kb * 1024,
+            datasette=ds,
+        )
+        assert results["successes"] == LOGIN_USERS
+        assert results["outbound_by_kind"]["GET profile"] == LOGIN_USERS
+
+    # Warm up imports, pools and caches, then measure logging them in again
+    await logins()
+    clients = live_clients()
+    with Allocations() as allocations:
+        await logins()
+        first_retained, _ = allocations.checkpoint()
+        await logins()
+    per_login = (allocations.retained - first_retained) / LOGIN_USERS
+    assert per_login < LOGIN_RETAINED_PER_LOGIN
+    assert allocations.peak < (
+        LOGIN_PEAK + LOGIN_CONCURRENCY * body_kb * LOGIN_PEAK_PER_KB
+    )
+    assert live_clients() == clients
@@ -0,0 +1,113 @@
+from datasette.app import Datasette
+from datasette_indieauth.permissions import PermissionRules, cached_plugin_config
+import pytest
+
+RULES = [
+    {
+        "actors": ["https://simonwillison.net/"],
+        "actions": ["view-table", "execute-sql"],
+        "database": "private",
+    },
+    {
+        "domains": ["example.com"],
+        "actions": "view-table",
+        "database": "private",
+        "table": "public_table",
+    },
+    {
+        "actors": "*",
+        "actions": ["view-database"],
+        "database": "private",
+        "allow": False,
+    },
+    {"domains": "example.org", "actions": ["*"], "allow": False},
+]
+
+
+@pytest.mark.parametrize(
+    "me,action,resource,expected",
+    (
+        ("https://simonwillison.net/", "view-table", ("private", "t"), True),
+        ("https://simonwillison.net/", "execute-sql", "private", True),
+        ("https://simonwillison.net/", "execute-sql", "other", None),
+        ("https://simonwillison.net/", "view-database", "private", False),
+        ("https://simonwillison.net/", "view-database", "other", None),
+        # Rules for a database never match instance-wide checks
+        ("https://simonwillison.net/", "execute-sql", None, None),
+        ("https://example.com/", "view-table", ("private", "public_table"), True),
+        ("https://www.example.com/", "view-table", ("private", "public_table"), True),
+        ("https://notexample.com/", "view-table", ("private", "public_table"), None),
+        ("https://example.com/", "view-table", ("private", "t"), None),
+        ("https://example.com/", "execute-sql", "private", None),
+        ("https://example.org/", "view-instance", None, False),
+        ("https://example.org/", "view-table", ("other", "t"), False),
+        ("https://example.org/", "view-database", "private", False),
+    ),
+)
+def test_permission_rules(me, action, resource, expected):
+    rules = PermissionRules(RULES)
+    assert rules.decide(me, action, resource) is expected
+
+
+def test_permission_rules_decision_cache():
+    rules = PermissionRules(RULES, cache_size=2)
+    for _ in range(3):
+        assert rules.decide(
+            "https://simonwillison.net/", "view-table", ["private", "t"]
+        )
+    assert (rules.hits, rules.misses) == (2, 1)
+    rules.decide("https://a.com/", "view-table", ("private", "t"))
+    rules.decide("https://b.com/", "view-table", ("private", "t"))
+    # The first decision has now been evicted
+    rules.decide("https://simonwillison.net/", "view-table", ("private", "t"))
+    assert (rules.hits, rules.misses) == (2, 4)
+
+
+@pytest.mark.asyncio
+async def test_permissions_in_datasette():
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={"plugins": {"datasette-indieauth": {"permissions": RULES}}},
+    )
+    db = ds.add_memory_database("private")
+    await db.execute_write("create table if not exists t (id integer primary key)")
+
+    def cookies(me):
+        return {"ds_actor": ds.sign({"a": {"me": me}}, "actor")}
+
+    assert (await ds.client.get("/private")).status_code == 200
+    assert (await ds.client.get("/private/t")).status_code == 200
+    response = await ds.client.get(
+        "/private", cookies=cookies("https://simonwillison.net/")
+    )
+    assert response.status_code == 403
+    response = await ds.client.get(
+        "/private/t", cookies=cookies("https://simonwillison.net/")
+    )
+    assert response.status_code == 200
+    response = await ds.client.get("/", cookies=cookies("https://example.org/"))
+    assert response.status_code == 403
+
+
+def test_config_changes_replace_rules():
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={"plugins": {"datasette-indieauth": {"permissions": RULES}}},
+    )
+    config = cached_plugin_config(ds)
+    rules = config.rules
+    assert rules.decide("https://example.org/", "view-instance", None) is False
+    assert cached_plugin_config(ds).rules is rules
+    ds._metadata_local["plugins"]["datasette-indieauth"]["permissions"] = RULES[:1]
+    # Config is only re-read once check_interval has passed
+    assert cached_plugin_config(ds).rules is rules
+    config.checked -= config.check_interval
+    assert cached_plugin_config(ds).rules is not rules
+    assert (
+        cached_plugin_config(ds).rules.decide(
+            "https://example.org/", "view-instance", None
+        )
+        is None
+    )
@@ -0,0 +1,153 @@
+from datasette.app import Datasette
+from datasette_indieauth import _background_tasks, shutdown
+from datasette_indieauth import popular
+from datasette_indieauth.popular import (
+    HeavyHitters,
+    popular_endpoints,
+    warm_connections,
+    warm_periodically,
+)
+import asyncio
+import httpx
+import pytest
+import random
+
+
+def test_heavy_hitters():
+    hitters = HeavyHitters(capacity=5)
+    rng = random.Random(0)
+    for _ in range(1000):
+        if rng.random() < 0.6:
+            hitters.add(rng.choice(["a", "b", "c"]))
+        else:
+            hitters.add(rng.randint(0, 10000))
+    assert len(hitters.counts) == 5
+    assert sorted(hitters.top(3)) == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_warm_connections(httpx_mock):
+    httpx_mock.add_response(url="https://a.example/auth", method="HEAD")
+
+    def refuse(request):
+        raise httpx.ConnectError("Connection refused")
+
+    httpx_mock.add_callback(refuse, url="https://b.example/auth", method="HEAD")
+    ds = Datasette([], memory=True)
+    hitters = popular_endpoints(ds)
+    for url, count in (
+        ("https://a.example/auth", 5),
+        ("https://b.example/auth", 3),
+        ("https://c.example/auth", 1),
+    ):
+        for _ in range(count):
+            hitters.add(url)
+    # Errors are ignored, only the top 2 are contacted
+    assert await warm_connections(ds, 2) == [
+        "https://a.example/auth",
+        "https://b.example/auth",
+    ]
+    assert len(httpx_mock.get_requests()) == 2
+
+
+@pytest.mark.asyncio
+async def test_warm_connections_invalid_url(httpx_mock):
+    httpx_mock.add_response(url="https://a.example/auth", method="HEAD")
+    ds = Datasette([], memory=True)
+    popular_endpoints(ds).add("https://a.example:abc/auth")
+    popular_endpoints(ds).add("https://a.example/auth")
+    await warm_connections(ds, 2)
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+async def test_warm_periodically_survives_errors(monkeypatch):
+    calls = []
+
+    async def warm_connections(datasette, n):
+        calls.append(n)
+        if len(calls) == 1:
+            raise RuntimeError("Unexpected")
+        # Still warming when the task is cancelled
+        await asyncio.sleep(5)
+
+    monkeypatch.setattr(popular, "warm_connections", warm_connections)
+    task = asyncio.ensure_future(warm_periodically(Datasette([], memory=True), 3, 0.01))
+    for _ in range(50):
+        if len(calls) >= 2:
+            break
+        await asyncio.sleep(0.01)
+    assert len(calls) >= 2
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "exchange",
+    (
+        {"status_code": 400, "json": {"error": "invalid_grant"}},
+        # The returned me does not resolve to the same authorization_endpoint
+        {"text": "me=https%3A%2F%2Fsimonwillison.net%2Fother"},
+    ),
+)
+async def test_failed_sign_in_does_not_count_endpoint(
+    httpx_mock, exchange, start_sign_in, finish_sign_in
+):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth", method="POST", **exchange
+    )
+    if "text" in exchange:
+        httpx_mock.add_response(url="https://simonwillison.net/other", text="")
+    ds = Datasette([], memory=True)
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    response = await finish_sign_in(ds, post_response)
+    assert "ds_actor" not in response.cookies
+    assert popular_endpoints(ds).top(3) == []
+
+
+@pytest.mark.asyncio
+async def test_done_records_authorization_endpoint(
+    httpx_mock, start_sign_in, finish_sign_in
+):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        text='<link rel="authorization_endpoint" href="https://indieauth.simonwillison.net/auth">',
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth",
+        method="POST",
+        text="me=https%3A%2F%2Fsimonwillison.net%2F",
+    )
+    httpx_mock.add_response(
+        url="https://indieauth.simonwillison.net/auth", method="HEAD", is_reusable=True
+    )
+    ds = Datasette(
+        [],
+        memory=True,
+        metadata={
+            "plugins": {
+                "datasette-indieauth": {
+                    "warm_connections": 3,
+                    "warm_connections_interval": 0.05,
+                }
+            }
+        },
+    )
+    await ds.invoke_startup()
+    post_response = await start_sign_in(ds, "https://simonwillison.net/")
+    await finish_sign_in(ds, post_response)
+    assert popular_endpoints(ds).top(3) == ["https://indieauth.simonwillison.net/auth"]
+    # The background task keeps a connection to it warm
+    for _ in range(50):
+        if any(r.method == "HEAD" for r in httpx_mock.get_requests()):
+            break
+        await asyncio.sleep(0.01)
+    assert any(r.method == "HEAD" for r in httpx_mock.get_requests())
+    await shutdown(ds)
+    assert ds not in _background_tasks
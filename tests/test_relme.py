@@ -0,0 +1,270 @@
+from datasette.app import Datasette
+from datasette_indieauth import utils
+from datasette_indieauth.discovery import discovery_cache, rel_me_cache
+from datasette_indieauth.relme import find_rel_me_provider, rel_me_links
+from datasette_indieauth.tokens import unsign_cookie
+import asyncio
+import httpx
+import pytest
+import time
+import urllib
+
+ME = "https://simonwillison.net/"
+RELME_CONFIG = {"plugins": {"datasette-indieauth": {"relmeauth": True}}}
+
+
+def page(auth=None, rel_me=()):
+    html = ""
+    if auth:
+        html += '<link rel="authorization_endpoint" href="{}">'.format(auth)
+    for url in rel_me:
+        html += '<a rel="me" href="{}">Me</a>'.format(url)
+    return html
+
+
+def test_parse_link_rels_includes_a_rel_me():
+    assert utils.parse_link_rels(
+        '<a rel="me nofollow" href="/github"><a rel="author" href="/x">'
+        '<link rel="me" href="https://example.com/">'
+    ) == [
+        {"rel": "me nofollow", "href": "/github"},
+        {"rel": "me", "href": "https://example.com/"},
+    ]
+
+
+def test_rel_me_urls():
+    rels = [
+        {"rel": "me", "href": "/github"},
+        {"rel": "Me nofollow", "href": "https://example.com/"},
+        {"rel": "me", "href": "https://example.com/"},
+        {"rel": "me", "href": "mailto:simon@example.com"},
+        {"rel": "me"},
+        {"rel": "me", "href": "https://a.example:abc/"},
+        {"rel": "authorization_endpoint", "href": "https://auth.example.com/"},
+    ]
+    assert utils.rel_me_urls(rels, ME) == [
+        "https://simonwillison.net/github",
+        "https://example.com/",
+    ]
+
+
+@pytest.mark.parametrize(
+    "url,other_url,expected",
+    (
+        ("https://simonwillison.net", "https://simonwillison.net/", True),
+        ("http://SimonWillison.net/", "https://simonwillison.net/", True),
+        ("https://simonwillison.net/about", "https://simonwillison.net/", False),
+        ("https://simonwillison.net.evil.com/", "https://simonwillison.net/", False),
+    ),
+)
+def test_same_profile(url, other_url, expected):
+    assert utils.same_profile(url, other_url) is expected
+
+
+@pytest.mark.asyncio
+async def test_relmeauth_sign_in(httpx_mock, start_sign_in, finish_sign_in):
+    httpx_mock.add_response(
+        url=ME,
+        text=page(
+            rel_me=(
+                "https://no-backlink.example.com/",
+                "https://no-auth.example.com/",
+                "https://provider.example.com/simonw",
+            )
+        ),
+    )
+    httpx_mock.add_response(
+        url="https://no-backlink.example.com/",
+        text=page(auth="https://no-backlink.example.com/auth"),
+    )
+    httpx_mock.add_response(url="https://no-auth.example.com/", text=page(rel_me=[ME]))
+    httpx_mock.add_response(
+        url="https://provider.example.com/simonw",
+        text=page(
+            auth="https://provider.example.com/auth",
+            rel_me=["http://simonwillison.net"],
+        ),
+    )
+    httpx_mock.add_response(
+        url="https://provider.example.com/auth",
+        method="POST",
+        json={"me": "https://provider.example.com/simonw"},
+    )
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    response = await start_sign_in(ds, ME)
+    assert response.status_code == 302
+    location = response.headers["location"]
+    assert location.startswith("https://provider.example.com/auth?")
+    bits = dict(urllib.parse.parse_qsl(location.split("?", 1)[1]))
+    assert bits["me"] == "https://provider.example.com/simonw"
+    cookie = response.cookies["ds_indieauth"]
+    cookie_bits = unsign_cookie(ds, cookie, "datasette-indieauth-cookie")
+    assert cookie_bits["m"] == ME
+    assert cookie_bits["p"] == "https://provider.example.com/simonw"
+
+    done = await finish_sign_in(ds, response)
+    assert done.status_code == 302
+    assert ds.unsign(done.cookies["ds_actor"], "actor")["a"] == {
+        "me": ME,
+        "display": "simonwillison.net",
+        "relmeauth_provider": "https://provider.example.com/simonw",
+    }
+
+
+@pytest.mark.asyncio
+async def test_relmeauth_returned_me_must_match_provider(
+    httpx_mock, start_sign_in, finish_sign_in
+):
+    # Fetched again to check the returned me, as it has no authorization_endpoint
+    httpx_mock.add_response(
+        url=ME, text=page(rel_me=["https://provider.example.com/"]), is_reusable=True
+    )
+    httpx_mock.add_response(
+        url="https://provider.example.com/",
+        text=page(auth="https://provider.example.com/auth", rel_me=[ME]),
+    )
+    httpx_mock.add_response(
+        url="https://provider.example.com/auth",
+        method="POST",
+        json={"me": ME},
+    )
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    response = await start_sign_in(ds, ME)
+    done = await finish_sign_in(ds, response)
+    assert "ds_actor" not in done.cookies
+    assert '<p class="message-error">&#34;me&#34; value' in done.text
+
+
+@pytest.mark.asyncio
+async def test_relmeauth_returned_me_must_be_the_provider_profile(
+    httpx_mock, start_sign_in, finish_sign_in
+):
+    provider = "https://provider.example.com/simonw"
+    attacker = "https://provider.example.com/attacker"
+    httpx_mock.add_response(url=ME, text=page(rel_me=[provider]))
+    httpx_mock.add_response(
+        url=provider, text=page(auth="https://provider.example.com/auth", rel_me=[ME])
+    )
+    # Another account on the same provider, with the same authorization_endpoint
+    httpx_mock.add_response(
+        url=attacker, text=page(auth="https://provider.example.com/auth")
+    )
+    httpx_mock.add_response(
+        url="https://provider.example.com/auth",
+        method="POST",
+        json={"me": attacker},
+    )
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    response = await start_sign_in(ds, ME)
+    done = await finish_sign_in(ds, response)
+    assert "ds_actor" not in done.cookies
+    assert "did not match the rel=me profile" in done.text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "metadata,expected_error",
+    (
+        ({}, "no authorization_endpoint found"),
+        (RELME_CONFIG, "no authorization_endpoint or verified rel=me link found"),
+    ),
+)
+async def test_relmeauth_no_verified_link(
+    httpx_mock, metadata, expected_error, start_sign_in
+):
+    httpx_mock.add_response(
+        url=ME,
+        text=page(rel_me=["https://other.example.com/", "https://down.example.com/"]),
+    )
+    if metadata:
+        # Has an authorization_endpoint but does not link back
+        httpx_mock.add_response(
+            url="https://other.example.com/",
+            text=page(auth="https://other.example.com/auth"),
+        )
+        httpx_mock.add_exception(
+            httpx.ConnectError("Connection refused"), url="https://down.example.com/"
+        )
+    ds = Datasette([], memory=True, metadata=metadata)
+    response = await start_sign_in(ds, ME)
+    assert response.status_code == 200
+    assert expected_error in response.text
+
+
+@pytest.mark.asyncio
+async def test_relmeauth_profile_unavailable_on_second_fetch(httpx_mock, start_sign_in):
+    httpx_mock.add_response(url=ME, text=page(rel_me=["https://other.example.com/"]))
+    httpx_mock.add_exception(httpx.ConnectError("Connection refused"), url=ME)
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    # The rel=me links expire straight away, so the profile is fetched again
+    rel_me_cache(ds).ttl = 0
+    response = await start_sign_in(ds, ME)
+    assert response.status_code == 200
+    assert "no authorization_endpoint or verified rel=me link found" in response.text
+
+
+@pytest.mark.asyncio
+async def test_rel_me_links_rediscovers_cached_profile(httpx_mock):
+    httpx_mock.add_response(url=ME, text=page(rel_me=["https://other.example.com/"]))
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    # Discovered before its rel=me links were collected
+    discovery_cache(ds).set(ME, (ME, None, None))
+    assert await rel_me_links(ds, ME) == ["https://other.example.com/"]
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.httpx_mock(assert_all_responses_were_requested=False)
+async def test_find_rel_me_provider_cancels_remaining_checks(httpx_mock):
+    slow = ["https://slow{}.example.com/".format(i) for i in range(3)]
+    httpx_mock.add_response(
+        url=ME, text=page(rel_me=slow + ["https://fast.example.com/"])
+    )
+    cancelled = []
+
+    async def slow_page(request):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(str(request.url))
+            raise
+        return httpx.Response(200, text="")
+
+    for url in slow:
+        httpx_mock.add_callback(slow_page, url=url)
+    httpx_mock.add_response(
+        url="https://fast.example.com/",
+        text=page(auth="https://fast.example.com/auth", rel_me=[ME]),
+    )
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    start = time.perf_counter()
+    assert await find_rel_me_provider(ds, ME) == (
+        "https://fast.example.com/",
+        "https://fast.example.com/auth",
+    )
+    assert time.perf_counter() - start < 1
+    assert sorted(cancelled) == slow
+
+
+@pytest.mark.asyncio
+async def test_find_rel_me_provider_bounded_fan_out(httpx_mock):
+    links = ["https://site{}.example.com/".format(i) for i in range(6)]
+    httpx_mock.add_response(url=ME, text=page(rel_me=links))
+    running = []
+    max_running = 0
+
+    async def profile(request):
+        nonlocal max_running
+        running.append(request)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.05)
+        running.remove(request)
+        return httpx.Response(200, text=page(rel_me=[ME]))
+
+    for url in links:
+        httpx_mock.add_callback(profile, url=url)
+    ds = Datasette([], memory=True, metadata=RELME_CONFIG)
+    # None of them have an authorization_endpoint
+    assert await find_rel_me_provider(ds, ME, fan_out=2) is None
+    assert len(httpx_mock.get_requests()) == 7
+    assert max_running == 2
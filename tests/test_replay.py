@@ -0,0 +1,131 @@
+from datasette.app import Datasette
+from datasette.database import Database
+from datasette_indieauth.replay import (
+    DatabaseReplayGuard,
+    ReplayGuard,
+    ReplayGuardError,
+)
+from datasette_indieauth.tokens import sign_cookie, sign_state
+from datasette_indieauth.utils import challenge_verifier_pair
+import pytest
+import secrets
+import sqlite3
+import time
+
+
+def test_replay_guard():
+    now = [1000.0]
+    guard = ReplayGuard(ttl=100, slots=10, timer=lambda: now[0])
+    assert guard.consume("a")
+    assert not guard.consume("a")
+    now[0] += 55
+    assert guard.consume("b")
+    assert not guard.consume("a")
+    # a is remembered for at least ttl seconds
+    now[0] += 44
+    assert not guard.consume("a")
+    now[0] += 20
+    assert guard.consume("a")
+    # b was used 64 seconds ago
+    assert not guard.consume("b")
+
+
+def test_replay_guard_memory_is_bounded():
+    now = [0.0]
+    guard = ReplayGuard(ttl=10, slots=10, timer=lambda: now[0])
+    for i in range(1000):
+        now[0] = i / 10
+        assert guard.consume(i)
+    # Only around ttl seconds of values are retained
+    assert len(guard) <= 110
+    # A long idle period clears everything
+    now[0] += 1000
+    guard.consume("x")
+    assert len(guard) == 1
+
+
+@pytest.mark.asyncio
+async def test_database_replay_guard_is_shared():
+    ds = Datasette([], memory=True)
+    memory_name = secrets.token_hex()
+    ds.add_database(Database(ds, memory_name=memory_name), name="auth")
+    # A second instance stands in for another worker process
+    ds2 = Datasette([], memory=True)
+    ds2.add_database(Database(ds2, memory_name=memory_name), name="auth")
+    guard = DatabaseReplayGuard(ds, "auth")
+    other = DatabaseReplayGuard(ds2, "auth")
+    assert await guard.consume("a")
+    assert not await other.consume("a")
+    assert await other.consume("b")
+    assert not await guard.consume("b")
+    # Expired values are purged
+    other.ttl = -1
+    assert await other.consume("c")
+    other.ttl = 600
+    other.purged = None
+    assert await other.consume("d")
+    rows = (
+        await ds.get_database("auth").execute(
+            "select value from indieauth_used_states order by value"
+        )
+    ).rows
+    assert [row[0] for row in rows] == ["a", "b", "d"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("immutable", (False, True))
+async def test_database_replay_guard_misconfigured(tmpdir, immutable):
+    ds = Datasette([], memory=True)
+    if immutable:
+        path = str(tmpdir / "auth.db")
+        sqlite3.connect(path).close()
+        ds.add_database(Database(ds, path=path, is_mutable=False), name="auth")
+    guard = DatabaseReplayGuard(ds, "auth")
+    with pytest.raises(ReplayGuardError) as ex:
+        await guard.consume("a")
+    expected = "AssertionError" if immutable else "KeyError"
+    assert str(ex.value) == (
+        'replay_guard database "auth" could not be written to: {}'.format(expected)
+    )
+
+
+@pytest.mark.asyncio
+async def test_misconfigured_replay_guard_error_page(make_datasette):
+    ds = make_datasette(replay_guard={"database": "missing"})
+    state = sign_state(
+        ds,
+        {
+            "a": "https://auth.example.com/",
+            "n": "0123456789abcdef",
+            "t": int(time.time()),
+        },
+        "datasette-indieauth-state",
+    )
+    _, verifier = challenge_verifier_pair()
+    cookie = sign_cookie(
+        ds, verifier, "https://example.com/", "datasette-indieauth-cookie"
+    )
+    response = await ds.client.get(
+        "/-/indieauth/done",
+        params={"state": state, "code": "123"},
+        cookies={"ds_indieauth": cookie},
+    )
+    assert response.status_code == 500
+    assert (
+        '<p class="message-error">Could not check this sign-in attempt: '
+        "replay_guard database &#34;missing&#34; could not be written to: KeyError"
+    ) in response.text
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("missing", ("n", "t"))
+async def test_state_without_nonce_or_timestamp(missing):
+    ds = Datasette([], memory=True)
+    state_bits = {"a": "https://auth.example.com/", "n": "1", "t": int(time.time())}
+    state_bits.pop(missing)
+    response = await ds.client.get(
+        "/-/indieauth/done",
+        params={"state": ds.sign(state_bits, "datasette-indieauth-state")},
+    )
+    assert response.status_code == 400
+    assert '<p class="message-error">Invalid state</p>' in response.text
@@ -0,0 +1,191 @@
+from datasette.app import Datasette
+from datasette_indieauth.discovery import http_client, resolver
+from datasette_indieauth.resolver import (
+    PinnedNetworkBackend,
+    PinnedTransport,
+    Resolver,
+    UnsafeAddressError,
+    is_public_address,
+)
+import httpcore
+import httpx
+import pytest
+import socket
+
+
+@pytest.mark.parametrize(
+    "address,expected",
+    (
+        ("93.184.215.14", True),
+        ("2606:2800:21f:cb07:6820:80da:af6b:8b2c", True),
+        ("127.0.0.1", False),
+        ("10.0.0.5", False),
+        ("192.168.1.1", False),
+        ("169.254.169.254", False),
+        ("0.0.0.0", False),
+        ("::1", False),
+        ("fe80::1", False),
+        ("fd00::1", False),
+        ("::ffff:127.0.0.1", False),
+        ("224.0.0.1", False),
+    ),
+)
+def test_is_public_address(address, expected):
+    assert is_public_address(address) is expected
+
+
+def fake_getaddrinfo(answers):
+    calls = []
+
+    async def getaddrinfo(host, port):
+        calls.append(host)
+        if host not in answers:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))
+            for address in answers[host]
+        ]
+
+    return getaddrinfo, calls
+
+
+@pytest.mark.asyncio
+async def test_resolver_caches_and_checks():
+    getaddrinfo, calls = fake_getaddrinfo(
+        {
+            "example.com": ["93.184.215.14", "93.184.215.14"],
+            "internal.example.com": ["10.0.0.5"],
+            "mixed.example.com": ["93.184.215.14", "127.0.0.1"],
+        }
+    )
+    resolver = Resolver(getaddrinfo=getaddrinfo)
+    assert await resolver.resolve("example.com", 443) == ["93.184.215.14"]
+    assert await resolver.resolve("example.com", 443) == ["93.184.215.14"]
+    assert calls == ["example.com"]
+    for host in ("internal.example.com", "mixed.example.com"):
+        # Rejected every time, including from the cache
+        for _ in range(2):
+            with pytest.raises(UnsafeAddressError):
+                await resolver.resolve(host, 443)
+    assert calls.count("internal.example.com") == 1
+    with pytest.raises(httpcore.ConnectError) as ex:
+        await resolver.resolve("missing.example.com", 443)
+    assert "Could not resolve missing.example.com" in str(ex.value)
+
+
+class RecordingBackend(httpcore.AsyncNetworkBackend):
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.connections = []
+
+    async def connect_tcp(self, host, port, **kwargs):
+        self.connections.append((host, port))
+        if host in self.failing:
+            raise httpcore.ConnectError("Connection refused")
+        return "stream"
+
+    async def connect_unix_socket(self, path, **kwargs):
+        self.connections.append(path)
+        return "unix stream"
+
+    async def sleep(self, seconds):
+        self.connections.append(seconds)
+
+
+@pytest.mark.asyncio
+async def test_connections_are_pinned_to_checked_address():
+    getaddrinfo, calls = fake_getaddrinfo(
+        {"example.com": ["93.184.215.14", "93.184.215.15"]}
+    )
+    inner = RecordingBackend(failing=("93.184.215.14",))
+    backend = PinnedNetworkBackend(Resolver(getaddrinfo=getaddrinfo), backend=inner)
+    assert await backend.connect_tcp("example.com", 443) == "stream"
+    assert await backend.connect_tcp("example.com", 443) == "stream"
+    # Connects to the IP addresses, trying the next if one fails
+    assert (
+        inner.connections
+        == [
+            ("93.184.215.14", 443),
+            ("93.184.215.15", 443),
+        ]
+        * 2
+    )
+    assert calls == ["example.com"]
+
+
+@pytest.mark.asyncio
+async def test_all_addresses_fail():
+    getaddrinfo, calls = fake_getaddrinfo(
+        {"example.com": ["93.184.215.14", "93.184.215.15"]}
+    )
+    inner = RecordingBackend(failing=("93.184.215.14", "93.184.215.15"))
+    backend = PinnedNetworkBackend(Resolver(getaddrinfo=getaddrinfo), backend=inner)
+    with pytest.raises(httpcore.ConnectError):
+        await backend.connect_tcp("example.com", 443)
+    assert len(inner.connections) == 2
+    # Unix sockets and sleeps are passed through unchanged
+    assert await backend.connect_unix_socket("/tmp/socket") == "unix stream"
+    await backend.sleep(0.5)
+    assert inner.connections[2:] == ["/tmp/socket", 0.5]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "allow,allowed",
+    (
+        (None, []),
+        (True, ["internal.example.com", "other.example.com", "ipv6.example.com"]),
+        (["Internal.example.com"], ["internal.example.com"]),
+        (["10.0.0.0/8"], ["internal.example.com"]),
+        (["192.168.1.0/24", "fd00::/8"], ["other.example.com", "ipv6.example.com"]),
+    ),
+)
+async def test_resolver_allow(allow, allowed):
+    getaddrinfo, calls = fake_getaddrinfo(
+        {
+            "internal.example.com": ["10.0.0.5"],
+            "other.example.com": ["192.168.1.1"],
+            "ipv6.example.com": ["fd00::1"],
+        }
+    )
+    resolver = Resolver(getaddrinfo=getaddrinfo, allow=allow)
+    for host in ("internal.example.com", "other.example.com", "ipv6.example.com"):
+        if host in allowed:
+            assert await resolver.resolve(host, 443)
+        else:
+            with pytest.raises(UnsafeAddressError):
+                await resolver.resolve(host, 443)
+
+
+@pytest.mark.asyncio
+async def test_transport_refuses_private_addresses():
+    async with httpx.AsyncClient(transport=PinnedTransport(Resolver())) as client:
+        with pytest.raises(httpx.ConnectError) as ex:
+            await client.get("http://localhost:8001/")
+    assert "localhost resolves to a non-public address" in str(ex.value)
+
+
+def test_shared_client_uses_resolver(monkeypatch):
+    for key in ("HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY"):
+        monkeypatch.delenv(key, raising=False)
+        monkeypatch.delenv(key.lower(), raising=False)
+    ds = Datasette([], memory=True)
+    client = http_client(ds)
+    transport = client._transport
+    assert isinstance(transport, PinnedTransport)
+    assert transport._pool._network_backend.resolver is resolver(ds)
+
+
+@pytest.mark.parametrize(
+    "setting,allow_all,allowed_hosts",
+    ((None, False, set()), (True, True, set()), (["localhost"], False, {"localhost"})),
+)
+def test_allow_private_addresses_setting(
+    make_datasette, setting, allow_all, allowed_hosts
+):
+    if setting is None:
+        ds = make_datasette()
+    else:
+        ds = make_datasette(allow_private_addresses=setting)
+    assert resolver(ds).allow_all is allow_all
+    assert resolver(ds).allowed_hosts == allowed_hosts
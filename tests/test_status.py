@@ -0,0 +1,185 @@
+from datasette.app import Datasette
+from datasette_indieauth.cache import TTLCache
+from datasette_indieauth.discovery import (
+    discover,
+    discovery_cache,
+    hcard_cache,
+    host_tracker,
+    redirect_cache,
+    rel_me_cache,
+)
+from datasette_indieauth.status import (
+    cache_status,
+    hosts_status,
+    invalidate_url,
+    pool_status,
+)
+from types import SimpleNamespace
+import pytest
+
+PROFILE = '<link rel="authorization_endpoint" href="https://auth.example.com/auth">'
+
+
+def root_cookies(ds):
+    return {"ds_actor": ds.sign({"a": {"id": "root"}}, "actor")}
+
+
+def test_cache_status():
+    now = [1000.0]
+    cache = TTLCache(maxsize=10, ttl=60, timer=lambda: now[0])
+    for i in range(4):
+        cache.set("https://example.com/{}".format(i), i)
+    now[0] += 10
+    cache.get("https://example.com/0")
+    cache.get("https://example.com/missing")
+    status = cache_status(cache, top=2, now=now[0])
+    assert status == {
+        "size": 4,
+        "maxsize": 10,
+        "ttl": 60,
+        "hits": 1,
+        "misses": 1,
+        "hit_rate": 0.5,
+        "top": [
+            {"key": "https://example.com/0", "expires_in": 50.0},
+            {"key": "https://example.com/3", "expires_in": 50.0},
+        ],
+    }
+
+
+def test_cache_status_dns_keys():
+    cache = TTLCache(maxsize=10)
+    cache.set(("example.com", 443), ["93.184.215.14"])
+    assert cache_status(cache)["top"] == [
+        {"key": "example.com:443", "expires_in": None}
+    ]
+
+
+def test_hosts_status_top():
+    ds = Datasette([], memory=True)
+    for i in range(3):
+        host_tracker(ds).record("{}.example.com".format(i), 0.1)
+    hosts = hosts_status(ds, top=2)
+    assert len(hosts) == 2
+    assert all(host["samples"] == 1 for host in hosts.values())
+
+
+def test_pool_status():
+    def connection(origin, idle):
+        return SimpleNamespace(_origin=origin, is_idle=lambda: idle)
+
+    pool = SimpleNamespace(
+        connections=[
+            connection("https://a.example.com:443", True),
+            connection("https://a.example.com:443", False),
+            connection("https://b.example.com:443", True),
+        ],
+        _max_connections=100,
+        _requests=[object()],
+    )
+    client = SimpleNamespace(_transport=SimpleNamespace(_pool=pool))
+    assert pool_status(client) == {
+        "connections": 3,
+        "max_connections": 100,
+        "queued_requests": 1,
+        "hosts": {
+            "https://a.example.com:443": {"connections": 2, "idle": 1},
+            "https://b.example.com:443": {"connections": 1, "idle": 1},
+        },
+    }
+    assert pool_status(SimpleNamespace()) is None
+
+
+@pytest.mark.asyncio
+async def test_invalidate_url(httpx_mock):
+    httpx_mock.add_response(
+        url="https://example.com/",
+        status_code=301,
+        headers={"location": "https://www.example.com/"},
+    )
+    httpx_mock.add_response(url="https://www.example.com/", text=PROFILE)
+    ds = Datasette([], memory=True)
+    await discover(ds, "https://example.com/")
+    assert "https://example.com/" in redirect_cache(ds)
+    assert invalidate_url(ds, "https://example.com") == ["discovery", "redirects"]
+    assert "https://example.com/" not in discovery_cache(ds)
+    assert "https://example.com/" not in redirect_cache(ds)
+    assert invalidate_url(ds, "https://example.com/") == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ("/-/indieauth/status", "/-/indieauth/status.json"))
+async def test_status_requires_permission(path):
+    ds = Datasette([], memory=True)
+    response = await ds.client.get(path)
+    assert response.status_code == 403
+    response = await ds.client.post(path, data={"action": "flush", "cache": "dns"})
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_status_page(httpx_mock):
+    httpx_mock.add_response(url="https://example.com/", text=PROFILE)
+    ds = Datasette([], memory=True)
+    await discover(ds, "https://example.com/")
+    await discover(ds, "https://example.com/")
+    cookies = root_cookies(ds)
+    data = (await ds.client.get("/-/indieauth/status.json", cookies=cookies)).json()
+    assert set(data) == {"caches", "pool", "in_flight_discoveries", "hosts"}
+    discovery = data["caches"]["discovery"]
+    assert discovery["size"] == 1
+    assert discovery["hit_rate"] == 0.5
+    assert discovery["top"][0]["key"] == "https://example.com/"
+    assert 0 < discovery["top"][0]["expires_in"] <= discovery["ttl"]
+    assert data["pool"]["max_connections"] == 100
+    assert data["in_flight_discoveries"] == {"count": 0, "urls": []}
+    assert data["hosts"]["example.com"]["samples"] == 1
+    assert data["hosts"]["example.com"]["error_rate"] == 0
+
+    response = await ds.client.get("/-/indieauth/status", cookies=cookies)
+    assert response.status_code == 200
+    assert "<h1>IndieAuth status</h1>" in response.text
+    assert '<input type="hidden" name="cache" value="discovery">' in response.text
+    assert "<td>example.com</td>" in response.text
+
+
+@pytest.mark.asyncio
+async def test_status_actions(httpx_mock):
+    httpx_mock.add_response(url="https://example.com/", text=PROFILE)
+    ds = Datasette([], memory=True)
+    await discover(ds, "https://example.com/")
+    cookies = root_cookies(ds)
+    page = await ds.client.get("/-/indieauth/status", cookies=cookies)
+    cookies["ds_csrftoken"] = page.cookies["ds_csrftoken"]
+
+    async def post(path, **data):
+        data["csrftoken"] = cookies["ds_csrftoken"]
+        return await ds.client.post(path, data=data, cookies=cookies)
+
+    response = await post(
+        "/-/indieauth/status.json", action="invalidate", url="https://example.com/"
+    )
+    assert response.json() == {
+        "ok": True,
+        "message": "Invalidated https://example.com/: discovery",
+    }
+    assert "https://example.com/" not in discovery_cache(ds)
+
+    response = await post("/-/indieauth/status.json", action="flush", cache="nope")
+    assert response.status_code == 400
+    assert response.json()["ok"] is False
+
+    discovery_cache(ds).set("https://example.com/", ("x", "y", None))
+    response = await post("/-/indieauth/status", action="flush", cache="discovery")
+    assert response.status_code == 302
+    assert response.headers["location"] == "/-/indieauth/status"
+    assert len(discovery_cache(ds)) == 0
+
+
+def test_invalidate_url_parsed_pages():
+    ds = Datasette([], memory=True)
+    hcard_cache(ds).set("https://example.com/", {"name": "Example"})
+    rel_me_cache(ds).set("https://example.com/", ["https://github.com/example"])
+    assert invalidate_url(ds, "https://example.com/") == ["hcards", "rel_me"]
+    assert "https://example.com/" not in hcard_cache(ds)
+    assert "https://example.com/" not in rel_me_cache(ds)
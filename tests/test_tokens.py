@@ -0,0 +1,207 @@
+from datasette.app import Datasette
+from datasette_indieauth import tokenbench
+from datasette_indieauth.discovery import discovery_cache
+from datasette_indieauth.tokenbench import benchmark_tokens
+from datasette_indieauth.tokens import (
+    COOKIE_FORMAT,
+    TOKEN_VERSION,
+    _endpoint_registries,
+    endpoint_id,
+    sign_bytes,
+    sign_cookie,
+    sign_state,
+    unsign_cookie,
+    unsign_state,
+)
+from datasette_indieauth.utils import challenge_verifier_pair
+import httpx
+import itsdangerous
+import json
+import pytest
+import runpy
+import time
+
+NAMESPACE = "datasette-indieauth-state"
+AUTH = "https://indieauth.simonwillison.net/auth"
+PROFILE = '<link rel="authorization_endpoint" href="{}">'
+
+
+def test_state_round_trip():
+    ds = Datasette([], memory=True)
+    state_bits = {"a": AUTH, "n": "0123456789abcdef", "t": int(time.time())}
+    state = sign_state(ds, state_bits, NAMESPACE)
+    assert len(state) == 50
+    assert unsign_state(ds, state, NAMESPACE) == dict(state_bits, i=endpoint_id(AUTH))
+    # Another instance can check the signature but does not know the endpoint
+    other = Datasette([], memory=True)
+    other._secret = ds._secret
+    assert unsign_state(other, state, NAMESPACE)["a"] is None
+    # Signed for a different purpose
+    with pytest.raises(itsdangerous.BadSignature):
+        unsign_state(ds, state, "datasette-indieauth-cookie")
+
+
+def test_cookie_round_trip():
+    ds = Datasette([], memory=True)
+    _, verifier = challenge_verifier_pair()
+    me = "https://例え.jp/"
+    cookie = sign_cookie(ds, verifier, me, "ns")
+    assert unsign_cookie(ds, cookie, "ns") == {"v": verifier, "m": me}
+    cookie = sign_cookie(ds, verifier, me, "ns", provider="https://example.com/me")
+    assert unsign_cookie(ds, cookie, "ns") == {
+        "v": verifier,
+        "m": me,
+        "p": "https://example.com/me",
+    }
+
+
+@pytest.mark.parametrize(
+    "token",
+    (
+        "",
+        "not-a-token",
+        "AQ",
+        "!!!",
+        "é",
+    ),
+)
+def test_invalid_tokens(token):
+    ds = Datasette([], memory=True)
+    with pytest.raises(itsdangerous.BadSignature):
+        unsign_state(ds, token, NAMESPACE)
+    with pytest.raises(itsdangerous.BadSignature):
+        unsign_cookie(ds, token, NAMESPACE)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    (
+        # Signed correctly, but not something this version wrote
+        bytes([TOKEN_VERSION + 1]) + b"\x00" * 20,
+        bytes([TOKEN_VERSION]),
+        COOKIE_FORMAT.pack(TOKEN_VERSION, 0) + b"\xff",
+    ),
+)
+def test_invalid_payloads(payload):
+    ds = Datasette([], memory=True)
+    token = sign_bytes(ds, payload, NAMESPACE)
+    with pytest.raises(itsdangerous.BadSignature):
+        unsign_state(ds, token, NAMESPACE)
+    with pytest.raises(itsdangerous.BadSignature):
+        unsign_cookie(ds, token, NAMESPACE)
+
+
+def test_tampered_tokens_rejected():
+    ds = Datasette([], memory=True)
+    state = sign_state(ds, {"a": AUTH, "n": "00" * 8, "t": 1}, NAMESPACE)
+    tampered = state[:5] + ("A" if state[5] != "A" else "B") + state[6:]
+    with pytest.raises(itsdangerous.BadSignature):
+        unsign_state(ds, tampered, NAMESPACE)
+
+
+def test_legacy_tokens_accepted():
+    ds = Datasette([], memory=True)
+    state_bits = {"a": AUTH, "n": "1", "t": 1}
+    assert unsign_state(ds, ds.sign(state_bits, NAMESPACE), NAMESPACE) == dict(
+        state_bits, i=None
+    )
+    cookie_bits = {"v": "verifier", "m": "https://example.com/"}
+    assert unsign_cookie(ds, ds.sign(cookie_bits, "ns"), "ns") == cookie_bits
+
+
+def test_benchmark_tokens():
+    results = benchmark_tokens(iterations=10)
+    assert results["iterations"] == 10
+    for kind in ("state", "cookie"):
+        assert results["compact"][kind]["bytes"] < results["legacy"][kind]["bytes"]
+        assert results["compact"][kind]["signs_per_second"] > 0
+        assert results["compact"][kind]["unsigns_per_second"] > 0
+
+
+def test_tokenbench_main(capsys):
+    tokenbench.main(
+        [
+            "--iterations",
+            "2",
+            "--me",
+            "https://example.com/",
+            "--authorization-endpoint",
+            "https://example.com/auth",
+        ]
+    )
+    results = json.loads(capsys.readouterr().out)
+    assert results["iterations"] == 2
+    assert set(results) == {"iterations", "legacy", "compact"}
+
+
+# The module is already imported, which runpy warns about
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_tokenbench_python_m(capsys, monkeypatch):
+    monkeypatch.setattr("sys.argv", ["tokenbench", "--help"])
+    with pytest.raises(SystemExit):
+        runpy.run_module("datasette_indieauth.tokenbench", run_name="__main__")
+    assert "Benchmark the datasette-indieauth" in capsys.readouterr().out
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("same_endpoint", (True, False))
+async def test_unknown_endpoint_id_is_rediscovered(
+    httpx_mock, start_sign_in, finish_sign_in, same_endpoint
+):
+    me = "https://simonwillison.net/"
+    httpx_mock.add_response(url=me, text=PROFILE.format(AUTH))
+    ds = Datasette([], memory=True)
+    post_response = await start_sign_in(ds, me)
+    # As if another process had started the sign-in
+    _endpoint_registries.pop(ds)
+    httpx_mock.reset()
+    profile = PROFILE.format(AUTH if same_endpoint else "https://evil.example.com/auth")
+    httpx_mock.add_response(url=me, text=profile, is_reusable=True)
+    if same_endpoint:
+        httpx_mock.add_response(
+            url=AUTH, method="POST", text="me=https%3A%2F%2Fsimonwillison.net%2F"
+        )
+    discovery_cache(ds).clear()
+    response = await finish_sign_in(ds, post_response)
+    if same_endpoint:
+        assert response.status_code == 302
+        assert "ds_actor" in response.cookies
+    else:
+        assert response.status_code == 400
+        assert "Invalid state" in response.text
+        assert not [r for r in httpx_mock.get_requests() if r.method == "POST"]
+
+
+@pytest.mark.asyncio
+async def test_unknown_endpoint_id_rediscovery_fails(
+    httpx_mock, start_sign_in, finish_sign_in
+):
+    me = "https://simonwillison.net/"
+    httpx_mock.add_response(url=me, text=PROFILE.format(AUTH))
+    ds = Datasette([], memory=True)
+    post_response = await start_sign_in(ds, me)
+    _endpoint_registries.pop(ds)
+    discovery_cache(ds).clear()
+    httpx_mock.add_exception(httpx.ConnectError("Connection refused"), url=me)
+    response = await finish_sign_in(ds, post_response)
+    assert response.status_code == 400
+    assert "Invalid state" in response.text
+    assert not [r for r in httpx_mock.get_requests() if r.method == "POST"]
+
+
+@pytest.mark.asyncio
+async def test_state_without_endpoint_or_id():
+    ds = Datasette([], memory=True)
+    # An old-format state that is missing the authorization_endpoint
+    state = ds.sign({"n": "1", "t": int(time.time())}, NAMESPACE)
+    _, verifier = challenge_verifier_pair()
+    cookie = sign_cookie(
+        ds, verifier, "https://simonwillison.net/", "datasette-indieauth-cookie"
+    )
+    response = await ds.client.get(
+        "/-/indieauth/done",
+        params={"state": state, "code": "123"},
+        cookies={"ds_indieauth": cookie},
+    )
+    assert response.status_code == 400
+    assert "Invalid state" in response.text
@@ -1,8 +1,15 @@
+import asyncio
 from collections import namedtuple
+import gzip
 import hashlib
+import httpx
 import pytest
+from pytest_httpx import IteratorStream
+import time
+import zlib
 from urllib.parse import parse_qsl
 from datasette_indieauth import utils
+from datasette_indieauth.cache import TTLCache
 from datasette.app import Datasette
 
 
@@ -252,7 +259,10 @@ MockRequest = namedtuple("MockRequest", ("status", "url", "body", "headers"))
 )
 async def test_discover_endpoints(httpx_mock, mocks, expected, expected_error):
     for status, url, body, headers in mocks:
-        httpx_mock.add_response(url=url, text=body, headers=headers, status_code=status)
+        # The too-many-redirects case requests the same URL repeatedly
+        httpx_mock.add_response(
+            url=url, text=body, headers=headers, status_code=status, is_reusable=True
+        )
     if expected_error:
         with pytest.raises(expected_error):
             actual = await utils.discover_endpoints("https://aaronparecki.com/")
@@ -261,6 +271,160 @@ async def test_discover_endpoints(httpx_mock, mocks, expected, expected_error):
         assert actual == expected
 
 
+@pytest.mark.asyncio
+async def test_discover_endpoints_redirect_cache(httpx_mock):
+    redirect_cache = TTLCache()
+    link = '<link rel="authorization_endpoint" href="https://www.example.com/auth">'
+    httpx_mock.add_response(
+        url="http://example.com/",
+        status_code=301,
+        headers={"location": "https://example.com/"},
+    )
+    httpx_mock.add_response(
+        url="https://example.com/",
+        status_code=308,
+        headers={"location": "https://www.example.com/"},
+    )
+    httpx_mock.add_response(
+        url="https://www.example.com/",
+        status_code=302,
+        headers={"location": "/home"},
+        is_reusable=True,
+    )
+    httpx_mock.add_response(
+        url="https://www.example.com/home", text=link, is_reusable=True
+    )
+    expected = ("https://www.example.com/", "https://www.example.com/auth", None)
+    assert (
+        await utils.discover_endpoints(
+            "http://example.com/", redirect_cache=redirect_cache
+        )
+        == expected
+    )
+    # Only the permanent redirects were remembered
+    assert [(key, value) for key, value, _ in redirect_cache.items()] == [
+        ("http://example.com/", "https://example.com/"),
+        ("https://example.com/", "https://www.example.com/"),
+    ]
+    # Second time goes straight to the final URL
+    assert (
+        await utils.discover_endpoints(
+            "http://example.com/", redirect_cache=redirect_cache
+        )
+        == expected
+    )
+    assert [str(r.url) for r in httpx_mock.get_requests()] == [
+        "http://example.com/",
+        "https://example.com/",
+        "https://www.example.com/",
+        "https://www.example.com/home",
+        "https://www.example.com/",
+        "https://www.example.com/home",
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("gone", ("404", "connect_error"))
+async def test_discover_endpoints_stale_redirect_cache(httpx_mock, gone):
+    redirect_cache = TTLCache()
+    redirect_cache.set("https://example.com/", "https://old.example.com/")
+    if gone == "404":
+        httpx_mock.add_response(url="https://old.example.com/", status_code=404)
+    else:
+        httpx_mock.add_exception(
+            httpx.ConnectError("Name or service not known"),
+            url="https://old.example.com/",
+        )
+    httpx_mock.add_response(
+        url="https://example.com/",
+        text='<link rel="authorization_endpoint" href="https://example.com/auth">',
+    )
+    assert await utils.discover_endpoints(
+        "https://example.com/", redirect_cache=redirect_cache
+    ) == ("https://example.com/", "https://example.com/auth", None)
+    assert len(redirect_cache) == 0
+
+
+LINK = '<link rel="authorization_endpoint" href="https://example.com/auth">'
+SMALL_LIMITS = utils.ResponseLimits(
+    max_compressed_bytes=1000, max_decompressed_bytes=2000, max_read_seconds=0.5
+)
+
+
+class SlowStream(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield LINK.encode("utf-8")
+        await asyncio.sleep(5)
+        yield b""
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "response_kwargs,expected_error",
+    (
+        ({"text": LINK}, None),
+        ({"content": gzip.compress(LINK.encode("utf-8")), "gzip": True}, None),
+        ({"content": zlib.compress(LINK.encode("utf-8")), "deflate": True}, None),
+        # Content-Length over the limit fails before reading the body
+        ({"text": LINK + " " * 1000}, "Content-Length of 1067 exceeds 1000 bytes"),
+        # Decompression bomb: 1MB of zeros compresses to ~1KB
+        (
+            {"content": gzip.compress(b"\0" * 1024 * 1024)[:1000], "gzip": True},
+            "Decompressed response exceeded 2000 bytes",
+        ),
+        (
+            {"stream": IteratorStream([b"not gzip"]), "gzip": True},
+            "Could not decompress response",
+        ),
+        ({"content": b"", "headers": {"content-encoding": "br"}}, "br"),
+        # An unknown charset falls back to UTF-8
+        ({"text": LINK, "headers": {"content-type": "text/html; charset=nope"}}, None),
+        ({"stream": SlowStream()}, "Timed out after 0.5s reading"),
+    ),
+)
+async def test_discover_endpoints_limits(httpx_mock, response_kwargs, expected_error):
+    headers = response_kwargs.pop("headers", {})
+    if response_kwargs.pop("gzip", None):
+        headers["content-encoding"] = "gzip"
+    if response_kwargs.pop("deflate", None):
+        headers["content-encoding"] = "deflate"
+    httpx_mock.add_response(
+        url="https://example.com/", headers=headers, **response_kwargs
+    )
+    if expected_error:
+        with pytest.raises(utils.DiscoverEndpointsError) as ex:
+            await utils.discover_endpoints("https://example.com/", limits=SMALL_LIMITS)
+        assert expected_error in str(ex.value)
+    else:
+        assert await utils.discover_endpoints(
+            "https://example.com/", limits=SMALL_LIMITS
+        ) == ("https://example.com/", "https://example.com/auth", None)
+    request = httpx_mock.get_requests()[0]
+    assert request.headers["accept-encoding"] == "gzip, deflate"
+
+
+@pytest.mark.asyncio
+async def test_discover_endpoints_streamed_body_too_large(httpx_mock):
+    # No Content-Length header, so the limit is enforced while reading
+    httpx_mock.add_response(
+        url="https://example.com/",
+        stream=IteratorStream([b"x" * 600, b"x" * 600]),
+    )
+    with pytest.raises(utils.ResponseTooLargeError) as ex:
+        await utils.discover_endpoints("https://example.com/", limits=SMALL_LIMITS)
+    assert str(ex.value) == "Response exceeded 1000 bytes"
+
+
+def test_follow_cached_redirects_loop():
+    redirect_cache = TTLCache()
+    redirect_cache.set("https://a.com/", "https://b.com/")
+    redirect_cache.set("https://b.com/", "https://a.com/")
+    assert (
+        utils.follow_cached_redirects("https://a.com/", redirect_cache)
+        == "https://b.com/"
+    )
+
+
 @pytest.mark.parametrize(
     "url,expected",
     [
@@ -301,6 +465,10 @@ def test_build_authorization_url():
     assert hashlib.sha256(verifier.encode("utf-8")).digest() == utils.decode_challenge(
         bits["code_challenge"]
     )
+    state_bits = datasette.unsign(state)
+    assert state_bits["a"] == "https://example.com/auth"
+    assert state_bits["n"]
+    assert abs(state_bits["t"] - time.time()) < 5
 
 
 @pytest.mark.parametrize(
@@ -364,3 +532,165 @@ class MockResponse:
 )
 def test_resolve_permanent_redirects(start_url, responses, expected):
     assert expected == utils.resolve_permanent_redirects(start_url, responses)
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = utils.TokenBucket(rate=2, burst=3, timer=lambda: now[0])
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+    now[0] = 0.5
+    assert bucket.consume() is True
+    assert bucket.consume() is False
+    now[0] = 100
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+LARGE_PAGE = (
+    '<div class="h-card"><a href="/about">About</a></div>\n' * 8000
+    + '<link rel="authorization_endpoint" href="https://example.com/auth">'
+)
+
+
+async def max_loop_lag(*coros):
+    "Run coros concurrently, returning (results, longest event loop stall)"
+    lags = []
+    running = True
+
+    async def ticker():
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0)
+            lags.append(time.perf_counter() - start)
+
+    task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    results = await asyncio.gather(*coros)
+    running = False
+    await task
+    return results, max(lags)
+
+
+@pytest.mark.asyncio
+async def test_parse_pool_keeps_event_loop_responsive():
+    expected = [{"rel": "authorization_endpoint", "href": "https://example.com/auth"}]
+
+    async def parse_inline(html):
+        return utils.parse_link_rels(html)
+
+    results, inline_lag = await max_loop_lag(
+        parse_inline(LARGE_PAGE), parse_inline(LARGE_PAGE)
+    )
+    assert results == [expected, expected]
+    pool = utils.ParsePool(max_workers=2)
+    try:
+        results, pool_lag = await max_loop_lag(
+            pool.parse_link_rels(LARGE_PAGE), pool.parse_link_rels(LARGE_PAGE)
+        )
+    finally:
+        pool.shutdown()
+    assert results == [expected, expected]
+    # Inline parsing stalls the loop for a whole parse, the pool does not
+    assert pool_lag < 0.05
+    assert pool_lag < inline_lag / 4
+
+
+@pytest.mark.asyncio
+async def test_parse_pool_parses_small_pages_inline():
+    pool = utils.ParsePool(inline_max=100)
+    pool.executor.shutdown()
+    # A shut down executor would raise if it was used
+    assert await pool.parse_link_rels('<link rel="me" href="/me">') == [
+        {"rel": "me", "href": "/me"}
+    ]
+    with pytest.raises(RuntimeError):
+        await pool.parse_link_rels(LARGE_PAGE)
+
+
+@pytest.mark.parametrize(
+    "html,expected",
+    (
+        ("<p>No h-card here</p>", {}),
+        (
+            '<div class="h-card"><img class="u-photo" src="/me.jpg">'
+            '<a class="p-name u-url" href="/">Simon Willison</a></div>',
+            {
+                "name": "Simon Willison",
+                "photo": "https://simonwillison.net/me.jpg",
+                "url": "https://simonwillison.net/",
+            },
+        ),
+        # Implied name from the text of the h-card
+        (
+            '<a class="h-card" href="/">  Simon\n  Willison </a>',
+            {"name": "Simon Willison"},
+        ),
+        (
+            '<img class="h-card" alt="Simon" src="https://cdn.example.com/s.png">',
+            {"name": "Simon", "photo": "https://cdn.example.com/s.png"},
+        ),
+        # Properties of nested microformats are ignored
+        (
+            '<div class="h-card"><span class="p-name">Simon</span>'
+            '<div class="p-org h-card"><span class="p-name">Org</span>'
+            '<img class="u-photo" src="/org.png"></div></div>',
+            {"name": "Simon"},
+        ),
+        # The h-card for the page URL is preferred
+        (
+            '<div class="h-card"><a class="u-url p-name" href="https://other.example.com/">Other</a></div>'
+            '<p><div class="h-card"><a class="u-url p-name" href="/">Simon</a><br></div>',
+            {"name": "Simon", "url": "https://simonwillison.net/"},
+        ),
+        # Only http and https photo URLs
+        (
+            '<div class="h-card"><span class="p-name">Simon</span>'
+            '<img class="u-photo" src="javascript:alert(1)"></div>',
+            {"name": "Simon"},
+        ),
+        # Name from alt text, a stray end tag and a u-url without an href
+        (
+            '<div class="h-card"><img class="p-name" alt="Simon"></span>'
+            '<a class="u-url">Home</a></div>',
+            {"name": "Simon"},
+        ),
+        # URLs httpx can't parse are left out
+        (
+            '<div class="h-card"><span class="p-name">Simon</span>'
+            '<img class="u-photo" src="http://\x01x/"></div>',
+            {"name": "Simon"},
+        ),
+    ),
+)
+def test_parse_profile_page_hcard(html, expected):
+    rels, hcard = utils.parse_profile_page(
+        '<link rel="me" href="https://github.com/simonw">' + html,
+        "https://simonwillison.net/",
+    )
+    assert rels == [{"rel": "me", "href": "https://github.com/simonw"}]
+    assert hcard == expected
+
+
+@pytest.mark.asyncio
+async def test_discover_endpoints_hcards(httpx_mock):
+    httpx_mock.add_response(
+        url="https://simonwillison.net/",
+        headers={
+            "link": '<https://indieauth.com/auth>; rel="authorization_endpoint", '
+            '<https://tokens.indieauth.com/token>; rel="token_endpoint"'
+        },
+        text='<div class="h-card"><span class="p-name">Simon</span></div>',
+        is_reusable=True,
+    )
+    hcards = TTLCache()
+    # Link headers are enough for the endpoints, but the body is still read
+    result = await utils.discover_endpoints("https://simonwillison.net/", hcards=hcards)
+    assert result == (
+        "https://simonwillison.net/",
+        "https://indieauth.com/auth",
+        "https://tokens.indieauth.com/token",
+    )
+    assert hcards.get("https://simonwillison.net/") == {"name": "Simon"}
+    # Once cached the page is not parsed again
+    hcards.set("https://simonwillison.net/", {"name": "Cached"})
+    await utils.discover_endpoints("https://simonwillison.net/", hcards=hcards)
+    assert hcards.get("https://simonwillison.net/") == {"name": "Cached"}